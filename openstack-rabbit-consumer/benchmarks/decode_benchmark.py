@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Microbenchmark comparing the previous message decoding, which fully
+parsed every message, against the current decoding which sniffs the
+event type first and decodes supported messages once.
+
+Run from the openstack-rabbit-consumer directory with:
+python3 -m benchmarks.decode_benchmark [--messages FILE]
+
+Where FILE holds recorded raw message bodies, one per line.
+"""
+import argparse
+import json
+import logging
+import random
+import time
+import uuid
+from typing import Callable, List, Optional
+
+from rabbit_consumer.message_consumer import SUPPORTED_MESSAGE_TYPES, decode_message
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.replay import ReplayedMessage
+
+# Event types commonly seen on the queue which we ignore
+_IGNORED_EVENT_TYPES = [
+    "compute.instance.update",
+    "compute.instance.exists",
+    "compute.instance.power_off.start",
+    "compute.instance.power_off.end",
+    "compute.instance.create.start",
+    "compute.instance.delete.end",
+    "port.create.end",
+]
+
+
+def make_message(
+    event_type: str,
+    instance_id: Optional[str] = None,
+    image_id: Optional[str] = None,
+    ip_addr: str = "172.16.0.10",
+) -> bytes:
+    """
+    Builds a raw message body of a similar size and shape to a real
+    Nova notification, for a random instance and image unless given
+    """
+    instance_id = instance_id if instance_id else str(uuid.uuid4())
+    image_id = image_id if image_id else str(uuid.uuid4())
+    payload = {
+        "instance_id": instance_id,
+        "display_name": f"vm-{instance_id[:8]}",
+        "vcpus": 2,
+        "memory_mb": 4096,
+        "host": "hv123.nubes.rl.ac.uk",
+        "metadata": {"AQ_MACHINENAME": "vm-openstack-1234"},
+        "image_ref_url": f"https://image.example.com/images/{image_id}",
+        "image_meta": {
+            "base_image_ref": image_id,
+            "AQ_OS": "rocky",
+            "AQ_OSVERSION": "8x-x86_64",
+            "hw_machine_type": "q35",
+        },
+        "fixed_ips": [
+            {
+                "address": ip_addr,
+                "vif_mac": "fa:16:3e:00:00:01",
+                "version": 4,
+                "label": "Internal",
+                "type": "fixed",
+                "meta": {},
+            }
+        ],
+        "state": "active",
+        "state_description": "",
+        "launched_at": "2023-01-01T00:00:00.000000",
+        "tenant_id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+    }
+    oslo_message = {
+        "message_id": str(uuid.uuid4()),
+        "publisher_id": "compute.hv123.nubes.rl.ac.uk",
+        "event_type": event_type,
+        "priority": "INFO",
+        "timestamp": "2023-01-01 00:00:00.000000",
+        "_context_project_name": "project",
+        "_context_project_id": str(uuid.uuid4()),
+        "_context_user_name": "user",
+        "_context_roles": ["member", "reader"],
+        "_context_request_id": f"req-{uuid.uuid4()}",
+        "payload": payload,
+    }
+    envelope = {"oslo.version": "2.0", "oslo.message": json.dumps(oslo_message)}
+    return json.dumps(envelope).encode("utf-8")
+
+
+def make_messages(count: int, supported_ratio: float) -> List[bytes]:
+    """
+    Builds a list of messages where the given ratio are supported events
+    """
+    rng = random.Random(0)
+    supported = list(SUPPORTED_MESSAGE_TYPES.values())
+    return [
+        make_message(
+            rng.choice(supported)
+            if rng.random() < supported_ratio
+            else rng.choice(_IGNORED_EVENT_TYPES)
+        )
+        for _ in range(count)
+    ]
+
+
+def load_messages(path: str) -> List[bytes]:
+    """
+    Loads recorded raw message bodies, one per line
+    """
+    with open(path, "rb") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def previous_decode(raw_body: bytes) -> Optional[RabbitMessage]:
+    """
+    The previous decoding path, which parsed the envelope, then the
+    oslo.message once for the event type and again for the full message
+    """
+    body = json.loads(raw_body.decode("utf-8"))["oslo.message"]
+    event_type = json.loads(body)["event_type"]
+    if event_type not in SUPPORTED_MESSAGE_TYPES.values():
+        return None
+    return RabbitMessage.from_json(body)
+
+
+def current_decode(raw_body: bytes) -> Optional[RabbitMessage]:
+    """
+    The current decoding path used by the consumer
+    """
+    return decode_message(ReplayedMessage(raw_body))
+
+
+def time_decode(
+    decode: Callable[[bytes], Optional[RabbitMessage]],
+    messages: List[bytes],
+    repeats: int,
+) -> float:
+    """
+    Returns the best time in seconds to decode all the messages
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for raw_body in messages:
+            decode(raw_body)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", help="File of recorded raw messages")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--supported-ratio", type=float, default=0.05)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    # Stop per-message logging from dominating the results
+    logging.getLogger("rabbit_consumer").setLevel(logging.WARNING)
+
+    if args.messages:
+        messages = load_messages(args.messages)
+    else:
+        messages = make_messages(args.count, args.supported_ratio)
+
+    previous = time_decode(previous_decode, messages, args.repeats)
+    current = time_decode(current_decode, messages, args.repeats)
+
+    print(f"Messages:  {len(messages)}")
+    for name, taken in (("Previous", previous), ("Current", current)):
+        print(
+            f"{name + ':':10} {taken * 1000:8.1f} ms total, "
+            f"{taken / len(messages) * 1e6:6.1f} us/msg, "
+            f"{len(messages) / taken:9.0f} msgs/s"
+        )
+    print(f"Speed-up:  {previous / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
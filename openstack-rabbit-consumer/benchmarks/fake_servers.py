@@ -0,0 +1,455 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+In-process stand-ins for the Aquilon broker and the Keystone, Nova and
+Glance APIs used by the consumer. These keep real state so a full
+create/delete flow can be run over HTTP, with configurable latency
+and error injection for load testing.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Status code, headers and body returned by a route
+Response = Tuple[int, Dict[str, str], Union[str, Dict]]
+
+
+@dataclass
+class FaultInjection:
+    """
+    Latency added to every request, and the chance of a request failing
+    """
+
+    latency: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    seed: int = 0
+    _rng: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def apply(self) -> Optional[Response]:
+        """
+        Sleeps for the latency, returning an error response if one is injected
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._rng.random() < self.error_rate:
+            return self.error_status, {}, "Injected error"
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Passes every request to the fake server's route method
+    """
+
+    server: "_HTTPServer"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def _handle(self) -> None:
+        parsed = urlsplit(self.path)
+        params = {
+            key: values[0]
+            for key, values in parse_qs(parsed.query, keep_blank_values=True).items()
+        }
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        fake = self.server.fake
+        response = fake.faults.apply()
+        if not response:
+            with fake.lock:
+                response = fake.route(self.command, parsed.path, params, body)
+        status, headers, content = response
+
+        if isinstance(content, dict):
+            encoded = json.dumps(content).encode()
+            headers = {"Content-Type": "application/json", **headers}
+        else:
+            encoded = content.encode()
+            headers = {"Content-Type": "text/plain", **headers}
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server which holds a reference to its fake
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fake: "FakeServer"):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.fake = fake
+
+
+class FakeServer:
+    """
+    Base class running a fake API on a random local port in a background
+    thread. Subclasses implement route, which is called under a lock so
+    state changes are atomic.
+    """
+
+    def __init__(self, faults: Optional[FaultInjection] = None):
+        self.faults = faults if faults else FaultInjection()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self._httpd = _HTTPServer(self)
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name=type(self).__name__, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        """
+        Returns the base URL of the server
+        """
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServer":
+        """
+        Starts serving requests
+        """
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops serving requests
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def route(
+        self, method: str, path: str, params: Dict[str, str], body: Optional[Dict]
+    ) -> Response:
+        """
+        Handles a request, returning the response
+        """
+        raise NotImplementedError
+
+
+@dataclass
+class FakeMachine:
+    """
+    A machine record held by the fake Aquilon
+    """
+
+    name: str
+    serial: str
+    interfaces: Dict[str, str] = field(default_factory=dict)
+    host: Optional[str] = None
+
+
+@dataclass
+class FakeHost:
+    """
+    A host record held by the fake Aquilon
+    """
+
+    hostname: str
+    machine: str
+    ip: str
+    makes: int = 0
+
+
+class FakeAquilon(FakeServer):
+    """
+    Implements the Aquilon broker endpoints used by aq_api, enforcing the
+    same ordering rules, e.g. a machine can't be deleted while it has a host
+    """
+
+    def __init__(self, faults: Optional[FaultInjection] = None):
+        super().__init__(faults)
+        self.machines: Dict[str, FakeMachine] = {}
+        self.hosts: Dict[str, FakeHost] = {}
+        self._next_machine = 0
+
+    # pylint: disable=too-many-return-statements,too-many-branches
+    def route(
+        self, method: str, path: str, params: Dict[str, str], body: Optional[Dict]
+    ) -> Response:
+        self.requests += 1
+        parts = path.strip("/").split("/")
+
+        if method == "PUT" and parts[0] == "next_machine":
+            self._next_machine += 1
+            name = f"{parts[1]}{self._next_machine}"
+            self.machines[name] = FakeMachine(name=name, serial=params["serial"])
+            return 200, {}, name
+
+        if parts[0] == "find" and parts[1] == "machine":
+            found = [
+                i
+                for i in self.machines.values()
+                if params.get("serial", i.serial) == i.serial
+            ]
+            if "fullinfo" in params:
+                return 200, {}, "\n".join(self._describe(i) for i in found)
+            return 200, {}, "\n".join(i.name for i in found)
+
+        if parts[0] == "find" and parts[1] == "host":
+            machine = self.machines.get(params["machine"])
+            return 200, {}, machine.host if machine and machine.host else ""
+
+        if parts[0] == "machine":
+            return self._route_machine(method, parts, params)
+
+        if path == "/host/command/reconfigure_list":
+            hostnames = params["list"].split("\n")
+            missing = [i for i in hostnames if i not in self.hosts]
+            if missing:
+                return 400, {}, f"Invalid hosts in list: {', '.join(missing)}"
+            for hostname in hostnames:
+                self.hosts[hostname].makes += 1
+            return 200, {}, ""
+
+        if parts[0] == "host":
+            return self._route_host(method, parts, params)
+
+        if path in ("/interface_address", "/interface/command/del"):
+            machine = self.machines.get(params["machine"])
+            if not machine:
+                return 400, {}, f"Machine {params['machine']} not found."
+            if path == "/interface/command/del":
+                machine.interfaces.pop(params["interface"], None)
+            return 200, {}, ""
+
+        return 404, {}, f"No route for {method} {path}"
+
+    def _route_machine(
+        self, method: str, parts: List[str], params: Dict[str, str]
+    ) -> Response:
+        machine = self.machines.get(parts[1])
+        if not machine:
+            return 400, {}, f"Machine {parts[1]} not found."
+
+        if len(parts) == 4 and parts[2] == "interface":
+            if method == "PUT":
+                machine.interfaces[parts[3]] = params["mac"]
+            return 200, {}, ""
+
+        if method == "DELETE":
+            if machine.host:
+                return 400, {}, f"Machine {machine.name} is still in use by a host."
+            del self.machines[machine.name]
+            return 200, {}, ""
+
+        return 200, {}, self._describe(machine)
+
+    def _describe(self, machine: FakeMachine) -> str:
+        lines = [f"Virtual_machine: {machine.name}"]
+        if machine.host:
+            host = self.hosts[machine.host]
+            lines.append(f"  Primary Name: {host.hostname} [{host.ip}]")
+        lines.append(f"  Serial: {machine.serial}")
+        for name, mac in machine.interfaces.items():
+            lines.append(f"  Interface: {name} {mac}")
+            if machine.host:
+                lines.append(f"    Provides: {self.hosts[machine.host].ip}")
+        return "\n".join(lines)
+
+    def _route_host(
+        self, method: str, parts: List[str], params: Dict[str, str]
+    ) -> Response:
+        hostname = parts[1]
+        host = self.hosts.get(hostname)
+
+        if method == "PUT":
+            if host:
+                return 400, {}, f"Host {hostname} already exists."
+            machine = self.machines.get(params["machine"])
+            if not machine:
+                return 400, {}, f"Machine {params['machine']} not found."
+            self.hosts[hostname] = FakeHost(hostname, machine.name, params["ip"])
+            machine.host = hostname
+            return 200, {}, ""
+
+        if not host:
+            return 400, {}, f"Host {hostname} not found."
+
+        if method == "DELETE":
+            del self.hosts[hostname]
+            self.machines[host.machine].host = None
+            return 200, {}, ""
+
+        if len(parts) == 4 and parts[3] == "make":
+            host.makes += 1
+        return 200, {}, f"Primary Name: {hostname}"
+
+
+class FakeOpenstack(FakeServer):
+    """
+    Implements the Keystone, Nova and Glance (through the Nova images
+    proxy) calls made through openstacksdk by openstack_api
+    """
+
+    def __init__(self, faults: Optional[FaultInjection] = None):
+        super().__init__(faults)
+        self.servers: Dict[str, Dict] = {}
+        self.images: Dict[str, Dict] = {}
+
+    @property
+    def auth_url(self) -> str:
+        """
+        Returns the Keystone URL to pass to openstacksdk
+        """
+        return f"{self.url}/identity/v3"
+
+    def add_image(self, metadata: Dict[str, str]) -> str:
+        """
+        Adds an image with the given metadata, returning its ID
+        """
+        image_id = str(uuid.uuid4())
+        with self.lock:
+            self.images[image_id] = {
+                "id": image_id,
+                "name": f"image-{image_id[:8]}",
+                "status": "ACTIVE",
+                "metadata": metadata,
+            }
+        return image_id
+
+    def add_server(self, server_id: str, image_id: str, ip_addr: str) -> None:
+        """
+        Adds a server with a single address on the internal network
+        """
+        with self.lock:
+            self.servers[server_id] = {
+                "id": server_id,
+                "name": f"vm-{server_id[:8]}",
+                "status": "ACTIVE",
+                "tenant_id": "project",
+                "user_id": "user",
+                "OS-EXT-SRV-ATTR:host": "hv1.example.com",
+                "flavor": {"vcpus": 2, "ram": 4096, "disk": 20, "original_name": "m1"},
+                "image": {"id": image_id},
+                "metadata": {},
+                "addresses": {
+                    "Internal": [
+                        {
+                            "OS-EXT-IPS-MAC:mac_addr": "fa:16:3e:00:00:01",
+                            "version": 4,
+                            "addr": ip_addr,
+                            "OS-EXT-IPS:type": "fixed",
+                        }
+                    ]
+                },
+            }
+
+    def route(
+        self, method: str, path: str, params: Dict[str, str], body: Optional[Dict]
+    ) -> Response:
+        self.requests += 1
+        if path.startswith("/identity"):
+            return self._route_identity(method, path)
+        if path.startswith("/compute"):
+            return self._route_compute(method, path.split("/")[3:], body)
+        return 404, {}, {"error": f"No route for {method} {path}"}
+
+    def _route_identity(self, method: str, path: str) -> Response:
+        if method == "POST" and path.rstrip("/").endswith("/auth/tokens"):
+            expires = datetime.now(timezone.utc) + timedelta(hours=1)
+            compute = [
+                {"interface": interface, "region": "RegionOne", "url": self.url + url}
+                for interface in ("public", "internal", "admin")
+                for url in ("/compute/v2.1",)
+            ]
+            token = {
+                "token": {
+                    "methods": ["password"],
+                    "expires_at": expires.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                    "user": {
+                        "id": "admin",
+                        "name": "admin",
+                        "domain": {"id": "default"},
+                    },
+                    "project": {
+                        "id": "admin",
+                        "name": "admin",
+                        "domain": {"id": "default"},
+                    },
+                    "catalog": [
+                        {"type": "compute", "name": "nova", "endpoints": compute},
+                    ],
+                }
+            }
+            return 201, {"X-Subject-Token": uuid.uuid4().hex}, token
+
+        version = {
+            "id": "v3.14",
+            "status": "stable",
+            "links": [{"rel": "self", "href": self.auth_url + "/"}],
+        }
+        return 200, {}, {"version": version}
+
+    # pylint: disable=too-many-return-statements
+    def _route_compute(
+        self, method: str, parts: List[str], body: Optional[Dict]
+    ) -> Response:
+        if not parts or not parts[0]:
+            version = {
+                "id": "v2.1",
+                "status": "CURRENT",
+                "version": "2.96",
+                "min_version": "2.1",
+                "links": [{"rel": "self", "href": self.url + "/compute/v2.1/"}],
+            }
+            return 200, {}, {"version": version}
+
+        if parts[0] == "images" and len(parts) == 2:
+            image = self.images.get(parts[1])
+            if not image:
+                return 404, {}, {"itemNotFound": {"message": "Image not found"}}
+            return 200, {}, {"image": image}
+
+        if parts[0] == "servers" and len(parts) == 1:
+            # Used by find_server when looking up by name
+            return 200, {}, {"servers": []}
+
+        if parts[0] == "servers" and parts[1] == "detail":
+            return 200, {}, {"servers": list(self.servers.values())}
+
+        if parts[0] == "servers":
+            server = self.servers.get(parts[1])
+            if not server:
+                return 404, {}, {"itemNotFound": {"message": "Server not found"}}
+            if len(parts) == 3 and parts[2] == "metadata" and method == "POST":
+                server["metadata"].update(body["metadata"])
+                return 200, {}, {"metadata": server["metadata"]}
+            return 200, {}, {"server": server}
+
+        return 404, {}, {"error": f"No route for {method} {'/'.join(parts)}"}
@@ -0,0 +1,242 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Load benchmark which runs create and delete messages through the full
+consumer against in-process fake Aquilon and Openstack servers, and
+reports the throughput and latency percentiles. Latency and errors can
+be injected into the fakes to see how the consumer degrades.
+
+Run from the openstack-rabbit-consumer directory with:
+python3 -m benchmarks.load_benchmark [--vms N] [--workers N] [--latency S]
+"""
+import argparse
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from typing import Iterator, List, Tuple
+from unittest.mock import patch
+
+import rabbitpy
+
+from benchmarks.decode_benchmark import make_message
+from benchmarks.fake_servers import FakeAquilon, FakeOpenstack, FaultInjection
+from rabbit_consumer import (
+    aq_api,
+    dns_resolver,
+    image_cache,
+    make_batcher,
+    openstack_api,
+)
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.message_consumer import (
+    SUPPORTED_MESSAGE_TYPES,
+    create_worker_pool,
+    dispatch_message,
+)
+from rabbit_consumer.replay import ReplayedMessage, ReplayReport
+from rabbit_consumer.retry_queue import RetryHandler
+
+_DOMAIN = "benchmark.example.com"
+
+# The instance ID each message is for, and its raw body
+LoadMessage = Tuple[str, bytes]
+
+
+class _TimedMessage(ReplayedMessage):
+    """
+    A replayed message which records its latency in the report once acked,
+    measured from when it was due to be received
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, body: bytes, due: float, report: ReplayReport):
+        super().__init__(body)
+        self.due = due
+        self.report = report
+
+    def ack(self, all_previous: bool = False) -> None:
+        # Appending to a list is atomic, so workers can share the report
+        self.report.latencies.append(time.monotonic() - self.due)
+
+
+class _CountingRetryHandler(RetryHandler):
+    """
+    Counts failed messages in the report rather than republishing them,
+    as there is no broker to retry them on
+    """
+
+    def __init__(self, report: ReplayReport):
+        super().__init__("benchmark")
+        self.report = report
+        self._lock = threading.Lock()
+
+    def retry(self, message: rabbitpy.Message, err: Exception) -> None:
+        logging.getLogger(__name__).debug("Message failed: %s", err)
+        with self._lock:
+            self.report.failed += 1
+
+    park = retry
+    dead_letter = retry
+
+
+def _fake_hostname(ip_addr: str) -> str:
+    return f"host-{ip_addr.replace('.', '-')}.{_DOMAIN}"
+
+
+def _fake_gethostbyaddr(ip_addr: str, latency: float) -> Tuple[str, List, List]:
+    time.sleep(latency)
+    return _fake_hostname(ip_addr), [], [ip_addr]
+
+
+def _fake_gethostbyname(hostname: str, latency: float) -> str:
+    time.sleep(latency)
+    return hostname.split(".")[0][len("host-") :].replace("-", ".")
+
+
+@contextmanager
+def fake_environment(
+    aquilon: FakeAquilon, openstack: FakeOpenstack, dns_latency: float = 0.0
+) -> Iterator[None]:
+    """
+    Points the consumer at the fake servers. Kerberos is skipped as the
+    fakes don't negotiate, and DNS answers are derived from the address.
+    """
+    env = {
+        "AQ_URL": aquilon.url,
+        "AQ_PREFIX": "vm-benchmark-",
+        "OPENSTACK_AUTH_URL": openstack.auth_url,
+        "OPENSTACK_USERNAME": "admin",
+        "OPENSTACK_PASSWORD": "password",
+    }
+    with ExitStack() as stack:
+        stack.enter_context(patch.dict(os.environ, env))
+        stack.enter_context(
+            patch("rabbit_consumer.aq_api.verify_kerberos_ticket", return_value=True)
+        )
+        stack.enter_context(
+            patch.object(
+                socket,
+                "gethostbyaddr",
+                functools.partial(_fake_gethostbyaddr, latency=dns_latency),
+            )
+        )
+        stack.enter_context(
+            patch.object(
+                socket,
+                "gethostbyname",
+                functools.partial(_fake_gethostbyname, latency=dns_latency),
+            )
+        )
+        # The fake Aquilon doesn't speak SPNEGO
+        stack.enter_context(patch.object(aq_api, "HTTPKerberosAuth", lambda: None))
+        try:
+            yield
+        finally:
+            make_batcher.stop_make_batcher()
+            aq_api.close_aq_client()
+            openstack_api.close_openstack_connection()
+            image_cache.reset_image_cache()
+            dns_resolver.reset_dns_resolver()
+
+
+def make_load(openstack: FakeOpenstack, vms: int, lag: int) -> List[LoadMessage]:
+    """
+    Adds the VMs to the fake Openstack and builds a create message for
+    each, followed by its delete message after lag other creates
+    """
+    image_id = openstack.add_image(
+        {
+            "AQ_ARCHETYPE": "cloud",
+            "AQ_DOMAIN": "prod_cloud",
+            "AQ_PERSONALITY": "nubesvms",
+            "AQ_OS": "rocky",
+            "AQ_OSVERSION": "8x-x86_64",
+        }
+    )
+    instance_ids = [str(uuid.uuid4()) for _ in range(vms)]
+    ip_addrs = {}
+    for i, instance_id in enumerate(instance_ids):
+        ip_addrs[instance_id] = f"10.0.{i // 250}.{i % 250 + 1}"
+        openstack.add_server(instance_id, image_id, ip_addrs[instance_id])
+
+    def message(event: str, instance_id: str) -> LoadMessage:
+        body = make_message(
+            SUPPORTED_MESSAGE_TYPES[event], instance_id, image_id, ip_addrs[instance_id]
+        )
+        return instance_id, body
+
+    load = []
+    for i, instance_id in enumerate(instance_ids):
+        load.append(message("create", instance_id))
+        if i >= lag:
+            load.append(message("delete", instance_ids[i - lag]))
+    for instance_id in instance_ids[max(vms - lag, 0) :]:
+        load.append(message("delete", instance_id))
+    return load
+
+
+def run_load(load: List[LoadMessage], workers: int, rate: float = 0.0) -> ReplayReport:
+    """
+    Dispatches the messages to the consumer's worker pool, as the consume
+    loop does, at the given rate per second or as fast as possible.
+    Latency is measured from when each message was due to be received.
+    """
+    report = ReplayReport()
+    retry_handler = _CountingRetryHandler(report)
+    config = ConsumerConfig()
+    config.consumer_workers = workers
+    pool = create_worker_pool(config)
+
+    start = time.monotonic()
+    for i, (_, body) in enumerate(load):
+        due = start + i / rate if rate > 0 else time.monotonic()
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        dispatch_message(
+            _TimedMessage(body, due, report), pool, retry_handler=retry_handler
+        )
+    pool.shutdown()
+    report.elapsed = time.monotonic() - start
+    return report
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vms", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0.0, help="0 for max speed")
+    parser.add_argument("--lag", type=int, default=100, help="Creates before a delete")
+    parser.add_argument("--latency", type=float, default=0.0, help="Per API request")
+    parser.add_argument("--dns-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # Stop per-message logging from dominating the results
+    logging.getLogger("rabbit_consumer").setLevel(logging.CRITICAL)
+
+    faults = FaultInjection(latency=args.latency, error_rate=args.error_rate)
+    with FakeAquilon(faults) as aquilon, FakeOpenstack(faults) as openstack:
+        load = make_load(openstack, args.vms, args.lag)
+        with fake_environment(aquilon, openstack, args.dns_latency):
+            report = run_load(load, args.workers, args.rate)
+
+        print(report.summary())
+        print(f"Aquilon:    {aquilon.requests} requests")
+        print(f"Openstack:  {openstack.requests} requests")
+        print(
+            f"Left over:  {len(aquilon.machines)} machines, {len(aquilon.hosts)} hosts"
+        )
+
+
+if __name__ == "__main__":
+    main()
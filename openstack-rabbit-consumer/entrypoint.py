@@ -23,5 +23,9 @@ if __name__ == "__main__":
     _prep_logging()
 
     from rabbit_consumer.message_consumer import initiate_consumer
+    from rabbit_consumer.metrics import start_metrics_server
+    from rabbit_consumer.shutdown import stop_on_sigterm
 
+    stop_on_sigterm()
+    start_metrics_server()
     initiate_consumer()
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file batches message acks into a single cumulative ack, covering
+every message up to the highest delivery tag where all earlier messages
+have completed. This cuts the broker round trips when draining bursts.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Set
+
+import rabbitpy
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedMessage:
+    """
+    Wraps a rabbitpy message so acks are passed to the batcher,
+    whilst everything else is passed to the message
+    """
+
+    def __init__(self, message: rabbitpy.Message, batcher: "AckBatcher"):
+        self._message = message
+        self._batcher = batcher
+
+    def ack(self, all_previous: bool = False) -> None:
+        """
+        Marks the message as complete, to be acked with the next batch
+        """
+        if all_previous:
+            raise ValueError("Batched messages can't be acked cumulatively")
+        self._batcher.complete(self._message)
+
+    def __getattr__(self, name: str):
+        return getattr(self._message, name)
+
+
+# pylint: disable=too-many-instance-attributes
+class AckBatcher:
+    """
+    Tracks delivered messages in order and acks them in batches. A batch
+    is flushed once max_batch messages have completed in order, or on a
+    background thread every interval seconds.
+
+    A message which is slow to complete, e.g. one held by the debouncer,
+    holds back the cumulative ack for every later message. So that these
+    don't fill the prefetch window, messages which completed out of order
+    are acked individually on each timed flush.
+    """
+
+    def __init__(self, max_batch: int, interval: float):
+        self.max_batch = max_batch
+        self.interval = interval
+        self.flushes = 0
+
+        self._lock = threading.Lock()
+        # Delivered messages which haven't been acked, in delivery order
+        self._pending: "OrderedDict[int, rabbitpy.Message]" = OrderedDict()
+        self._completed: Set[int] = set()
+        self._highest: Optional[rabbitpy.Message] = None
+        self._unflushed = 0
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="ack-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def track(self, message: rabbitpy.Message) -> BatchedMessage:
+        """
+        Records a delivered message, returning a wrapper to pass on in its place.
+        This must be called in delivery order, i.e. from the consume loop.
+        """
+        with self._lock:
+            self._pending[message.delivery_tag] = message
+        return BatchedMessage(message, self)
+
+    def complete(self, message: rabbitpy.Message) -> None:
+        """
+        Marks a message as complete, flushing if the batch is full
+        """
+        with self._lock:
+            self._completed.add(message.delivery_tag)
+            while self._pending and next(iter(self._pending)) in self._completed:
+                tag, self._highest = self._pending.popitem(last=False)
+                self._completed.remove(tag)
+                self._unflushed += 1
+            if self._unflushed >= self.max_batch:
+                self._flush()
+
+    def flush(self) -> None:
+        """
+        Acks every completed message, cumulatively up to the first
+        message still in progress, then individually for the rest
+        """
+        with self._lock:
+            self._flush()
+            for tag in self._completed:
+                self._pending.pop(tag).ack()
+            self._completed.clear()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread, flushing any remaining acks
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _flush(self) -> None:
+        if not self._unflushed:
+            return
+        logger.debug("Acking %s messages", self._unflushed)
+        self._highest.ack(all_previous=True)
+        self._highest = None
+        self._unflushed = 0
+        self.flushes += 1
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # The messages are redelivered if the channel has gone
+                logger.exception("Failed to flush acks")
@@ -5,16 +5,23 @@ This file defines methods to be used to interact with the
 Aquilon API
 """
 import logging
-import subprocess
-from typing import Optional, List
+import re
+import threading
+from typing import Dict, Optional, List
 
 import requests
 from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import RetryError, Timeout
 from requests_kerberos import HTTPKerberosAuth
 from urllib3.util.retry import Retry
 
+from rabbit_consumer.circuit_breaker import get_breaker
+from rabbit_consumer.concurrency_limiter import OVERLOAD_STATUS_CODES, get_limiter
 from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.kerberos_ticket import get_ticket_cache
 from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.metrics import timed
 from rabbit_consumer.openstack_address import OpenstackAddress
 from rabbit_consumer.rabbit_message import RabbitMessage
 from rabbit_consumer.vm_data import VmData
@@ -23,9 +30,19 @@ HOST_CHECK_SUFFIX = "/host/{0}"
 
 UPDATE_INTERFACE_SUFFIX = "/machine/{0}/interface/{1}?boot&default_route"
 
+MAKE_HOSTS_SUFFIX = "/host/command/reconfigure_list"
+
 DELETE_HOST_SUFFIX = "/host/{0}"
 DELETE_MACHINE_SUFFIX = "/machine/{0}"
 
+SEARCH_MACHINES_SUFFIX = "/find/machine?fullinfo"
+
+# Matches the start of each machine in a fullinfo search, and its serial
+_MACHINE_NAME = re.compile(r"^(?:Virtual_machine|Machine): (\S+)", re.MULTILINE)
+_MACHINE_SERIAL = re.compile(r"^\s+Serial: (\S+)", re.MULTILINE)
+
+AQ_CA_CHAIN = "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,13 +59,137 @@ def verify_kerberos_ticket() -> bool:
     """
     logger.debug("Checking for valid Kerberos Ticket")
 
-    if subprocess.call(["klist", "-s"]) == 1:
+    if not get_ticket_cache().is_valid():
         raise RuntimeError("No shared Kerberos ticket found.")
 
     logger.debug("Kerberos ticket success")
     return True
 
 
+class AquilonClient:
+    """
+    Long-lived client for the Aquilon API. This holds a single keep-alive
+    connection pool for the life of the consumer, rather than re-negotiating
+    TLS for every request. The Kerberos auth handler keeps the state of each
+    SPNEGO handshake, so isn't thread-safe, and each thread gets its own.
+    """
+
+    def __init__(self, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.timeout = (config.aq_connect_timeout, config.aq_read_timeout)
+
+        self.session = requests.Session()
+        self.session.verify = AQ_CA_CHAIN
+        retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[503])
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config.aq_pool_size,
+                max_retries=retries,
+            ),
+        )
+        self._local = threading.local()
+
+    @property
+    def auth(self) -> HTTPKerberosAuth:
+        """
+        Returns the Kerberos auth handler for the calling thread
+        """
+        auth = getattr(self._local, "auth", None)
+        if auth is None:
+            auth = self._local.auth = HTTPKerberosAuth()
+        return auth
+
+    def request(
+        self, url: str, method: str, desc: str, params: Optional[dict] = None
+    ) -> str:
+        """
+        Sends a request to the Aquilon API using the pooled session,
+        returning the response text
+        """
+        logger.debug("%s: %s - params: %s", method, url, params)
+
+        if method == "post":
+            rest_method = self.session.post
+        elif method == "put":
+            rest_method = self.session.put
+        elif method == "delete":
+            rest_method = self.session.delete
+        else:
+            rest_method = self.session.get
+        with (
+            get_breaker("aquilon").protect() as guarded,
+            get_limiter("aquilon").limit_call(desc) as call,
+        ):
+            try:
+                response = rest_method(
+                    url, auth=self.auth, params=params, timeout=self.timeout
+                )
+            except (Timeout, RequestsConnectionError, RetryError):
+                # Retried 503s surface as a RetryError
+                call.dropped = guarded.failed = True
+                raise
+            call.dropped = guarded.failed = (
+                response.status_code in OVERLOAD_STATUS_CODES
+            )
+
+        if response.status_code == 401:
+            # Our ticket may have been revoked or expired early
+            get_ticket_cache().invalidate()
+
+        if response.status_code == 400:
+            # This might be an expected error, so don't log it
+            logger.debug("AQ Error Response: %s", response.text)
+            raise AquilonError(response.text)
+
+        if response.status_code != 200:
+            logger.error("%s: Failed: %s", desc, response.text)
+            logger.error(url)
+            raise ConnectionError(
+                f"Failed {desc}: {response.status_code} -" "{response.text}"
+            )
+
+        logger.debug("Success: %s ", desc)
+        logger.debug("AQ Response: %s", response.text)
+        return response.text
+
+    def close(self) -> None:
+        """
+        Closes the underlying connection pool
+        """
+        self.session.close()
+
+
+_client: Optional[AquilonClient] = None  # pylint: disable=invalid-name
+_client_lock = threading.Lock()
+
+
+def get_aq_client() -> AquilonClient:
+    """
+    Returns the shared Aquilon client, creating it on first use
+    """
+    # pylint: disable=global-statement
+    global _client
+    with _client_lock:
+        if _client is None:
+            logger.debug("Creating pooled Aquilon client")
+            _client = AquilonClient()
+        return _client
+
+
+def close_aq_client() -> None:
+    """
+    Closes the shared Aquilon client, a new one will be created on next use
+    """
+    # pylint: disable=global-statement
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
 def setup_requests(
     url: str, method: str, desc: str, params: Optional[dict] = None
 ) -> str:
@@ -56,38 +197,10 @@ def setup_requests(
     Passes a request to the Aquilon API
     """
     verify_kerberos_ticket()
-    logger.debug("%s: %s - params: %s", method, url, params)
-
-    session = requests.Session()
-    session.verify = "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
-    retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[503])
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-    if method == "post":
-        response = session.post(url, auth=HTTPKerberosAuth(), params=params)
-    elif method == "put":
-        response = session.put(url, auth=HTTPKerberosAuth(), params=params)
-    elif method == "delete":
-        response = session.delete(url, auth=HTTPKerberosAuth(), params=params)
-    else:
-        response = session.get(url, auth=HTTPKerberosAuth(), params=params)
-
-    if response.status_code == 400:
-        # This might be an expected error, so don't log it
-        logger.debug("AQ Error Response: %s", response.text)
-        raise AquilonError(response.text)
-
-    if response.status_code != 200:
-        logger.error("%s: Failed: %s", desc, response.text)
-        logger.error(url)
-        raise ConnectionError(
-            f"Failed {desc}: {response.status_code} -" "{response.text}"
-        )
-
-    logger.debug("Success: %s ", desc)
-    logger.debug("AQ Response: %s", response.text)
-    return response.text
+    return get_aq_client().request(url, method, desc, params)
 
 
+@timed("aquilon")
 def aq_make(addresses: List[OpenstackAddress]) -> None:
     """
     Runs AQ make against a list of addresses passed to refresh
@@ -110,6 +223,22 @@ def aq_make(addresses: List[OpenstackAddress]) -> None:
         logger.debug("make request failed, continuing")
 
 
+@timed("aquilon")
+def aq_make_hosts(hostnames: List[str]) -> None:
+    """
+    Compiles the templates for a list of hosts in a single reconfigure.
+    Aquilon rejects the whole list if any host fails, raising an AquilonError.
+    """
+    logger.debug("Attempting to make templates for %s hosts", len(hostnames))
+    if not hostnames:
+        return
+
+    url = ConsumerConfig().aq_url + MAKE_HOSTS_SUFFIX
+    params = {"list": "\n".join(hostnames)}
+    setup_requests(url, "post", "Make Templates", params=params)
+
+
+@timed("aquilon")
 def aq_manage(addresses: List[OpenstackAddress], image_meta: AqMetadata) -> None:
     """
     Manages the list of Aquilon addresses passed to it back to the production domain
@@ -131,6 +260,7 @@ def aq_manage(addresses: List[OpenstackAddress], image_meta: AqMetadata) -> None
     setup_requests(url, "post", "Manage Host", params=params)
 
 
+@timed("aquilon")
 def create_machine(message: RabbitMessage, vm_data: VmData) -> str:
     """
     Creates a machine in Aquilon. Returns the machine name
@@ -150,6 +280,7 @@ def create_machine(message: RabbitMessage, vm_data: VmData) -> str:
     return response
 
 
+@timed("aquilon")
 def delete_machine(machine_name: str) -> None:
     """
     Deletes a machine in Aquilon
@@ -161,6 +292,7 @@ def delete_machine(machine_name: str) -> None:
     setup_requests(url, "delete", "Delete Machine")
 
 
+@timed("aquilon")
 def create_host(
     image_meta: AqMetadata, addresses: List[OpenstackAddress], machine_name: str
 ) -> None:
@@ -189,6 +321,7 @@ def create_host(
     setup_requests(url, "put", "Host Create", params=params)
 
 
+@timed("aquilon")
 def delete_host(hostname: str) -> None:
     """
     Deletes a host in Aquilon
@@ -198,6 +331,7 @@ def delete_host(hostname: str) -> None:
     setup_requests(url, "delete", "Host Delete")
 
 
+@timed("aquilon")
 def delete_address(address: str, machine_name: str) -> None:
     """
     Deletes an address in Aquilon
@@ -208,6 +342,7 @@ def delete_address(address: str, machine_name: str) -> None:
     setup_requests(url, "delete", "Address Delete", params=params)
 
 
+@timed("aquilon")
 def delete_interface(machine_name: str) -> None:
     """
     Deletes a host interface in Aquilon
@@ -218,6 +353,7 @@ def delete_interface(machine_name: str) -> None:
     setup_requests(url, "post", "Interface Delete", params=params)
 
 
+@timed("aquilon")
 def add_machine_nics(machine_name: str, addresses: List[OpenstackAddress]) -> None:
     """
     Adds NICs to a given machine in Aquilon based on the VM addresses
@@ -241,6 +377,7 @@ def add_machine_nics(machine_name: str, addresses: List[OpenstackAddress]) -> No
     )
 
 
+@timed("aquilon")
 def set_interface_bootable(machine_name: str, interface_name: str) -> None:
     """
     Sets a given interface on a machine to be bootable
@@ -254,6 +391,7 @@ def set_interface_bootable(machine_name: str, interface_name: str) -> None:
     setup_requests(url, "post", "Update Machine Interface")
 
 
+@timed("aquilon")
 def search_machine_by_serial(vm_data: VmData) -> Optional[str]:
     """
     Searches for a machine in Aquilon based on a serial number
@@ -268,6 +406,33 @@ def search_machine_by_serial(vm_data: VmData) -> Optional[str]:
     return None
 
 
+@timed("aquilon")
+def search_machines_by_model(model: str) -> Dict[str, str]:
+    """
+    Lists every machine of the given model in a single search,
+    returning the machine names keyed by serial
+    """
+    logger.debug("Searching for all machines with model %s", model)
+    url = ConsumerConfig().aq_url + SEARCH_MACHINES_SUFFIX
+    params = {"model": model}
+    response = setup_requests(url, "get", "Search Machines", params=params)
+
+    machines = {}
+    starts = list(_MACHINE_NAME.finditer(response))
+    for i, start in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(response)
+        serial = _MACHINE_SERIAL.search(response, start.end(), end)
+        if serial:
+            machines[serial.group(1)] = start.group(1)
+        else:
+            logger.warning("No serial found for machine %s", start.group(1))
+
+    if response.strip() and not starts:
+        raise ValueError("Could not parse the machine search from Aquilon")
+    return machines
+
+
+@timed("aquilon")
 def search_host_by_machine(machine_name: str) -> Optional[str]:
     """
     Searches for a host in Aquilon based on a machine name
@@ -282,6 +447,7 @@ def search_host_by_machine(machine_name: str) -> Optional[str]:
     return None
 
 
+@timed("aquilon")
 def get_machine_details(machine_name: str) -> str:
     """
     Gets a machine's details as a string
@@ -291,6 +457,7 @@ def get_machine_details(machine_name: str) -> str:
     return setup_requests(url, "get", "Get machine details").strip()
 
 
+@timed("aquilon")
 def check_host_exists(hostname: str) -> bool:
     """
     Checks if a host exists in Aquilon
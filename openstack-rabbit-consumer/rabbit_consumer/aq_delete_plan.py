@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file plans the clean-up of a machine in Aquilon, fetching the
+machine and host state in as few round trips as possible, then
+running only the deletes which are required
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from rabbit_consumer import aq_api
+from rabbit_consumer.dns_resolver import get_dns_resolver
+from rabbit_consumer.state_store import VmRecord
+from rabbit_consumer.tracing import run_in_context
+from rabbit_consumer.vm_data import VmData
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AqMachineState:
+    """
+    The records held in Aquilon for a VM and the hostname from its message
+    """
+
+    hostname: Optional[str] = None
+    hostname_exists: bool = False
+    machine_name: Optional[str] = None
+    machine_host: Optional[str] = None
+    machine_details: str = ""
+
+
+@dataclass
+class AqDeletePlan:
+    """
+    The deletes required to remove a VM from Aquilon, in the order
+    Aquilon requires them to be run
+    """
+
+    hosts: List[str] = field(default_factory=list)
+    address: Optional[str] = None
+    delete_interface: bool = False
+    machine_name: Optional[str] = None
+
+
+def fetch_machine_state(vm_data: VmData, hostname: Optional[str]) -> AqMachineState:
+    """
+    Looks up the Aquilon records for a VM. Lookups which don't depend on
+    each other are run concurrently, so this takes at most two round trips.
+    """
+    state = AqMachineState(hostname=hostname)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="aq-lookup") as executor:
+        machine_future = executor.submit(
+            run_in_context(aq_api.search_machine_by_serial, vm_data)
+        )
+        if hostname:
+            state.hostname_exists = aq_api.check_host_exists(hostname)
+        state.machine_name = machine_future.result()
+
+        if not state.machine_name:
+            return state
+
+        details_future = executor.submit(
+            run_in_context(aq_api.get_machine_details, state.machine_name)
+        )
+        state.machine_host = aq_api.search_host_by_machine(state.machine_name)
+        state.machine_details = details_future.result()
+    return state
+
+
+def plan_deletion(state: AqMachineState) -> AqDeletePlan:
+    """
+    Builds the deletes required for the given state. Aquilon enforces
+    that hosts are removed first, then any leftover addresses and
+    interfaces, and finally the machine itself.
+    """
+    plan = AqDeletePlan()
+    if state.hostname_exists:
+        plan.hosts.append(state.hostname)
+
+    if not state.machine_name:
+        return plan
+
+    if state.machine_host and state.machine_host != state.hostname:
+        # The machine points to a different host to the one in the message.
+        # This was returned by a host search, so we know it exists.
+        plan.hosts.append(state.machine_host)
+    elif state.machine_host and not state.hostname_exists:
+        # The machine still points at a host which no longer exists,
+        # so its address and interface have to be removed by hand
+        ipv4_address = get_dns_resolver().get_address(state.machine_host)
+        if ipv4_address in state.machine_details:
+            plan.address = ipv4_address
+        plan.delete_interface = "eth0" in state.machine_details
+
+    plan.machine_name = state.machine_name
+    return plan
+
+
+def plan_from_record(record: VmRecord) -> Optional[AqDeletePlan]:
+    """
+    Builds the deletes for a VM from the records stored when it was
+    created, so only the machine's host has to be looked up in Aquilon.
+    Returns None if the recorded host is no longer on the recorded machine,
+    e.g. another VM has since taken over the hostname, as deleting it
+    would remove a live host.
+    """
+    host = aq_api.search_host_by_machine(record.machine_name)
+    if host != record.hostname:
+        return None
+    return AqDeletePlan(hosts=[record.hostname], machine_name=record.machine_name)
+
+
+def run_deletion_plan(plan: AqDeletePlan) -> None:
+    """
+    Runs the deletes in the given plan
+    """
+    for hostname in plan.hosts:
+        logger.info("Deleting host %s", hostname)
+        aq_api.delete_host(hostname)
+
+    if plan.address:
+        aq_api.delete_address(plan.address, plan.machine_name)
+    if plan.delete_interface:
+        aq_api.delete_interface(plan.machine_name)
+
+    if plan.machine_name:
+        logger.info("Deleting machine %s", plan.machine_name)
+        aq_api.delete_machine(plan.machine_name)
@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines a circuit breaker for each upstream API. Once an
+upstream has failed repeatedly, calls to it fail at once without
+touching the network, until a single probe call shows it has recovered.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import CIRCUIT_REJECTIONS, CIRCUIT_STATE
+
+logger = logging.getLogger(__name__)
+
+UPSTREAMS = ("aquilon", "keystone", "nova", "glance")
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream whose circuit is open
+    """
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is unavailable, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+@dataclass
+class BreakerCall:
+    """
+    A call allowed through a breaker. Set failed if the
+    upstream was unreachable or overloaded.
+    """
+
+    failed: bool = False
+
+
+# pylint: disable=too-many-instance-attributes
+class CircuitBreaker:
+    """
+    Opens once failure_threshold calls in a row have failed, rejecting
+    calls for reset_timeout seconds. The next call is then let through as
+    a probe, with other calls still rejected until it finishes. The
+    circuit closes if the probe succeeds, otherwise it opens again.
+    A threshold of 0 disables the breaker.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, upstream: str, failure_threshold: int, reset_timeout: float):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._gauge = CIRCUIT_STATE.labels(upstream)
+        self._gauge.set(self._state)
+
+    @property
+    def state(self) -> int:
+        """
+        Returns the current state, one of CLOSED, OPEN or HALF_OPEN
+        """
+        return self._state
+
+    def allow(self) -> None:
+        """
+        Raises a CircuitOpenError if calls to the upstream are being rejected
+        """
+        if self.failure_threshold <= 0:
+            return
+
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+
+            retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+            if self._state == self.OPEN and retry_after <= 0:
+                logger.info("Probing whether %s has recovered", self.upstream)
+                self._set_state(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+
+        CIRCUIT_REJECTIONS.labels(self.upstream).inc()
+        raise CircuitOpenError(self.upstream, max(retry_after, 0))
+
+    def record(self, failed: Optional[bool]) -> None:
+        """
+        Records the outcome of an allowed call. None means the call never
+        reached the upstream, so a probe is let through again.
+        """
+        if self.failure_threshold <= 0:
+            return
+
+        with self._lock:
+            probe = self._probing
+            self._probing = False
+            if failed is None:
+                return
+
+            if not failed:
+                self._failures = 0
+                if self._state != self.CLOSED:
+                    logger.info("%s has recovered, closing circuit", self.upstream)
+                    self._set_state(self.CLOSED)
+                return
+
+            self._failures += 1
+            if probe or self._failures >= self.failure_threshold:
+                if self._state == self.CLOSED:
+                    logger.error(
+                        "%s failed %s times in a row, opening circuit for %ss",
+                        self.upstream,
+                        self._failures,
+                        self.reset_timeout,
+                    )
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    @contextmanager
+    def protect(self) -> Iterator[BreakerCall]:
+        """
+        Allows a call through the breaker, recording its outcome once the
+        block exits. Errors which aren't marked as failed, e.g. a 400,
+        show the upstream is up, so count as a success.
+        """
+        self.allow()
+        call = BreakerCall()
+        try:
+            yield call
+        finally:
+            self.record(call.failed)
+
+    def _set_state(self, state: int) -> None:
+        self._state = state
+        self._gauge.set(state)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    """
+    Returns the shared breaker for an upstream, creating it on first use
+    """
+    if upstream not in UPSTREAMS:
+        raise ValueError(f"Unknown upstream: {upstream}")
+
+    with _breakers_lock:
+        if upstream not in _breakers:
+            config = ConsumerConfig()
+            _breakers[upstream] = CircuitBreaker(
+                upstream, config.circuit_failure_threshold, config.circuit_reset_timeout
+            )
+        return _breakers[upstream]
+
+
+def reset_breakers() -> None:
+    """
+    Drops the shared breakers, so new ones are created on next use
+    """
+    with _breakers_lock:
+        _breakers.clear()
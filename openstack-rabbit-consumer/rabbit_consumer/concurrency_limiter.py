@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines an adaptive limit on the concurrent calls made to an
+API. The limit grows while calls are quick, and is cut when the API is
+overloaded, so the workers get the most throughput from Aquilon and
+Openstack without the concurrency being tuned by hand.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import CONCURRENCY_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Response codes which mean the API is overloaded, rather than the request is bad
+OVERLOAD_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+# How much of each latency sample is added to the running average
+_AVERAGE_WEIGHT = 0.1
+# How much of each sample above the baseline is added to it, so the
+# baseline follows a lasting rise in latency instead of cutting forever
+_BASELINE_DRIFT = 0.01
+# Latencies below this, in seconds, are too short to tell a rise from jitter
+_LATENCY_FLOOR = 0.05
+
+
+@dataclass
+class LimitedCall:
+    """
+    A call holding a slot under the limit, and whether at least half the
+    limit was in use. Set dropped if the response shows the API is overloaded.
+    """
+
+    name: str
+    started: float
+    saturated: bool
+    dropped: bool = False
+
+
+@dataclass
+class _CallLatency:
+    """
+    The lowest latency seen for a call, and its running average
+    """
+
+    baseline: float
+    average: float
+
+
+# pylint: disable=too-many-instance-attributes
+class AdaptiveLimiter:
+    """
+    Limits concurrent calls using additive increase, multiplicative decrease.
+
+    Each call made while at least half the limit was in use, which finished
+    with its average latency within tolerance times its baseline, adds
+    1/limit to the limit, so it grows steadily whilst the limit is in use. A dropped call
+    halves the limit, whilst rising latency cuts it by a tenth. Calls
+    started before the last cut don't cut it again, so one burst of
+    errors from a full round of calls only cuts the limit once.
+
+    Latency is tracked separately for each named call, as an Aquilon make
+    naturally takes far longer than a search.
+    """
+
+    DROP_BACKOFF = 0.5
+    LATENCY_BACKOFF = 0.9
+
+    def __init__(
+        self, api: str, min_limit: int, max_limit: int, latency_tolerance: float = 2.0
+    ):
+        if not 0 < min_limit <= max_limit:
+            raise ValueError("Limits must be positive, with min_limit <= max_limit")
+
+        self.api = api
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+
+        self._limit = float(max(min_limit, max_limit // 2))
+        self._in_flight = 0
+        self._last_cut = 0.0
+        self._latencies: Dict[str, _CallLatency] = {}
+        self._cond = threading.Condition()
+        self._gauge = CONCURRENCY_LIMIT.labels(api)
+        self._gauge.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        """
+        Returns the current number of concurrent calls allowed
+        """
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Returns the number of calls currently holding a slot
+        """
+        return self._in_flight
+
+    def acquire(self, name: str = "") -> LimitedCall:
+        """
+        Waits for a free slot under the limit, returning the call holding it
+        """
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            saturated = self._in_flight * 2 >= self.limit
+        return LimitedCall(name=name, started=time.monotonic(), saturated=saturated)
+
+    def release(self, call: LimitedCall) -> None:
+        """
+        Frees the slot held by a call, adjusting the limit from its outcome
+        """
+        latency = time.monotonic() - call.started
+        with self._cond:
+            self._in_flight -= 1
+            if call.dropped:
+                self._cut(call, self.DROP_BACKOFF, "dropped")
+            elif self._latency_rising(call.name, latency):
+                self._cut(call, self.LATENCY_BACKOFF, "latency rising")
+            elif call.saturated and self._limit < self.max_limit:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+                self._gauge.set(self.limit)
+            self._cond.notify_all()
+
+    @contextmanager
+    def limit_call(self, name: str = "") -> Iterator[LimitedCall]:
+        """
+        Holds a slot for the duration of the block
+        """
+        call = self.acquire(name)
+        try:
+            yield call
+        finally:
+            self.release(call)
+
+    def _latency_rising(self, name: str, latency: float) -> bool:
+        stats = self._latencies.get(name)
+        if stats is None:
+            self._latencies[name] = _CallLatency(baseline=latency, average=latency)
+            return False
+
+        stats.average += (latency - stats.average) * _AVERAGE_WEIGHT
+        if latency < stats.baseline:
+            stats.baseline = latency
+        else:
+            stats.baseline += (latency - stats.baseline) * _BASELINE_DRIFT
+        baseline = max(stats.baseline, _LATENCY_FLOOR)
+        return stats.average > baseline * self.latency_tolerance
+
+    def _cut(self, call: LimitedCall, backoff: float, reason: str) -> None:
+        if call.started < self._last_cut:
+            return
+        self._last_cut = time.monotonic()
+        self._limit = max(float(self.min_limit), self._limit * backoff)
+        self._gauge.set(self.limit)
+        logger.info("Cut %s concurrency to %s (%s)", self.api, self.limit, reason)
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _max_limit(api: str, config: ConsumerConfig) -> int:
+    """
+    Returns the most concurrent calls allowed to an API
+    """
+    if api == "aquilon":
+        return config.aq_pool_size
+    if api == "openstack":
+        return config.openstack_concurrency_max
+    raise ValueError(f"Unknown API: {api}")
+
+
+def get_limiter(api: str) -> AdaptiveLimiter:
+    """
+    Returns the shared limiter for an API, creating it on first use.
+    If adaptive concurrency is disabled, the limit is fixed at its max.
+    """
+    with _limiters_lock:
+        if api not in _limiters:
+            config = ConsumerConfig()
+            max_limit = _max_limit(api, config)
+            min_limit = 1 if config.adaptive_concurrency else max_limit
+            _limiters[api] = AdaptiveLimiter(
+                api, min_limit, max_limit, config.concurrency_latency_tolerance
+            )
+        return _limiters[api]
+
+
+def reset_limiters() -> None:
+    """
+    Drops the shared limiters, so new ones are created on next use
+    """
+    with _limiters_lock:
+        _limiters.clear()
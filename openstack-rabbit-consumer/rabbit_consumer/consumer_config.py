@@ -10,6 +10,33 @@ from dataclasses import dataclass, field
 from functools import partial
 
 
+def _get_env_int(key: str, default: int) -> int:
+    """
+    Gets an integer from an environment variable, falling back to the default
+    if the variable is not set
+    """
+    return int(os.getenv(key, str(default)))
+
+
+def _get_env_float(key: str, default: float) -> float:
+    """
+    Gets a float from an environment variable, falling back to the default
+    if the variable is not set
+    """
+    return float(os.getenv(key, str(default)))
+
+
+def _get_env_bool(key: str, default: bool) -> bool:
+    """
+    Gets a boolean from an environment variable, falling back to the default
+    if the variable is not set
+    """
+    value = os.getenv(key)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 @dataclass
 class _AqFields:
     """
@@ -20,8 +47,68 @@ class _AqFields:
     aq_prefix: str = field(default_factory=partial(os.getenv, "AQ_PREFIX"))
     aq_url: str = field(default_factory=partial(os.getenv, "AQ_URL"))
 
+    # Connection pool and timeouts (in seconds) for the long-lived Aquilon client.
+    # The pool size also caps the adaptive limit on concurrent calls.
+    aq_pool_size: int = field(default_factory=partial(_get_env_int, "AQ_POOL_SIZE", 10))
+    aq_connect_timeout: float = field(
+        default_factory=partial(_get_env_float, "AQ_CONNECT_TIMEOUT", 10)
+    )
+    aq_read_timeout: float = field(
+        default_factory=partial(_get_env_float, "AQ_READ_TIMEOUT", 300)
+    )
+    # Hosts to compile together in one batched reconfigure, rather than
+    # making each new host as it is created. 0 disables this.
+    aq_make_batch: int = field(
+        default_factory=partial(_get_env_int, "AQ_MAKE_BATCH", 0)
+    )
+    # Seconds between compiling a partial batch of hosts
+    aq_make_interval: float = field(
+        default_factory=partial(_get_env_float, "AQ_MAKE_INTERVAL", 10)
+    )
+
+
+@dataclass
+class _DnsFields:
+    """
+    Dataclass for config elements controlling DNS lookups.
+    These are pulled from environment variables.
+    """
+
+    # Seconds to wait for a single lookup before giving up
+    dns_timeout: float = field(
+        default_factory=partial(_get_env_float, "DNS_TIMEOUT", 5)
+    )
+    # Seconds to cache successful and failed lookups for
+    dns_cache_ttl: float = field(
+        default_factory=partial(_get_env_float, "DNS_CACHE_TTL", 300)
+    )
+    dns_negative_ttl: float = field(
+        default_factory=partial(_get_env_float, "DNS_NEGATIVE_TTL", 30)
+    )
+    # Number of lookups which can run at once
+    dns_workers: int = field(default_factory=partial(_get_env_int, "DNS_WORKERS", 8))
+
+
+@dataclass
+class _KerberosFields:
+    """
+    Dataclass for all Kerberos config elements. These are pulled from
+    environment variables.
+    """
+
+    krb5_ccname: str = field(default_factory=partial(os.getenv, "KRB5CCNAME"))
+    # Seconds before expiry at which the ticket is re-checked
+    krb5_expiry_margin: float = field(
+        default_factory=partial(_get_env_float, "KRB5_EXPIRY_MARGIN", 300)
+    )
+    # Seconds between klist checks when gssapi isn't installed
+    krb5_recheck_interval: float = field(
+        default_factory=partial(_get_env_float, "KRB5_RECHECK_INTERVAL", 60)
+    )
+
 
 @dataclass
+# pylint: disable=too-many-instance-attributes
 class _OpenstackFields:
     """
     Dataclass for all Openstack config elements. These are pulled from
@@ -40,6 +127,25 @@ class _OpenstackFields:
     openstack_password: str = field(
         default_factory=partial(os.getenv, "OPENSTACK_PASSWORD")
     )
+    # Seconds before the Keystone token expires at which it is refreshed
+    openstack_token_margin: float = field(
+        default_factory=partial(_get_env_float, "OPENSTACK_TOKEN_REFRESH_MARGIN", 300)
+    )
+    # Re-checks the VM still exists before writing metadata back to it
+    openstack_recheck_exists: bool = field(
+        default_factory=partial(_get_env_bool, "OPENSTACK_RECHECK_EXISTS", True)
+    )
+    # Max concurrent Openstack calls, which the adaptive limit stays under
+    openstack_concurrency_max: int = field(
+        default_factory=partial(_get_env_int, "OPENSTACK_CONCURRENCY_MAX", 10)
+    )
+    # Max number of images, and seconds each is kept for, in the image cache
+    image_cache_size: int = field(
+        default_factory=partial(_get_env_int, "IMAGE_CACHE_SIZE", 128)
+    )
+    image_cache_ttl: float = field(
+        default_factory=partial(_get_env_float, "IMAGE_CACHE_TTL", 600)
+    )
 
 
 @dataclass
@@ -60,7 +166,129 @@ class _RabbitFields:
 
 
 @dataclass
-class ConsumerConfig(_AqFields, _OpenstackFields, _RabbitFields):
+class _ConsumerFields:
+    """
+    Dataclass for config elements controlling how messages are consumed.
+    These are pulled from environment variables.
+    """
+
+    # "all" handles messages from the main queue. To scale out, a single
+    # "router" spreads them by instance ID across the queues of replicas
+    # running as "shard", so each VM's messages are still handled in order.
+    consumer_role: str = field(
+        default_factory=partial(os.getenv, "CONSUMER_ROLE", "all")
+    )
+    # Name of this shard replica, ending in its ordinal, e.g. a StatefulSet
+    # pod name. This must be set when running as "shard".
+    consumer_shard_name: str = field(
+        default_factory=partial(os.getenv, "CONSUMER_SHARD_NAME", "")
+    )
+    # Logical shards VMs are spread across, each with its own queue. This
+    # must stay fixed, as changing it moves VMs between shards.
+    consumer_shard_count: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_SHARD_COUNT", 16)
+    )
+    # Replicas running as "shard", which the logical shards are split between
+    consumer_shard_replicas: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_SHARD_REPLICAS", 1)
+    )
+    # Number of worker threads, 1 handles messages serially on the main thread
+    consumer_workers: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_WORKERS", 1)
+    )
+    # Worker threads for a separate delete lane, so deletes aren't queued
+    # behind slow creates. 0 handles deletes on the same workers as creates.
+    consumer_delete_workers: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_DELETE_WORKERS", 0)
+    )
+    # Max unacked messages the broker will send us, 0 uses the default
+    consumer_prefetch: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_PREFETCH", 0)
+    )
+    # Completed messages to ack together in one cumulative ack, 1 acks
+    # each message as it completes. This is capped at half the prefetch.
+    consumer_ack_batch: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_ACK_BATCH", 1)
+    )
+    # Seconds between flushing a partial batch of acks
+    consumer_ack_interval: float = field(
+        default_factory=partial(_get_env_float, "CONSUMER_ACK_INTERVAL", 1)
+    )
+    # Seconds to hold create messages for, so a VM deleted within this
+    # window is never registered in Aquilon. 0 disables this.
+    consumer_debounce_window: float = field(
+        default_factory=partial(_get_env_float, "CONSUMER_DEBOUNCE_WINDOW", 0)
+    )
+    # Attempts before a failing message is moved to the dead-letter queue,
+    # 0 disables retries so a failing message stops the consumer
+    retry_max_attempts: int = field(
+        default_factory=partial(_get_env_int, "CONSUMER_RETRY_MAX_ATTEMPTS", 5)
+    )
+    # Seconds before the first retry, doubling on each attempt up to the max
+    retry_base_delay: float = field(
+        default_factory=partial(_get_env_float, "CONSUMER_RETRY_DELAY", 30)
+    )
+    retry_max_delay: float = field(
+        default_factory=partial(_get_env_float, "CONSUMER_RETRY_MAX_DELAY", 900)
+    )
+    # Messages taking at least this many seconds have their trace logged,
+    # 0 disables this
+    slow_message_threshold: float = field(
+        default_factory=partial(_get_env_float, "SLOW_MESSAGE_THRESHOLD", 30)
+    )
+    # Adapts the concurrent calls to Aquilon and Openstack to their latency
+    # and errors. If disabled, the limits are fixed at the pool sizes.
+    adaptive_concurrency: bool = field(
+        default_factory=partial(_get_env_bool, "ADAPTIVE_CONCURRENCY", True)
+    )
+    # The concurrency is cut once the average latency of a call rises
+    # above this multiple of its lowest latency
+    concurrency_latency_tolerance: float = field(
+        default_factory=partial(_get_env_float, "CONCURRENCY_LATENCY_TOLERANCE", 2)
+    )
+    # Consecutive failed calls to an upstream which open its circuit,
+    # rejecting calls for the reset timeout in seconds. 0 disables this.
+    circuit_failure_threshold: int = field(
+        default_factory=partial(_get_env_int, "CIRCUIT_FAILURE_THRESHOLD", 5)
+    )
+    circuit_reset_timeout: float = field(
+        default_factory=partial(_get_env_float, "CIRCUIT_RESET_TIMEOUT", 30)
+    )
+    # Port to serve Prometheus metrics on, 0 disables the endpoint
+    metrics_port: int = field(default_factory=partial(_get_env_int, "METRICS_PORT", 0))
+    # Port to serve /healthz and /readyz on, 0 disables the endpoint
+    health_port: int = field(default_factory=partial(_get_env_int, "HEALTH_PORT", 0))
+    # Seconds between checking the depth of the consumed queue
+    health_interval: float = field(
+        default_factory=partial(_get_env_float, "HEALTH_INTERVAL", 15)
+    )
+    # Take the image, metadata and addresses of new VMs from the create
+    # message rather than fetching the server from Nova
+    consumer_payload_first: bool = field(
+        default_factory=partial(_get_env_bool, "CONSUMER_PAYLOAD_FIRST", False)
+    )
+    # SQLite file recording the Aquilon records created for each VM and
+    # the IDs of processed messages. Empty disables the store.
+    state_db_path: str = field(default_factory=partial(os.getenv, "STATE_DB_PATH", ""))
+    # Seconds to remember processed message IDs for
+    state_dedupe_ttl: float = field(
+        default_factory=partial(_get_env_float, "STATE_DEDUPE_TTL", 86400)
+    )
+    # JSON library used to decode messages: auto, json or orjson
+    json_backend: str = field(
+        default_factory=partial(os.getenv, "CONSUMER_JSON_BACKEND", "auto")
+    )
+
+
+@dataclass
+class ConsumerConfig(
+    _AqFields,
+    _DnsFields,
+    _KerberosFields,
+    _OpenstackFields,
+    _RabbitFields,
+    _ConsumerFields,
+):
     """
     Mix-in class for all known config elements
     """
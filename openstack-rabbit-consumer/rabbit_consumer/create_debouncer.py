@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file holds create messages back for a short window, so a VM which is
+deleted shortly after being created is never registered in Aquilon
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict
+
+import rabbitpy
+
+from rabbit_consumer.rabbit_message import RabbitMessage, SUPPORTED_MESSAGE_TYPES
+
+logger = logging.getLogger(__name__)
+
+Dispatcher = Callable[[rabbitpy.Message, RabbitMessage], None]
+
+
+@dataclass
+class _PendingCreate:
+    """
+    A create message waiting for its window to pass
+    """
+
+    deadline: float
+    message: rabbitpy.Message
+    decoded: RabbitMessage
+
+
+class CreateDebouncer:
+    """
+    Sits in front of the handlers, holding each create message for the
+    debounce window before dispatching it. If a delete for the same VM
+    arrives within the window, the create is acked without being handled,
+    leaving only the (cheap) delete clean-up to run. All other messages are
+    dispatched straight away.
+    """
+
+    def __init__(self, window: float, dispatch: Dispatcher):
+        self.window = window
+        self.cancelled = 0
+
+        self._dispatch = dispatch
+        self._pending: Dict[str, _PendingCreate] = {}
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="create-debouncer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Holds create messages for the window, and cancels a pending create
+        when a delete for the same VM arrives
+        """
+        instance_id = decoded.payload.instance_id
+        with self._condition:
+            pending = self._pending.pop(instance_id, None)
+
+            if decoded.event_type == SUPPORTED_MESSAGE_TYPES["create"]:
+                if pending:
+                    # Keep the order of a repeated create by releasing the first
+                    self._dispatch(pending.message, pending.decoded)
+                self._pending[instance_id] = _PendingCreate(
+                    deadline=time.monotonic() + self.window,
+                    message=message,
+                    decoded=decoded,
+                )
+                self._condition.notify()
+                return
+
+            if pending and decoded.event_type == SUPPORTED_MESSAGE_TYPES["delete"]:
+                logger.info(
+                    "VM %s was deleted within %ss of being created, skipping create",
+                    instance_id,
+                    self.window,
+                )
+                self.cancelled += 1
+                pending.message.ack()
+            elif pending:
+                self._dispatch(pending.message, pending.decoded)
+
+            self._dispatch(message, decoded)
+
+    def stop(self) -> None:
+        """
+        Stops releasing creates. Any still pending are left unacked,
+        so they will be redelivered to the next consumer.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """
+        Dispatches each pending create once its window has passed
+        """
+        with self._condition:
+            while not self._stopped:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+
+                # Creates all share a window, so the first is due soonest
+                instance_id, pending = next(iter(self._pending.items()))
+                delay = pending.deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                del self._pending[instance_id]
+                try:
+                    self._dispatch(pending.message, pending.decoded)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    # The message stays unacked, and the error will be
+                    # raised from the worker pool on the consume loop
+                    logger.exception("Failed to dispatch create for %s", instance_id)
@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines a DNS resolver which bounds each lookup with a timeout
+and caches the results, so a slow resolver can't block the consumer
+"""
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import CACHE_LOOKUPS, DNS_LOOKUP_DURATION, DNS_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+_FORWARD = "forward"
+_REVERSE = "reverse"
+
+
+@dataclass
+class _CachedLookup:
+    """
+    The result of a lookup, either a name or the error raised for it
+    """
+
+    expires_at: float
+    value: Optional[str] = None
+    error: Optional[OSError] = None
+
+    def unwrap(self) -> str:
+        """
+        Returns the looked up name, or raises a copy of the original error
+        """
+        if self.error:
+            raise type(self.error)(*self.error.args)
+        return self.value
+
+
+# pylint: disable=too-many-instance-attributes
+class DnsResolver:
+    """
+    Resolves hostnames and addresses on a pool of threads, so each lookup
+    can be abandoned after a timeout and many lookups can run at once.
+    Results are cached, with failed lookups cached for a shorter time.
+    """
+
+    def __init__(self, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.timeout = config.dns_timeout
+        self.ttl = config.dns_cache_ttl
+        self.negative_ttl = config.dns_negative_ttl
+
+        self._hits = CACHE_LOOKUPS.labels("dns", "hit")
+        self._misses = CACHE_LOOKUPS.labels("dns", "miss")
+
+        self._cache: Dict[Tuple[str, str], _CachedLookup] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.dns_workers, thread_name_prefix="dns-resolver"
+        )
+
+    def get_hostname(self, ip_addr: str) -> str:
+        """
+        Returns the hostname for an IP address
+        """
+        return self.get_hostnames([ip_addr])[0]
+
+    def get_hostnames(self, ip_addrs: List[str]) -> List[str]:
+        """
+        Returns the hostnames for the given IP addresses in the same order,
+        looking up any which aren't cached concurrently
+        """
+        return self._resolve_many(_REVERSE, ip_addrs)
+
+    def get_address(self, hostname: str) -> str:
+        """
+        Returns the IPv4 address for a hostname
+        """
+        return self._resolve_many(_FORWARD, [hostname])[0]
+
+    def close(self) -> None:
+        """
+        Stops the lookup threads, without waiting on any stuck lookups
+        """
+        self._executor.shutdown(wait=False)
+
+    def _resolve_many(self, kind: str, names: List[str]) -> List[str]:
+        """
+        Resolves each name, raising the error for the first which fails
+        """
+        results: Dict[str, _CachedLookup] = {}
+        futures = {}
+        for name in dict.fromkeys(names):
+            cached = self._get_cached((kind, name))
+            if cached:
+                results[name] = cached
+            else:
+                futures[name] = self._executor.submit(self._lookup, kind, name)
+
+        deadline = time.monotonic() + self.timeout
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(
+                    timeout=max(0.0, deadline - time.monotonic())
+                )
+            except FutureTimeoutError as err:
+                DNS_TIMEOUTS.inc()
+                logger.warning("DNS lookup for %s timed out", name)
+                raise socket.timeout(f"DNS lookup for {name} timed out") from err
+
+        return [results[name].unwrap() for name in names]
+
+    def _get_cached(self, key: Tuple[str, str]) -> Optional[_CachedLookup]:
+        """
+        Returns an unexpired cached lookup, counting hits and misses
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry.expires_at <= time.monotonic():
+                del self._cache[key]
+                entry = None
+
+            (self._hits if entry else self._misses).inc()
+            return entry
+
+    def _lookup(self, kind: str, name: str) -> _CachedLookup:
+        """
+        Runs a single blocking lookup on a resolver thread and caches it
+        """
+        start = time.monotonic()
+        try:
+            if kind == _REVERSE:
+                value = socket.gethostbyaddr(name)[0]
+            else:
+                value = socket.gethostbyname(name)
+            entry = _CachedLookup(expires_at=time.monotonic() + self.ttl, value=value)
+        except (socket.herror, socket.gaierror) as err:
+            entry = _CachedLookup(
+                expires_at=time.monotonic() + self.negative_ttl, error=err
+            )
+        finally:
+            elapsed = time.monotonic() - start
+            DNS_LOOKUP_DURATION.labels(kind).observe(elapsed)
+            logger.debug("DNS %s lookup for %s took %.3fs", kind, name, elapsed)
+
+        with self._lock:
+            self._cache[(kind, name)] = entry
+        return entry
+
+
+_dns_resolver: Optional[DnsResolver] = None  # pylint: disable=invalid-name
+_dns_resolver_lock = threading.Lock()
+
+
+def get_dns_resolver() -> DnsResolver:
+    """
+    Returns the shared DNS resolver, creating it on first use
+    """
+    # pylint: disable=global-statement
+    global _dns_resolver
+    with _dns_resolver_lock:
+        if _dns_resolver is None:
+            _dns_resolver = DnsResolver()
+        return _dns_resolver
+
+
+def reset_dns_resolver() -> None:
+    """
+    Closes the shared DNS resolver, a new one is created on next use
+    """
+    # pylint: disable=global-statement
+    global _dns_resolver
+    with _dns_resolver_lock:
+        if _dns_resolver is not None:
+            _dns_resolver.close()
+        _dns_resolver = None
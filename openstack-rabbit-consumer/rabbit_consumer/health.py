@@ -0,0 +1,323 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file serves the consumer's health and lag over HTTP, so replicas
+can be scaled on how far behind they are (e.g. by KEDA) rather than CPU.
+The queue depth is checked on a separate connection in the background,
+so a request never waits on the broker or the consume loop.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+import rabbitpy
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import OLDEST_UNACKED_AGE, QUEUE_CONSUMERS, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Seconds of acks the processing rate is averaged over
+_RATE_WINDOW = 60.0
+
+
+def _message_key(message: rabbitpy.Message) -> Tuple[int, int]:
+    """
+    Returns a key for a message, as delivery tags are only unique per channel
+    """
+    return message.channel.id, message.delivery_tag
+
+
+class TrackedMessage:
+    """
+    Wraps a rabbitpy message so acks are recorded by the monitor,
+    whilst everything else is passed to the message
+    """
+
+    def __init__(self, message: rabbitpy.Message, monitor: "HealthMonitor"):
+        self._message = message
+        self._monitor = monitor
+
+    def ack(self, all_previous: bool = False) -> None:
+        """
+        Acks the message, then stops tracking it, and every earlier
+        message too if the ack is cumulative
+        """
+        self._message.ack(all_previous=all_previous)
+        self._monitor.acked(_message_key(self._message), all_previous)
+
+    def __getattr__(self, name: str):
+        return getattr(self._message, name)
+
+
+# pylint: disable=too-many-instance-attributes
+class HealthMonitor:
+    """
+    Tracks unacked messages and the ack rate from the consume loop, and
+    checks the depth of the queues being consumed with a passive declare
+    every interval seconds. The same check counts the consumers of those
+    queues, and of any queues consumed elsewhere, e.g. a router's shards.
+    The consumer is ready once it is consuming, the last check reached
+    the broker within the last two intervals, and every watched queue had
+    a consumer.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.queue_names: Tuple[str, ...] = ()
+        self.consumed_elsewhere: Tuple[str, ...] = ()
+
+        self._lock = threading.Lock()
+        # Delivery time of each unacked message, in delivery order
+        self._unacked: "OrderedDict[Tuple[int, int], float]" = OrderedDict()
+        self._acks: Deque[float] = deque()
+        self._queue_depth: Optional[int] = None
+        self._unconsumed: List[str] = []
+        self._checked_at: Optional[float] = None
+        self._login_str = ""
+        self._connection: Optional[rabbitpy.Connection] = None
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def track(self, message: rabbitpy.Message) -> TrackedMessage:
+        """
+        Records a delivered message, returning a wrapper to pass on in its place.
+        This must be called in delivery order, i.e. from the consume loop.
+        """
+        with self._lock:
+            self._unacked[_message_key(message)] = time.monotonic()
+        return TrackedMessage(message, self)
+
+    def acked(self, key: Tuple[int, int], all_previous: bool = False) -> None:
+        """
+        Stops tracking an acked message, keyed by its channel and delivery
+        tag, counting it towards the rate. A cumulative ack only covers
+        earlier messages on the same channel.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if all_previous:
+                channel, delivery_tag = key
+                for tracked in list(self._unacked):
+                    if tracked[0] == channel and tracked[1] <= delivery_tag:
+                        del self._unacked[tracked]
+                        self._acks.append(now)
+            elif self._unacked.pop(key, None) is not None:
+                self._acks.append(now)
+
+    def watch(
+        self,
+        login_str: str,
+        *queue_names: str,
+        consumed_elsewhere: Sequence[str] = (),
+    ) -> None:
+        """
+        Starts checking the depth of the queues being consumed in the
+        background, and that the queues consumed elsewhere have consumers
+        """
+        self._login_str = login_str
+        self.queue_names = queue_names
+        self.consumed_elsewhere = tuple(consumed_elsewhere)
+        self._thread = threading.Thread(
+            target=self._run, name="health-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def check(self) -> None:
+        """
+        Fetches the number of messages waiting in the queues, and their
+        consumers, reconnecting to the broker if needed. The depth is kept
+        if the broker can't be reached, but the consumer is no longer ready.
+        """
+        try:
+            if self._connection is None:
+                self._connection = rabbitpy.Connection(self._login_str)
+            depth = 0
+            unconsumed = []
+            with self._connection.channel() as channel:
+                for queue_name in self.queue_names + self.consumed_elsewhere:
+                    messages, consumers = rabbitpy.Queue(
+                        channel, queue_name
+                    ).declare(passive=True)
+                    QUEUE_CONSUMERS.labels(queue_name).set(consumers)
+                    if not consumers:
+                        unconsumed.append(queue_name)
+                    if queue_name in self.queue_names:
+                        depth += messages
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to check the depth of %s", self.queue_names)
+            self._close()
+            return
+
+        if unconsumed:
+            # e.g. a shard whose replica is down, so its VMs aren't handled
+            logger.warning("No consumers on %s", ", ".join(unconsumed))
+        QUEUE_DEPTH.set(depth)
+        with self._lock:
+            self._queue_depth = depth
+            self._unconsumed = unconsumed
+            self._checked_at = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        """
+        Returns True if the consumer is consuming, can reach the broker,
+        and every watched queue has a consumer
+        """
+        checked_at = self._checked_at
+        return (
+            self._thread is not None
+            and not self._stopped.is_set()
+            and checked_at is not None
+            and time.monotonic() - checked_at <= self.interval * 2
+            and not self._unconsumed
+        )
+
+    def snapshot(self) -> Dict:
+        """
+        Returns the current health and lag. The lag estimates the seconds
+        to drain the queue at the current rate, and is None while idle.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._acks and self._acks[0] < now - _RATE_WINDOW:
+                self._acks.popleft()
+            rate = len(self._acks) / _RATE_WINDOW
+            oldest = next(iter(self._unacked.values()), None)
+            unacked = len(self._unacked)
+            depth = self._queue_depth
+            unconsumed = list(self._unconsumed)
+
+        oldest_age = now - oldest if oldest is not None else 0.0
+        OLDEST_UNACKED_AGE.set(oldest_age)
+        lag = None
+        if depth is not None and rate > 0:
+            lag = (depth + unacked) / rate
+        return {
+            "ready": self.ready,
+            "queue": ",".join(self.queue_names),
+            "queue_depth": depth,
+            "unconsumed_queues": unconsumed,
+            "unacked": unacked,
+            "oldest_unacked_seconds": round(oldest_age, 3),
+            "processing_rate": round(rate, 3),
+            "lag_seconds": round(lag, 3) if lag is not None else None,
+        }
+
+    def stop(self) -> None:
+        """
+        Stops checking the queue, so the consumer is no longer ready
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._close()
+
+    def _close(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.debug("Failed to close the health check connection")
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.interval)
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves /healthz, which is always OK while the process is up, and
+    /readyz, which returns the lag as JSON and is 503 until ready
+    """
+
+    monitor: HealthMonitor
+
+    # pylint: disable=invalid-name
+    def do_GET(self) -> None:
+        """
+        Responds with the monitor's snapshot
+        """
+        if self.path == "/healthz":
+            self._respond(200, {"alive": True})
+        elif self.path == "/readyz":
+            snapshot = self.monitor.snapshot()
+            self._respond(200 if snapshot["ready"] else 503, snapshot)
+        else:
+            self._respond(404, {"error": f"Unknown path: {self.path}"})
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def _respond(self, status: int, body: Dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_health_server(monitor: HealthMonitor, port: int) -> ThreadingHTTPServer:
+    """
+    Serves the monitor's health on a background thread
+    """
+    handler = type("BoundHealthRequestHandler", (HealthRequestHandler,), {})
+    handler.monitor = monitor
+    server = ThreadingHTTPServer(("", port), handler)
+    threading.Thread(
+        target=server.serve_forever, name="health-server", daemon=True
+    ).start()
+    logger.info("Serving health on port %s", port)
+    return server
+
+
+_health_monitor: Optional[HealthMonitor] = None  # pylint: disable=invalid-name
+_health_server: Optional[ThreadingHTTPServer] = None  # pylint: disable=invalid-name
+_health_monitor_loaded = False  # pylint: disable=invalid-name
+_health_monitor_lock = threading.Lock()
+
+
+def get_health_monitor() -> Optional[HealthMonitor]:
+    """
+    Returns the shared health monitor, serving it on first use,
+    or None if no health port is configured
+    """
+    # pylint: disable=global-statement
+    global _health_monitor, _health_server, _health_monitor_loaded
+    with _health_monitor_lock:
+        if not _health_monitor_loaded:
+            config = ConsumerConfig()
+            if config.health_port > 0:
+                _health_monitor = HealthMonitor(config.health_interval)
+                _health_server = start_health_server(
+                    _health_monitor, config.health_port
+                )
+            _health_monitor_loaded = True
+        return _health_monitor
+
+
+def stop_health_monitor() -> None:
+    """
+    Stops the shared health monitor and its server.
+    A new one is started on next use.
+    """
+    # pylint: disable=global-statement
+    global _health_monitor, _health_server, _health_monitor_loaded
+    with _health_monitor_lock:
+        monitor, server = _health_monitor, _health_server
+        _health_monitor = None
+        _health_server = None
+        _health_monitor_loaded = False
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    if monitor is not None:
+        monitor.stop()
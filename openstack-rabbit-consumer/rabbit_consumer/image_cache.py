@@ -0,0 +1,146 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines a bounded cache of Openstack images and their parsed
+Aquilon metadata, as image metadata rarely changes between messages
+"""
+import dataclasses
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from openstack.compute.v2.image import Image
+
+from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import CACHE_EVICTIONS, CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedImage:
+    """
+    An image held in the cache, alongside the Aquilon metadata
+    parsed from it once it has been requested
+    """
+
+    image: Image
+    expires_at: float
+    aq_metadata: Optional[AqMetadata] = None
+
+
+class ImageCache:
+    """
+    LRU cache of images keyed by their UUID, where each entry expires
+    after a fixed TTL so changes to an image are eventually picked up
+    """
+
+    def __init__(self, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.max_size = config.image_cache_size
+        self.ttl = config.image_cache_ttl
+
+        self._hits = CACHE_LOOKUPS.labels("image", "hit")
+        self._misses = CACHE_LOOKUPS.labels("image", "miss")
+        self._evictions = CACHE_EVICTIONS.labels("image")
+        self._entries: OrderedDict[str, CachedImage] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uuid: str) -> Optional[Image]:
+        """
+        Returns the cached image for the given UUID, or None if it
+        is not cached or has expired
+        """
+        with self._lock:
+            entry = self._get_entry(uuid)
+            if not entry:
+                self._misses.inc()
+                logger.debug("Image cache miss for %s", uuid)
+                return None
+
+            self._hits.inc()
+            logger.debug("Image cache hit for %s", uuid)
+            return entry.image
+
+    def put(self, uuid: str, image: Image) -> None:
+        """
+        Adds an image to the cache, evicting the least recently used
+        entry if the cache is full
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[uuid] = CachedImage(
+                image=image, expires_at=time.monotonic() + self.ttl
+            )
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions.inc()
+
+    def get_aq_metadata(self, image: Image) -> AqMetadata:
+        """
+        Returns the Aquilon metadata for an image. The metadata is parsed
+        once per cached image, and a copy is returned so callers can
+        override fields without changing the cached template.
+        """
+        with self._lock:
+            entry = self._get_entry(image.id)
+            if entry and not entry.aq_metadata:
+                entry.aq_metadata = AqMetadata.from_dict(image.metadata)
+            template = entry.aq_metadata if entry else None
+
+        if not template:
+            return AqMetadata.from_dict(image.metadata)
+        return dataclasses.replace(template)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _get_entry(self, uuid: str) -> Optional[CachedImage]:
+        """
+        Returns an unexpired entry, marking it as recently used.
+        The lock must be held by the caller.
+        """
+        entry = self._entries.get(uuid)
+        if not entry:
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            del self._entries[uuid]
+            return None
+
+        self._entries.move_to_end(uuid)
+        return entry
+
+
+_image_cache: Optional[ImageCache] = None  # pylint: disable=invalid-name
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> ImageCache:
+    """
+    Returns the shared image cache, creating it on first use
+    """
+    # pylint: disable=global-statement
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+        return _image_cache
+
+
+def reset_image_cache() -> None:
+    """
+    Drops the shared image cache, a new one is created on next use
+    """
+    # pylint: disable=global-statement
+    global _image_cache
+    with _image_cache_lock:
+        _image_cache = None
@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file selects the JSON library used to decode messages, preferring
+orjson when it is installed as it is considerably faster than json
+"""
+import functools
+import json
+import logging
+from typing import Any, Callable, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # pylint: disable=invalid-name
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+
+logger = logging.getLogger(__name__)
+
+JsonLoads = Callable[[Union[str, bytes]], Any]
+
+
+@functools.lru_cache(maxsize=None)
+def get_json_loads(backend: str = "auto") -> JsonLoads:
+    """
+    Returns the loads function for the given backend. This can be "json",
+    "orjson", or "auto" to use orjson if it is available.
+    """
+    backend = backend.strip().lower() if backend else "auto"
+    if backend == "auto":
+        backend = "orjson" if orjson else "json"
+
+    if backend == "json":
+        loads = json.loads
+    elif backend == "orjson":
+        if not orjson:
+            raise ValueError("The orjson backend was requested but is not installed")
+        loads = orjson.loads
+    else:
+        raise ValueError(f"Unknown JSON backend: {backend}")
+
+    logger.debug("Using %s to decode messages", backend)
+    return loads
+
+
+@functools.lru_cache(maxsize=1)
+def get_configured_json_loads() -> JsonLoads:
+    """
+    Returns the loads function for the backend set in the config. This is
+    resolved once, as building the config for every message is not free.
+    """
+    return get_json_loads(ConsumerConfig().json_backend)
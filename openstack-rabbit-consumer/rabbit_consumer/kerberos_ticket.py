@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file watches the Kerberos credential cache shared by the sidecar,
+so the ticket expiry is read once and cached rather than forking
+klist before every Aquilon request
+"""
+import logging
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+try:
+    import gssapi
+except ImportError:  # pragma: no cover
+    gssapi = None  # pylint: disable=invalid-name
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+
+logger = logging.getLogger(__name__)
+
+
+def read_ticket_expiry() -> Optional[float]:
+    """
+    Reads the expiry of the default Kerberos credentials through GSSAPI,
+    returning the expiry as a unix timestamp, or 0 if there are no valid
+    credentials. If gssapi is not installed, None is returned.
+    """
+    if gssapi is None:
+        return None
+    try:
+        lifetime = gssapi.Credentials(usage="initiate").lifetime
+    except gssapi.exceptions.GSSError as err:
+        logger.debug("No valid Kerberos credentials: %s", err)
+        return 0.0
+    return time.time() + lifetime
+
+
+def get_ccache_path(ccname: Optional[str]) -> Optional[str]:
+    """
+    Returns the path to a file credential cache from the KRB5CCNAME value,
+    or None if the cache is not a file
+    """
+    if not ccname:
+        return f"/tmp/krb5cc_{os.getuid()}"
+    if ccname.startswith("FILE:"):
+        return ccname[len("FILE:") :]
+    if ":" in ccname:
+        # Other cache types, e.g. KEYRING: or KCM:
+        return None
+    return ccname
+
+
+class KerberosTicketCache:
+    """
+    Caches whether the shared Kerberos ticket is valid. The expiry is read
+    through GSSAPI and trusted until it is within the margin of expiring,
+    the cache file changes, or an auth failure invalidates it. If gssapi
+    is not installed, this falls back to klist, re-checking at most once
+    per recheck interval.
+    """
+
+    def __init__(self, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.ccache_path = get_ccache_path(config.krb5_ccname)
+        self.expiry_margin = config.krb5_expiry_margin
+        self.recheck_interval = config.krb5_recheck_interval
+
+        self.forks_saved = 0
+        self._valid_until = 0.0
+        self._ccache_stat = None
+        self._lock = threading.Lock()
+
+    def is_valid(self) -> bool:
+        """
+        Returns True if there is a valid Kerberos ticket, using the cached
+        result where possible
+        """
+        with self._lock:
+            now = time.time()
+            if now < self._valid_until and self._ccache_stat == self._stat_ccache():
+                self.forks_saved += 1
+                return True
+            return self._refresh(now)
+
+    def invalidate(self) -> None:
+        """
+        Forces the ticket to be re-checked on next use, e.g. after an
+        auth failure from Aquilon
+        """
+        with self._lock:
+            logger.info("Invalidating cached Kerberos ticket state")
+            self._valid_until = 0.0
+
+    def _stat_ccache(self) -> Optional[Tuple[int, int]]:
+        """
+        Returns a cheap fingerprint of the credential cache file, so a ticket
+        renewed by the sidecar is picked up without waiting for the margin
+        """
+        if not self.ccache_path:
+            return None
+        try:
+            stat = os.stat(self.ccache_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _refresh(self, now: float) -> bool:
+        """
+        Re-reads the ticket state and updates the cached validity
+        """
+        self._ccache_stat = self._stat_ccache()
+        expiry = read_ticket_expiry()
+
+        if expiry is not None:
+            self._valid_until = expiry - self.expiry_margin
+            if now >= expiry:
+                logger.warning("No valid Kerberos ticket found")
+                return False
+            logger.info(
+                "Kerberos ticket expires at %s, %s klist calls avoided so far",
+                datetime.fromtimestamp(expiry).isoformat(),
+                self.forks_saved,
+            )
+            return True
+
+        # We can't read the credentials directly, so ask klist
+        logger.debug("Checking for valid Kerberos ticket with klist")
+        valid = subprocess.call(["klist", "-s"]) != 1
+        self._valid_until = now + self.recheck_interval if valid else 0.0
+        logger.info(
+            "Kerberos ticket checked with klist, %s klist calls avoided so far",
+            self.forks_saved,
+        )
+        return valid
+
+
+_ticket_cache: Optional[KerberosTicketCache] = None  # pylint: disable=invalid-name
+_ticket_cache_lock = threading.Lock()
+
+
+def get_ticket_cache() -> KerberosTicketCache:
+    """
+    Returns the shared Kerberos ticket cache, creating it on first use
+    """
+    # pylint: disable=global-statement
+    global _ticket_cache
+    with _ticket_cache_lock:
+        if _ticket_cache is None:
+            _ticket_cache = KerberosTicketCache()
+        return _ticket_cache
+
+
+def reset_ticket_cache() -> None:
+    """
+    Drops the shared Kerberos ticket cache, a new one is created on next use
+    """
+    # pylint: disable=global-statement
+    global _ticket_cache
+    with _ticket_cache_lock:
+        _ticket_cache = None
@@ -0,0 +1,224 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defers compiling the templates of new hosts, so hosts created
+close together are compiled in one batched reconfigure rather than
+one make each. This cuts the compile time during mass boots. Each host
+added gets a future, so its create can wait for the make before acking.
+"""
+import functools
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from rabbit_consumer import aq_api
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.metrics import AQ_MAKES
+
+logger = logging.getLogger(__name__)
+
+
+def _copy(target: Future, source: Future) -> None:
+    """
+    Resolves the target future with the outcome of the source
+    """
+    if source.exception():
+        target.set_exception(source.exception())
+    else:
+        target.set_result(None)
+
+
+# pylint: disable=too-many-instance-attributes
+class MakeBatcher:
+    """
+    Collects hostnames to compile, flushing them on a background thread
+    every interval seconds, or as soon as max_batch hosts are waiting.
+
+    Aquilon rejects a whole batch if any host in it fails, so a rejected
+    batch is retried one host at a time to find the failures, which are
+    set on the futures of those hosts.
+    """
+
+    def __init__(self, max_batch: int, interval: float):
+        self.max_batch = max_batch
+        self.interval = interval
+        self.flushes = 0
+
+        self._lock = threading.Lock()
+        # Only one batch is compiled at a time, without blocking new hosts
+        self._flush_lock = threading.Lock()
+        # Dicts keep the order hosts were added in, and drop duplicates
+        self._pending: Dict[str, Future] = {}
+
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="make-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, hostname: str) -> Future:
+        """
+        Queues a host to be compiled with the next batch, returning a future
+        which is resolved once it has been made, or set to the error if
+        Aquilon rejects it. A host queued twice shares the same future.
+        """
+        if not hostname or not hostname.strip():
+            raise ValueError("Hostname cannot be empty")
+
+        with self._lock:
+            future = self._pending.setdefault(hostname, Future())
+            full = len(self._pending) >= self.max_batch
+        logger.debug("Queued %s to be made", hostname)
+        if full:
+            self._wake.set()
+        return future
+
+    def discard(self, hostname: str) -> None:
+        """
+        Removes a host from the queue, e.g. as it has since been deleted,
+        failing its future as it won't be made
+        """
+        with self._lock:
+            future = self._pending.pop(hostname, None)
+        if future:
+            future.set_exception(
+                AquilonError(f"{hostname} was deleted before it was made")
+            )
+
+    def flush(self) -> List[str]:
+        """
+        Compiles every queued host, returning the hostnames which failed
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return []
+
+            failed = []
+            try:
+                aq_api.aq_make_hosts(list(pending))
+            except AquilonError:
+                logger.warning(
+                    "Batched make of %s hosts failed, making each separately",
+                    len(pending),
+                )
+                failed = self._make_each(pending)
+            except Exception:
+                # Aquilon is unreachable, so leave them for the next batch
+                self._requeue(pending)
+                raise
+            else:
+                for future in pending.values():
+                    future.set_result(None)
+
+            self.flushes += 1
+            self._count(len(pending), failed)
+            return failed
+
+    def stop(self) -> None:
+        """
+        Stops the background thread, compiling any remaining hosts. If they
+        can't be made, their futures are failed so nothing waits on them.
+        """
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            for hostname, future in pending.items():
+                future.set_exception(
+                    RuntimeError(f"Stopped before {hostname} could be made")
+                )
+
+    def _make_each(self, pending: Dict[str, Future]) -> List[str]:
+        """
+        Makes each host separately, returning those Aquilon rejected. If
+        Aquilon becomes unreachable part way, the hosts not yet tried are
+        left for the next batch.
+        """
+        failed: List[str] = []
+        items = list(pending.items())
+        for tried, (hostname, future) in enumerate(items):
+            try:
+                aq_api.aq_make_hosts([hostname])
+            except AquilonError as err:
+                logger.error("Failed to make %s: %s", hostname, err)
+                failed.append(hostname)
+                future.set_exception(err)
+            except Exception:
+                self._requeue(dict(items[tried:]))
+                self._count(tried, failed)
+                raise
+            else:
+                future.set_result(None)
+        return failed
+
+    def _requeue(self, pending: Dict[str, Future]) -> None:
+        with self._lock:
+            for hostname, future in pending.items():
+                queued = self._pending.setdefault(hostname, future)
+                if queued is not future:
+                    # Queued again since, so resolve both with the one make
+                    queued.add_done_callback(functools.partial(_copy, future))
+
+    @staticmethod
+    def _count(made: int, failed: List[str]) -> None:
+        AQ_MAKES.labels("succeeded").inc(made - len(failed))
+        AQ_MAKES.labels("failed").inc(len(failed))
+        logger.info("Made %s hosts, %s failed", made - len(failed), len(failed))
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to make queued hosts")
+
+
+_make_batcher: Optional[MakeBatcher] = None  # pylint: disable=invalid-name
+_make_batcher_loaded = False  # pylint: disable=invalid-name
+_make_batcher_lock = threading.Lock()
+
+
+def get_make_batcher() -> Optional[MakeBatcher]:
+    """
+    Returns the shared make batcher, starting it on first use,
+    or None if hosts are made as they are created
+    """
+    # pylint: disable=global-statement
+    global _make_batcher, _make_batcher_loaded
+    with _make_batcher_lock:
+        if not _make_batcher_loaded:
+            config = ConsumerConfig()
+            if config.aq_make_batch > 0:
+                _make_batcher = MakeBatcher(
+                    config.aq_make_batch, config.aq_make_interval
+                )
+            _make_batcher_loaded = True
+        return _make_batcher
+
+
+def stop_make_batcher() -> None:
+    """
+    Stops the shared make batcher, making any queued hosts first.
+    A new one is started on next use.
+    """
+    # pylint: disable=global-statement
+    global _make_batcher, _make_batcher_loaded
+    with _make_batcher_lock:
+        batcher = _make_batcher
+        _make_batcher = None
+        _make_batcher_loaded = False
+    if batcher is not None:
+        batcher.stop()
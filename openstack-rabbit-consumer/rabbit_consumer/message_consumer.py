@@ -4,38 +4,73 @@
 This file manages how rabbit messages stating AQ VM creation and deletion 
 should be handled and processed between the consumer and Aquilon
 """
-import json
+import functools
 import logging
 import os
-import socket
-from typing import Optional, List
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from typing import Optional, List, Tuple
 
 import rabbitpy
 
 from rabbit_consumer import aq_api
+from rabbit_consumer import aq_delete_plan
 from rabbit_consumer import openstack_api
-from rabbit_consumer.aq_api import verify_kerberos_ticket
+from rabbit_consumer.ack_batcher import AckBatcher
+from rabbit_consumer.aq_api import AquilonError, verify_kerberos_ticket
 from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.create_debouncer import CreateDebouncer
 from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.health import (
+    HealthMonitor,
+    get_health_monitor,
+    stop_health_monitor,
+)
+from rabbit_consumer.image_cache import get_image_cache
+from rabbit_consumer.make_batcher import get_make_batcher, stop_make_batcher
 from rabbit_consumer.openstack_address import OpenstackAddress
-from rabbit_consumer.rabbit_message import RabbitMessage, MessageEventType
+from rabbit_consumer.json_backend import get_configured_json_loads
+from rabbit_consumer.metrics import (
+    IN_FLIGHT,
+    MESSAGE_DURATION,
+    MESSAGES,
+    MESSAGES_RECEIVED,
+)
+from rabbit_consumer.rabbit_message import (
+    RabbitMessage,
+    SUPPORTED_MESSAGE_TYPES,
+    sniff_event_type,
+)
+from rabbit_consumer.retry_queue import RetryHandler
+from rabbit_consumer.server_snapshot import ServerSnapshot
+from rabbit_consumer.sharding import (
+    CONSUMER_ROLES,
+    ShardRouter,
+    declare_shard_queue,
+    get_assigned_shards,
+    get_shard_queue,
+)
+from rabbit_consumer.shutdown import (
+    QueueStopper,
+    request_stop,
+    stop_when_requested,
+)
+from rabbit_consumer.state_store import VmRecord, get_state_store
+from rabbit_consumer.tracing import MessageTrace, span, traced
 from rabbit_consumer.vm_data import VmData
+from rabbit_consumer.worker_pool import LanedWorkerPool, ShardedWorkerPool
 
 logger = logging.getLogger(__name__)
-SUPPORTED_MESSAGE_TYPES = {
-    "create": "compute.instance.create.end",
-    "delete": "compute.instance.delete.start",
-}
 
 
-def is_aq_managed_image(vm_data: VmData) -> bool:
+def is_aq_managed_image(snapshot: ServerSnapshot) -> bool:
     """
     Check to see if the metadata in the message contains entries that suggest it
     is for an Aquilon VM.
     """
-    image = openstack_api.get_image(vm_data)
+    image = openstack_api.get_image(snapshot)
     if not image:
-        logger.info("No image found for %s", vm_data.virtual_machine_id)
+        logger.info("No image found for %s", snapshot.vm_data.virtual_machine_id)
         return False
 
     if "AQ_OS" not in image.metadata:
@@ -44,15 +79,16 @@ def is_aq_managed_image(vm_data: VmData) -> bool:
     return True
 
 
-def get_aq_build_metadata(vm_data: VmData) -> AqMetadata:
+@traced("fetch_metadata")
+def get_aq_build_metadata(snapshot: ServerSnapshot) -> AqMetadata:
     """
     Gets the Aq Metadata from either the image or VM (where
     VM metadata takes precedence) to determine the AQ params
     """
-    image = openstack_api.get_image(vm_data)
-    image_meta = AqMetadata.from_dict(image.metadata)
+    image = openstack_api.get_image(snapshot)
+    image_meta = get_image_cache().get_aq_metadata(image)
 
-    vm_metadata = openstack_api.get_server_metadata(vm_data)
+    vm_metadata = openstack_api.get_server_metadata(snapshot)
     image_meta.override_from_vm_meta(vm_metadata)
     return image_meta
 
@@ -60,8 +96,14 @@ def get_aq_build_metadata(vm_data: VmData) -> AqMetadata:
 def consume(message: RabbitMessage) -> None:
     """
     Consumes a message from the rabbit queue and calls the appropriate
-    handler based on the event type.
+    handler based on the event type. Messages which have already been
+    handled, e.g. redelivered after a restart, are skipped.
     """
+    store = get_state_store()
+    if store and message.message_id and store.is_processed(message.message_id):
+        logger.info("Skipping already processed message %s", message.message_id)
+        return
+
     if message.event_type == SUPPORTED_MESSAGE_TYPES["create"]:
         handle_create_machine(message)
 
@@ -71,6 +113,39 @@ def consume(message: RabbitMessage) -> None:
     else:
         raise ValueError(f"Unsupported message type: {message.event_type}")
 
+    if store and message.message_id:
+        store.mark_processed(message.message_id)
+
+
+@traced("clean_up")
+def _discard_make(hostnames: List[str]) -> None:
+    """
+    Drops hosts which are about to be deleted from the queue to be made
+    """
+    make_batcher = get_make_batcher()
+    if make_batcher:
+        for hostname in hostnames:
+            make_batcher.discard(hostname)
+
+
+def _delete_from_record(record: VmRecord) -> bool:
+    """
+    Deletes the Aquilon records stored for a VM, returning False
+    if they are out of date so must be looked up instead
+    """
+    plan = aq_delete_plan.plan_from_record(record)
+    if plan:
+        _discard_make(plan.hosts)
+        try:
+            aq_delete_plan.run_deletion_plan(plan)
+            return True
+        except AquilonError:
+            pass
+    logger.warning(
+        "Stored records for %s are out of date, looking them up", record.instance_id
+    )
+    return False
+
 
 def delete_machine(
     vm_data: VmData, network_details: Optional[OpenstackAddress] = None
@@ -79,68 +154,72 @@ def delete_machine(
     Deletes a machine in Aquilon and all associated addresses based on
     the serial, MAC and hostname provided. This is the best effort attempt
     to clean-up, since we can have partial or incorrect information.
+    If the records created for the VM are in the state store, and still
+    match Aquilon, these are deleted directly, falling back to looking
+    them up if they are stale.
     """
-    # First handle hostnames
-    if network_details and aq_api.check_host_exists(network_details.hostname):
-        logger.info("Deleting host %s", network_details.hostname)
-        aq_api.delete_host(network_details.hostname)
-
-    machine_name = aq_api.search_machine_by_serial(vm_data)
-    if not machine_name:
-        logger.info("No existing record found for %s", vm_data.virtual_machine_id)
+    store = get_state_store()
+    record = store.get_vm(vm_data.virtual_machine_id) if store else None
+    if record and _delete_from_record(record):
+        store.record_deleted(vm_data.virtual_machine_id)
         return
 
-    # We have to do this manually because AQ has neither a:
-    # - Just delete the machine please
-    # - Delete this if it exists
-    # So alas we have to do everything by hand, whilst adhering to random rules
-    # of deletion orders which it enforces...
-
-    hostname = aq_api.search_host_by_machine(machine_name)
-    machine_details = aq_api.get_machine_details(machine_name)
-
-    # We have to clean-up all the interfaces and addresses first
-    # we could have a machine which points to a different hostname
-    if hostname:
-        if aq_api.check_host_exists(hostname):
-            # This is a different hostname to the one we have in the message
-            # so, we need to delete it
-            logger.info("Host exists for %s. Deleting old", hostname)
-            aq_api.delete_host(hostname)
-        else:
-            # Delete the interfaces
-            ipv4_address = socket.gethostbyname(hostname)
-            if ipv4_address in machine_details:
-                aq_api.delete_address(ipv4_address, machine_name)
-
-            if "eth0" in machine_details:
-                aq_api.delete_interface(machine_name)
-
-    logger.info("Machine exists for %s. Deleting old", vm_data.virtual_machine_id)
+    hostname = network_details.hostname if network_details else None
+    state = aq_delete_plan.fetch_machine_state(vm_data, hostname)
+    plan = aq_delete_plan.plan_deletion(state)
+    _discard_make(plan.hosts)
+    if not plan.machine_name:
+        logger.info("No existing record found for %s", vm_data.virtual_machine_id)
 
-    # Then delete the machine
-    aq_api.delete_machine(machine_name)
+    aq_delete_plan.run_deletion_plan(plan)
+    if store:
+        store.record_deleted(vm_data.virtual_machine_id)
 
 
-def check_machine_valid(rabbit_message: RabbitMessage) -> bool:
+@traced("validate")
+def check_machine_valid(
+    rabbit_message: RabbitMessage, snapshot: ServerSnapshot
+) -> bool:
     """
     Checks to see if the machine is valid for creating in Aquilon.
     """
-    vm_data = VmData.from_message(rabbit_message)
-    if not openstack_api.check_machine_exists(vm_data):
+    if not snapshot.exists:
         # User has likely deleted the machine since we got here
         logger.warning(
-            "Machine %s does not exist, skipping creation", vm_data.virtual_machine_id
+            "Machine %s does not exist, skipping creation",
+            snapshot.vm_data.virtual_machine_id,
         )
         return False
 
-    if not is_aq_managed_image(vm_data):
+    if not is_aq_managed_image(snapshot):
         logger.debug("Ignoring non AQ Image: %s", rabbit_message)
         return False
 
     return True
 
 
+def get_create_snapshot(
+    rabbit_message: RabbitMessage, vm_data: VmData
+) -> ServerSnapshot:
+    """
+    Gets the server for a create message. In payload-first mode this is
+    built from the message itself, falling back to Nova if the message is
+    missing details. The server may then have been deleted since the message
+    was sent. A retried message may have waited long enough for the delete
+    to be handled first, so its existence is checked again before anything
+    is created in Aquilon.
+    """
+    if ConsumerConfig().consumer_payload_first:
+        snapshot = ServerSnapshot.from_payload(vm_data, rabbit_message.payload)
+        if snapshot:
+            return snapshot
+        logger.info(
+            "Message for %s is missing details, fetching from Openstack",
+            vm_data.virtual_machine_id,
+        )
+    return openstack_api.get_server_snapshot(vm_data)
+
+
 def handle_create_machine(rabbit_message: RabbitMessage) -> None:
     """
     Handles the creation of a machine in Aquilon. This includes
@@ -149,13 +228,13 @@ def handle_create_machine(rabbit_message: RabbitMessage) -> None:
     logger.info("=== Received Aquilon VM create message ===")
     _print_debug_logging(rabbit_message)
 
-    if not check_machine_valid(rabbit_message):
-        return
-
     vm_data = VmData.from_message(rabbit_message)
+    snapshot = get_create_snapshot(rabbit_message, vm_data)
+    if not check_machine_valid(rabbit_message, snapshot):
+        return
 
-    image_meta = get_aq_build_metadata(vm_data)
-    network_details = openstack_api.get_server_networks(vm_data)
+    image_meta = get_aq_build_metadata(snapshot)
+    network_details = openstack_api.get_server_networks(snapshot)
 
     if not network_details or not network_details[0].hostname:
         vm_name = rabbit_message.payload.vm_name
@@ -165,6 +244,15 @@ def handle_create_machine(rabbit_message: RabbitMessage) -> None:
     logger.info("Clearing any existing records from Aquilon")
     delete_machine(vm_data, network_details[0])
 
+    if rabbit_message.retried and not openstack_api.check_machine_exists(vm_data):
+        # The delete may have been handled whilst this waited to be retried,
+        # in which case nothing would clean up the records we create
+        logger.warning(
+            "Machine %s was deleted before its create was retried, skipping",
+            vm_data.virtual_machine_id,
+        )
+        return
+
     # Configure networking
     machine_name = aq_api.create_machine(rabbit_message, vm_data)
     aq_api.add_machine_nics(machine_name, network_details)
@@ -172,15 +260,41 @@ def handle_create_machine(rabbit_message: RabbitMessage) -> None:
 
     # Manage host in Aquilon
     aq_api.create_host(image_meta, network_details, machine_name)
-    aq_api.aq_make(network_details)
+    store = get_state_store()
+    if store:
+        store.record_created(
+            vm_data.virtual_machine_id,
+            machine_name,
+            network_details[0].hostname,
+            network_details[0].addr,
+        )
+
+    try:
+        make_host(network_details)
+    except AquilonError:
+        openstack_api.update_metadata(snapshot, {"AQ_STATUS": "FAILED"})
+        raise
 
-    add_aq_details_to_metadata(vm_data, network_details)
+    add_aq_details_to_metadata(snapshot, network_details, machine_name)
 
     logger.info(
         "=== Finished Aquilon creation hook for VM %s ===", vm_data.virtual_machine_id
     )
 
 
+def make_host(network_details: List[OpenstackAddress]) -> None:
+    """
+    Compiles the templates of a new host. With batched makes, the host is
+    made together with others being created, but this still waits for it,
+    so the message is only acked once the host has been made.
+    """
+    make_batcher = get_make_batcher()
+    if make_batcher:
+        make_batcher.add(network_details[0].hostname).result()
+    else:
+        aq_api.aq_make(network_details)
+
+
 def _print_debug_logging(rabbit_message: RabbitMessage) -> None:
     """
     Prints debug logging for the Aquilon message.
@@ -211,13 +325,21 @@ def handle_machine_delete(rabbit_message: RabbitMessage) -> None:
     )
 
 
+@traced("write_metadata")
 def add_aq_details_to_metadata(
-    vm_data: VmData, network_details: List[OpenstackAddress]
+    snapshot: ServerSnapshot,
+    network_details: List[OpenstackAddress],
+    machine_name: str,
 ) -> None:
     """
-    Adds the hostname to the metadata of the VM.
+    Adds the hostname and the Aquilon machine created for it to the
+    metadata of the VM. The VM may have been
+    deleted whilst we were registering it, so its existence is re-checked
+    first unless OPENSTACK_RECHECK_EXISTS is disabled.
     """
-    if not openstack_api.check_machine_exists(vm_data):
+    vm_data = snapshot.vm_data
+    recheck_exists = ConsumerConfig().openstack_recheck_exists
+    if recheck_exists and not openstack_api.check_machine_exists(vm_data):
         # User has likely deleted the machine since we got here
         logger.warning(
             "Machine %s does not exist, skipping metadata update",
@@ -229,30 +351,175 @@ def add_aq_details_to_metadata(
     metadata = {
         "HOSTNAMES": ",".join(hostnames),
         "AQ_STATUS": "SUCCESS",
-        "AQ_MACHINE": aq_api.search_machine_by_serial(vm_data),
+        "AQ_MACHINE": machine_name,
     }
-    openstack_api.update_metadata(vm_data, metadata)
+    openstack_api.update_metadata(snapshot, metadata)
 
 
-def on_message(message: rabbitpy.Message) -> None:
+def decode_message(message: rabbitpy.Message) -> Optional[RabbitMessage]:
     """
-    Deserializes the message and calls the consume function on message.
+    Deserializes the message, returning None if it is an event type we ignore.
+    Most messages are ignored, so the event type is checked before the
+    message is decoded, and supported messages are only decoded once.
     """
     raw_body = message.body
     logger.debug("New message: %s", raw_body)
 
-    body = json.loads(raw_body.decode("utf-8"))["oslo.message"]
-    parsed_event = MessageEventType.from_json(body)
-    if parsed_event.event_type not in SUPPORTED_MESSAGE_TYPES.values():
-        logger.info("Ignoring event_type: %s", parsed_event.event_type)
+    event_type = sniff_event_type(raw_body)
+    if event_type and event_type not in SUPPORTED_MESSAGE_TYPES.values():
+        logger.info("Ignoring event_type: %s", event_type)
+        MESSAGES.labels(event_type, "ignored").inc()
+        return None
+
+    json_loads = get_configured_json_loads()
+    body = json_loads(raw_body)["oslo.message"]
+    if isinstance(body, (str, bytes)):
+        body = json_loads(body)
+
+    if body["event_type"] not in SUPPORTED_MESSAGE_TYPES.values():
+        logger.info("Ignoring event_type: %s", body["event_type"])
+        MESSAGES.labels(body["event_type"], "ignored").inc()
+        return None
+
+    decoded = RabbitMessage.from_dict(body)
+    logger.debug("Decoded message: %s", decoded)
+    return decoded
+
+
+def _handle_message(
+    message: rabbitpy.Message,
+    decoded: RabbitMessage,
+    retry_handler: Optional[RetryHandler] = None,
+    trace: Optional[MessageTrace] = None,
+) -> None:
+    """
+    Calls the consume function on a decoded message, acking it once handled.
+    If a retry handler is set, failed messages are parked for a later retry.
+    The latency is measured from the start of the trace, or from now if
+    there isn't one.
+    """
+    trace = trace if trace else MessageTrace()
+    trace.fields.update(
+        event_type=decoded.event_type, instance_id=decoded.payload.instance_id
+    )
+    succeeded = False
+    try:
+        with trace.activate(), IN_FLIGHT.track_inprogress():
+            if retry_handler:
+                decoded.retried = retry_handler.was_retried(message)
+                succeeded = retry_handler.run(
+                    message, functools.partial(consume, decoded)
+                )
+            else:
+                consume(decoded)
+                message.ack()
+                succeeded = True
+    finally:
+        status = "succeeded" if succeeded else "failed"
+        MESSAGES.labels(decoded.event_type, status).inc()
+        MESSAGE_DURATION.labels(decoded.event_type).observe(trace.elapsed)
+        trace.fields["status"] = status
+        trace.finish()
+
+
+def _decode_or_dead_letter(
+    message: rabbitpy.Message, retry_handler: Optional[RetryHandler]
+) -> Optional[RabbitMessage]:
+    """
+    Decodes the message. A message which can't be decoded will never
+    succeed, so is moved to the dead-letter queue when one is set.
+    """
+    MESSAGES_RECEIVED.inc()
+    try:
+        return decode_message(message)
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        MESSAGES.labels("unknown", "invalid").inc()
+        if not retry_handler:
+            raise
+        retry_handler.dead_letter(message, err)
+        return None
+
+
+def on_message(
+    message: rabbitpy.Message, retry_handler: Optional[RetryHandler] = None
+) -> None:
+    """
+    Deserializes the message and calls the consume function on message.
+    """
+    trace = MessageTrace()
+    with trace.activate(), span("decode"):
+        decoded = _decode_or_dead_letter(message, retry_handler)
+    if not decoded:
         message.ack()
         return
 
-    decoded = RabbitMessage.from_json(body)
-    logger.debug("Decoded message: %s", decoded)
+    _handle_message(message, decoded, retry_handler, trace)
+
+
+def get_lane(decoded: RabbitMessage) -> str:
+    """
+    Returns the worker lane for a message, so deletes have their own lane
+    """
+    if decoded.event_type == SUPPORTED_MESSAGE_TYPES["delete"]:
+        return "delete"
+    return "create"
+
+
+def create_worker_pool(config: ConsumerConfig) -> LanedWorkerPool:
+    """
+    Creates the worker pool. Deletes get their own lane if delete workers
+    are configured, otherwise both lanes share the same workers.
+    """
+    create_pool = ShardedWorkerPool(max(config.consumer_workers, 1), name="create")
+    if config.consumer_delete_workers > 0:
+        delete_pool = ShardedWorkerPool(config.consumer_delete_workers, name="delete")
+    else:
+        delete_pool = create_pool
+    return LanedWorkerPool({"create": create_pool, "delete": delete_pool})
+
+
+def submit_message(
+    pool: LanedWorkerPool,
+    message: rabbitpy.Message,
+    decoded: RabbitMessage,
+    retry_handler: Optional[RetryHandler] = None,
+    trace: Optional[MessageTrace] = None,
+) -> None:
+    """
+    Hands a decoded message to its lane of the worker pool, sharded by
+    instance ID so messages for the same VM are handled in order. Creates
+    released by the debouncer have no trace, so the window isn't counted
+    as latency.
+    """
+    pool.submit(
+        get_lane(decoded),
+        decoded.payload.instance_id,
+        functools.partial(_handle_message, message, decoded, retry_handler, trace),
+    )
+
+
+def dispatch_message(
+    message: rabbitpy.Message,
+    pool: LanedWorkerPool,
+    debouncer: Optional[CreateDebouncer] = None,
+    retry_handler: Optional[RetryHandler] = None,
+) -> None:
+    """
+    Deserializes the message and hands it to the worker pool, passing
+    through the debouncer first if one is set. Messages are only acked
+    by the worker once they have been handled.
+    """
+    trace = MessageTrace()
+    with trace.activate(), span("decode"):
+        decoded = _decode_or_dead_letter(message, retry_handler)
+    if not decoded:
+        message.ack()
+        return
 
-    consume(decoded)
-    message.ack()
+    if debouncer:
+        debouncer.submit(message, decoded)
+    else:
+        submit_message(pool, message, decoded, retry_handler, trace)
 
 
 def generate_login_str(config: ConsumerConfig) -> str:
@@ -282,32 +549,304 @@ def generate_login_str(config: ConsumerConfig) -> str:
     return connect_str
 
 
+def get_prefetch_count(config: ConsumerConfig) -> int:
+    """
+    Returns the prefetch count to set on the channel. When running workers
+    without an explicit prefetch, this is bounded to keep each worker busy
+    without pulling the whole queue into memory. The debouncer holds creates
+    unacked for the whole window, which a bounded prefetch would soon fill,
+    stalling every other message behind them, so this is left unbounded.
+    """
+    if config.consumer_prefetch > 0:
+        return config.consumer_prefetch
+    if config.consumer_debounce_window > 0:
+        return 0
+    workers = config.consumer_workers + config.consumer_delete_workers
+    if workers > 1:
+        return workers * 2
+    return 0
+
+
+def get_ack_batch_size(config: ConsumerConfig, prefetch: int) -> int:
+    """
+    Returns the number of acks to batch together. This is capped at half
+    the prefetch, so the broker keeps sending whilst a batch fills.
+    """
+    if prefetch:
+        return max(min(config.consumer_ack_batch, prefetch // 2), 1)
+    return max(config.consumer_ack_batch, 1)
+
+
+# pylint: disable=too-few-public-methods
+class QueueConsumer:
+    """
+    Consumes a queue on its own channel. Retries, held creates and batched
+    acks are tied to the queue or channel a message came from, so each
+    queue has its own, whilst the workers are shared between queues.
+    """
+
+    def __init__(
+        self,
+        channel: rabbitpy.Channel,
+        queue: rabbitpy.Queue,
+        config: ConsumerConfig,
+        pool: Optional[LanedWorkerPool] = None,
+    ):
+        self.queue = queue
+        self.stopper = QueueStopper(queue)
+        self.pool = pool
+        self.retry_handler = _declare_retry_handler(channel, queue, config)
+
+        self.debouncer: Optional[CreateDebouncer] = None
+        if config.consumer_debounce_window > 0:
+            self.debouncer = CreateDebouncer(
+                config.consumer_debounce_window,
+                functools.partial(
+                    submit_message, pool, retry_handler=self.retry_handler
+                ),
+            )
+
+        self.batcher: Optional[AckBatcher] = None
+        ack_batch = get_ack_batch_size(config, get_prefetch_count(config))
+        if ack_batch > 1:
+            logger.debug("Batching up to %s acks", ack_batch)
+            self.batcher = AckBatcher(ack_batch, config.consumer_ack_interval)
+
+    def run(self, monitor: Optional[HealthMonitor] = None) -> None:
+        """
+        Handles messages from the queue until the consumer is stopped
+        """
+        self.stopper.consume(functools.partial(self._handle, monitor=monitor))
+
+    def _handle(
+        self, message: rabbitpy.Message, monitor: Optional[HealthMonitor]
+    ) -> None:
+        message = _track(message, monitor)
+        if self.batcher:
+            message = self.batcher.track(message)
+        if self.pool:
+            dispatch_message(message, self.pool, self.debouncer, self.retry_handler)
+        else:
+            on_message(message, self.retry_handler)
+
+
+def _stop_consumer(
+    consumers: List[QueueConsumer], pool: Optional[LanedWorkerPool]
+) -> None:
+    """
+    Releases any held creates and waits for the workers to finish, so the
+    final acks can be flushed, then closes the shared clients
+    """
+    for consumer in consumers:
+        if consumer.debouncer:
+            consumer.debouncer.stop()
+    if pool:
+        pool.shutdown()
+    for consumer in consumers:
+        if consumer.batcher:
+            consumer.batcher.stop()
+    stop_make_batcher()
+    stop_health_monitor()
+    aq_api.close_aq_client()
+    openstack_api.close_openstack_connection()
+
+
+def _track(
+    message: rabbitpy.Message, monitor: Optional[HealthMonitor]
+) -> rabbitpy.Message:
+    """
+    Tracks a delivered message for the health monitor, if there is one
+    """
+    return monitor.track(message) if monitor else message
+
+
+def _open_channel(
+    channels: ExitStack, conn: rabbitpy.Connection, config: ConsumerConfig
+) -> rabbitpy.Channel:
+    """
+    Opens a channel, closed with the others on exit, and sets its prefetch
+    """
+    channel = channels.enter_context(conn.channel())
+    prefetch = get_prefetch_count(config)
+    if prefetch:
+        logger.debug("Setting prefetch count to %s", prefetch)
+        channel.prefetch_count(prefetch)
+    return channel
+
+
+def _declare_queue(channel: rabbitpy.Channel) -> rabbitpy.Queue:
+    """
+    Returns the main queue, bound to the Nova exchange
+    """
+    queue_name = os.getenv(key="CONSUMER_QUEUE", default="ral.info")
+    exchanges = ["nova"]
+    # Durable indicates that the queue will survive a broker restart
+    queue = rabbitpy.Queue(
+        channel,
+        name=queue_name,
+        durable=True,
+    )
+    for exchange in exchanges:
+        logger.debug("Binding to exchange: %s", exchange)
+        queue.bind(
+            exchange,
+            routing_key=os.getenv(key="CONSUMER_QUEUE", default="ral.info"),
+        )
+    return queue
+
+
+def _declare_queues(
+    channels: ExitStack, conn: rabbitpy.Connection, config: ConsumerConfig
+) -> List[Tuple[rabbitpy.Channel, rabbitpy.Queue]]:
+    """
+    Returns the queues to consume from, each on its own channel. Shards
+    consume the queue of each logical shard assigned to them, otherwise
+    the main queue is consumed.
+    """
+    if config.consumer_role != "shard":
+        channel = _open_channel(channels, conn, config)
+        return [(channel, _declare_queue(channel))]
+
+    queue_name = os.getenv(key="CONSUMER_QUEUE", default="ral.info")
+    shards = get_assigned_shards(config)
+    logger.info("Consuming from shards %s of %s", shards, queue_name)
+    queues = []
+    for shard in shards:
+        channel = _open_channel(channels, conn, config)
+        queues.append((channel, declare_shard_queue(channel, queue_name, shard)))
+    return queues
+
+
+def _declare_retry_handler(
+    channel: rabbitpy.Channel, queue: rabbitpy.Queue, config: ConsumerConfig
+) -> Optional[RetryHandler]:
+    """
+    Declares the retry queues for the queue, if retries are enabled
+    """
+    if config.retry_max_attempts <= 0:
+        return None
+    retry_handler = RetryHandler(queue.name, config)
+    retry_handler.declare(channel)
+    return retry_handler
+
+
+def _consume(consumers: List[QueueConsumer], monitor: Optional[HealthMonitor]) -> None:
+    """
+    Consumes every queue until a stop is requested or one of them stops.
+    A single queue is consumed on this thread, otherwise each is consumed
+    on its own thread whilst this one waits, so the consumer stops if any
+    of them fails. Once this returns, no more messages are dispatched.
+    """
+    watcher = stop_when_requested([i.stopper for i in consumers])
+    try:
+        if len(consumers) == 1:
+            consumers[0].run(monitor)
+        else:
+            _consume_threaded(consumers, monitor)
+    finally:
+        request_stop()
+        watcher.join()
+
+
+def _consume_threaded(
+    consumers: List[QueueConsumer], monitor: Optional[HealthMonitor]
+) -> None:
+    """
+    Consumes each queue on its own thread until one of them stops
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=len(consumers), thread_name_prefix="consume"
+    )
+    futures = [executor.submit(i.run, monitor) for i in consumers]
+    try:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+    finally:
+        # A thread whose channel broke may be stuck waiting on it until the
+        # channels are closed, so this doesn't wait for them
+        executor.shutdown(wait=False)
+
+
+def _run_router(
+    channel: rabbitpy.Channel,
+    queue: rabbitpy.Queue,
+    config: ConsumerConfig,
+    monitor: Optional[HealthMonitor],
+) -> None:
+    """
+    Routes messages from the queue to the shards until the consumer is stopped
+    """
+    retry_handler = _declare_retry_handler(channel, queue, config)
+    decode = functools.partial(_decode_or_dead_letter, retry_handler=retry_handler)
+    stopper = QueueStopper(queue)
+    watcher = stop_when_requested([stopper])
+    try:
+        ShardRouter(channel, queue.name, decode, config.consumer_shard_count).run(
+            stopper, monitor
+        )
+    finally:
+        request_stop()
+        watcher.join()
+        stop_health_monitor()
+
+
+def _check_role(config: ConsumerConfig) -> None:
+    """
+    Checks the consumer role is known, and that we have valid creds
+    before trying to contact rabbit, if the role talks to Aquilon
+    """
+    if config.consumer_role not in CONSUMER_ROLES:
+        raise ValueError(f"Unknown consumer role: {config.consumer_role}")
+    if config.consumer_role != "router":
+        verify_kerberos_ticket()
+
+
 def initiate_consumer() -> None:
     """
     Initiates the message consumer and starts consuming messages in a loop.
     This includes setting up the rabbit connection and channel.
     """
     logger.debug("Initiating message consumer")
-    # Ensure we have valid creds before trying to contact rabbit
-    verify_kerberos_ticket()
-
-    exchanges = ["nova"]
-
     config = ConsumerConfig()
+    _check_role(config)
     login_str = generate_login_str(config)
-    with rabbitpy.Connection(login_str) as conn:
-        with conn.channel() as channel:
-            logger.debug("Connected to RabbitMQ")
-
-            # Durable indicates that the queue will survive a broker restart
-            queue = rabbitpy.Queue(channel, name=os.getenv(key="CONSUMER_QUEUE", default="ral.info"), durable=True)
-            for exchange in exchanges:
-                logger.debug("Binding to exchange: %s", exchange)
-                queue.bind(exchange, routing_key=os.getenv(key="CONSUMER_QUEUE", default="ral.info"))
-
+    monitor = get_health_monitor()
+    with rabbitpy.Connection(login_str) as conn, ExitStack() as channels:
+        logger.debug("Connected to RabbitMQ")
+        if config.consumer_role == "router":
+            channel = _open_channel(channels, conn, config)
+            queue = _declare_queue(channel)
+            if monitor:
+                # Shards without a running replica are reported by the router
+                shards = range(config.consumer_shard_count)
+                monitor.watch(
+                    login_str,
+                    queue.name,
+                    consumed_elsewhere=[get_shard_queue(queue.name, i) for i in shards],
+                )
+            _run_router(channel, queue, config, monitor)
+            return
+
+        pool = None
+        if (
+            config.consumer_workers > 1
+            or config.consumer_delete_workers > 0
+            or config.consumer_debounce_window > 0
+        ):
+            pool = create_worker_pool(config)
+
+        consumers: List[QueueConsumer] = []
+        try:
+            for channel, queue in _declare_queues(channels, conn, config):
+                consumers.append(QueueConsumer(channel, queue, config, pool))
+            if monitor:
+                monitor.watch(login_str, *(i.queue.name for i in consumers))
 
-            # Consume the messages from generator
-            message: rabbitpy.Message
             logger.debug("Starting to consume messages")
-            for message in queue:
-                on_message(message)
+            _consume(consumers, monitor)
+            if pool and pool.error:
+                # A worker failed and stopped the consumer, so exit with it
+                raise pool.error
+        finally:
+            _stop_consumer(consumers, pool)
@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines the Prometheus metrics for the consumer, and the
+optional HTTP server which exposes them on /metrics
+"""
+import functools
+import logging
+from typing import Callable, Optional, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.tracing import span
+
+logger = logging.getLogger(__name__)
+
+_Func = TypeVar("_Func", bound=Callable)
+
+# Aquilon builds can take minutes, so extend the default buckets
+_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+MESSAGES_RECEIVED = Counter(
+    "rabbit_consumer_messages_received",
+    "Messages received from RabbitMQ",
+)
+MESSAGES = Counter(
+    "rabbit_consumer_messages",
+    "Messages handled, by event type and status "
+    "(ignored, invalid, routed, succeeded or failed)",
+    ["event_type", "status"],
+)
+MESSAGE_DURATION = Histogram(
+    "rabbit_consumer_message_duration_seconds",
+    "Time from a message being received to it being handled",
+    ["event_type"],
+    buckets=_LATENCY_BUCKETS,
+)
+IN_FLIGHT = Gauge(
+    "rabbit_consumer_messages_in_flight",
+    "Messages currently being handled by a worker",
+)
+LANE_QUEUED = Gauge(
+    "rabbit_consumer_lane_messages",
+    "Messages queued or running in each worker lane",
+    ["lane"],
+)
+LANE_WAIT = Histogram(
+    "rabbit_consumer_lane_wait_seconds",
+    "Time messages wait in a worker lane before a worker starts them",
+    ["lane"],
+    buckets=_LATENCY_BUCKETS,
+)
+API_CALL_DURATION = Histogram(
+    "rabbit_consumer_api_call_duration_seconds",
+    "Time taken by each call to an external API",
+    ["api", "call"],
+    buckets=_LATENCY_BUCKETS,
+)
+API_CALL_ERRORS = Counter(
+    "rabbit_consumer_api_call_errors",
+    "Calls to an external API which raised",
+    ["api", "call"],
+)
+AQ_MAKES = Counter(
+    "rabbit_consumer_aq_makes",
+    "Hosts compiled in batched makes, by status (succeeded or failed)",
+    ["status"],
+)
+CONCURRENCY_LIMIT = Gauge(
+    "rabbit_consumer_concurrency_limit",
+    "Concurrent calls currently allowed to each external API",
+    ["api"],
+)
+CIRCUIT_STATE = Gauge(
+    "rabbit_consumer_circuit_state",
+    "Circuit breaker state of each upstream (0 closed, 1 open, 2 half-open)",
+    ["upstream"],
+)
+CIRCUIT_REJECTIONS = Counter(
+    "rabbit_consumer_circuit_rejections",
+    "Calls rejected without being sent as the upstream's circuit was open",
+    ["upstream"],
+)
+QUEUE_DEPTH = Gauge(
+    "rabbit_consumer_queue_depth",
+    "Messages waiting in the consumed queue, as of the last health check",
+)
+QUEUE_CONSUMERS = Gauge(
+    "rabbit_consumer_queue_consumers",
+    "Consumers of each watched queue, as of the last health check",
+    ["queue"],
+)
+OLDEST_UNACKED_AGE = Gauge(
+    "rabbit_consumer_oldest_unacked_seconds",
+    "Age of the oldest message delivered to the consumer but not yet acked",
+)
+CACHE_LOOKUPS = Counter(
+    "rabbit_consumer_cache_lookups",
+    "Lookups in each in-memory cache, by result (hit or miss)",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "rabbit_consumer_cache_evictions",
+    "Entries evicted from each in-memory cache as it was full",
+    ["cache"],
+)
+DNS_TIMEOUTS = Counter(
+    "rabbit_consumer_dns_timeouts",
+    "DNS lookups abandoned after the timeout",
+)
+DNS_LOOKUP_DURATION = Histogram(
+    "rabbit_consumer_dns_lookup_duration_seconds",
+    "Time taken by DNS lookups which missed the cache",
+    ["kind"],
+)
+
+
+def timed(api: str) -> Callable[[_Func], _Func]:
+    """
+    Decorates an API function to record its latency and errors, and to
+    add each call as a span to the trace of the message being handled.
+    The labels are bound once, so each call only pays for the timer.
+    """
+
+    def decorator(func: _Func) -> _Func:
+        duration = API_CALL_DURATION.labels(api, func.__name__)
+        errors = API_CALL_ERRORS.labels(api, func.__name__)
+        span_name = f"{api}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name), duration.time(), errors.count_exceptions():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_metrics_server(config: Optional[ConsumerConfig] = None) -> bool:
+    """
+    Starts serving /metrics on a background thread if a port is configured,
+    so scrapes never block the consume loop. Returns True if started.
+    """
+    config = config if config else ConsumerConfig()
+    if config.metrics_port <= 0:
+        return False
+
+    start_http_server(config.metrics_port)
+    logger.info("Serving metrics on port %s", config.metrics_port)
+    return True
@@ -7,10 +7,12 @@ OpenStack API response
 import logging
 import socket
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from mashumaro import DataClassDictMixin, field_options
 
+from rabbit_consumer.dns_resolver import get_dns_resolver
+
 logger = logging.getLogger(__name__)
 
 
@@ -34,11 +36,10 @@ class OpenstackAddress(DataClassDictMixin):
         is expected to be called from the OpenstackAPI. To get an actual
         list use the Openstack API wrapper directly.
         """
-        internal_networks = []
-        for address in addresses["Internal"]:
-            found = OpenstackAddress.from_dict(address)
-            found.hostname = OpenstackAddress.convert_hostnames(found.addr)
-            internal_networks.append(found)
+        internal_networks = [
+            OpenstackAddress.from_dict(address) for address in addresses["Internal"]
+        ]
+        OpenstackAddress.populate_hostnames(internal_networks)
         return internal_networks
 
     @staticmethod
@@ -48,22 +49,39 @@ class OpenstackAddress(DataClassDictMixin):
         is expected to be called from the OpenstackAPI. To get an actual
         list use the Openstack API wrapper directly.
         """
-        services_networks = []
-        for address in addresses["Services"]:
-            found = OpenstackAddress.from_dict(address)
-            found.hostname = OpenstackAddress.convert_hostnames(found.addr)
-            services_networks.append(found)
+        services_networks = [
+            OpenstackAddress.from_dict(address) for address in addresses["Services"]
+        ]
+        OpenstackAddress.populate_hostnames(services_networks)
         return services_networks
 
+    @staticmethod
+    def populate_hostnames(addresses: List["OpenstackAddress"]) -> None:
+        """
+        Sets the hostname of each address, looking them up concurrently
+        """
+        hostnames = OpenstackAddress.convert_all_hostnames(
+            [address.addr for address in addresses]
+        )
+        for address, hostname in zip(addresses, hostnames):
+            address.hostname = hostname
+
     @staticmethod
     def convert_hostnames(ip_addr: str) -> str:
         """
         Converts an ip address to a hostname using DNS lookup.
         """
+        return OpenstackAddress.convert_all_hostnames([ip_addr])[0]
+
+    @staticmethod
+    def convert_all_hostnames(ip_addrs: List[str]) -> List[str]:
+        """
+        Converts ip addresses to hostnames using DNS lookups.
+        """
         try:
-            return socket.gethostbyaddr(ip_addr)[0]
+            return get_dns_resolver().get_hostnames(ip_addrs)
         except socket.herror:
-            logger.info("No hostname found for ip %s", ip_addr)
+            logger.info("No hostname found for ips %s", ip_addrs)
             raise
         except Exception:
             logger.error("Problem converting ip to hostname")
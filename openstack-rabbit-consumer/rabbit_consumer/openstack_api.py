@@ -5,72 +5,252 @@ This file defines methods for connecting and interacting with the
 OpenStack API
 """
 import logging
+import threading
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 
 import openstack
+from openstack.connection import Connection
+from openstack.exceptions import HttpException, ResourceNotFound
 from openstack.compute.v2.image import Image
 from openstack.compute.v2.server import Server
+from keystoneauth1.exceptions import ConnectionError as KeystoneConnectionError
+from keystoneauth1.exceptions import HttpError as KeystoneHttpError
 
+from rabbit_consumer.circuit_breaker import get_breaker
+from rabbit_consumer.concurrency_limiter import OVERLOAD_STATUS_CODES, get_limiter
 from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.image_cache import get_image_cache
+from rabbit_consumer.metrics import timed
 from rabbit_consumer.openstack_address import OpenstackAddress
+from rabbit_consumer.server_snapshot import ServerSnapshot
 from rabbit_consumer.vm_data import VmData
 
 logger = logging.getLogger(__name__)
 
 
+def _is_overload(err: Optional[BaseException]) -> bool:
+    """
+    Returns True if a call failed as Openstack is overloaded or unreachable.
+    openstacksdk re-raises Keystone errors, so the original is checked too.
+    """
+    while err is not None:
+        if isinstance(err, HttpException):
+            return err.status_code in OVERLOAD_STATUS_CODES
+        if isinstance(err, KeystoneHttpError):
+            return err.http_status in OVERLOAD_STATUS_CODES
+        if isinstance(err, KeystoneConnectionError):
+            return True
+        err = err.__context__
+    return False
+
+
+class OpenstackConnectionManager:
+    """
+    Holds a single authenticated Openstack connection for the whole process,
+    so the Keystone token and service catalog are re-used across messages.
+    The token is refreshed shortly before it expires, or if Openstack
+    rejects it. The connection itself is only closed on shutdown, as other
+    threads may be using it.
+    """
+
+    def __init__(self, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.refresh_margin = config.openstack_token_margin
+
+        self._conn: Optional[Connection] = None
+        self._expires_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def get_connection(self) -> Connection:
+        """
+        Returns the shared connection, authenticating if required
+        """
+        with self._lock:
+            if self._conn is None:
+                logger.debug("Creating shared Openstack connection")
+                self._conn = openstack.connect(
+                    auth_url=ConsumerConfig().openstack_auth_url,
+                    username=ConsumerConfig().openstack_username,
+                    password=ConsumerConfig().openstack_password,
+                    project_name="admin",
+                    user_domain_name="Default",
+                    project_domain_name="default",
+                )
+                try:
+                    self._authorize()
+                except Exception:
+                    # Authenticate from scratch on next use
+                    self._conn = None
+                    raise
+            elif self._token_expiring():
+                logger.info("Openstack token expires soon, re-authenticating")
+                self._conn.session.auth.invalidate()
+                self._authorize()
+            return self._conn
+
+    def expire_token(self) -> None:
+        """
+        Treats the token as expired, so the next caller re-authenticates
+        on the shared connection before using it
+        """
+        with self._lock:
+            self._expires_at = datetime.min.replace(tzinfo=timezone.utc)
+
+    def invalidate(self) -> None:
+        """
+        Closes the shared connection, so the next caller re-authenticates
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._expires_at = None
+
+    def _authorize(self) -> None:
+        """
+        Fetches a token for the connection and records when it expires
+        """
+        with get_breaker("keystone").protect() as guarded:
+            try:
+                self._conn.authorize()
+            except Exception as err:
+                guarded.failed = _is_overload(err)
+                raise
+        try:
+            expires_at = self._conn.session.auth.auth_ref.expires
+        except AttributeError:
+            expires_at = None
+        self._expires_at = expires_at if isinstance(expires_at, datetime) else None
+
+    def _token_expiring(self) -> bool:
+        """
+        Returns True if the token will expire within the refresh margin
+        """
+        if not self._expires_at:
+            return False
+        margin = timedelta(seconds=self.refresh_margin)
+        return datetime.now(timezone.utc) + margin >= self._expires_at
+
+
+_manager: Optional[OpenstackConnectionManager] = None  # pylint: disable=invalid-name
+_manager_lock = threading.Lock()
+
+
+def get_connection_manager() -> OpenstackConnectionManager:
+    """
+    Returns the process-wide Openstack connection manager
+    """
+    # pylint: disable=global-statement
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = OpenstackConnectionManager()
+        return _manager
+
+
+def close_openstack_connection() -> None:
+    """
+    Closes the shared Openstack connection, if one is open
+    """
+    # pylint: disable=global-statement
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.invalidate()
+        _manager = None
+
+
 class OpenstackConnection:
     """
     Wrapper for Openstack connection, to reduce boilerplate code
-    in subsequent functions.
+    in subsequent functions. This hands out the shared connection,
+    re-authenticating it if Openstack rejects our token. Each use goes through
+    the circuit breaker for the upstream being called, and holds a slot
+    under the adaptive limit on concurrent Openstack calls.
     """
 
-    def __init__(self):
+    def __init__(self, name: str = "", upstream: str = "nova"):
+        self.name = name
         self.conn = None
+        self._breaker = get_breaker(upstream)
+        self._limiter = get_limiter("openstack")
+        self._call = None
 
     def __enter__(self):
-        self.conn = openstack.connect(
-            auth_url=ConsumerConfig().openstack_auth_url,
-            username=ConsumerConfig().openstack_username,
-            password=ConsumerConfig().openstack_password,
-            project_name="admin",
-            user_domain_name="Default",
-            project_domain_name="default",
-        )
+        self._breaker.allow()
+        self._call = self._limiter.acquire(self.name)
+        try:
+            self.conn = get_connection_manager().get_connection()
+        except Exception as err:
+            # Keystone failed rather than the upstream, so it isn't counted
+            self._call.dropped = _is_overload(err)
+            self._limiter.release(self._call)
+            self._breaker.record(None)
+            raise
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        overloaded = _is_overload(exc_val)
+        self._call.dropped = overloaded
+        self._limiter.release(self._call)
+        self._breaker.record(overloaded)
+        if isinstance(exc_val, HttpException) and exc_val.status_code == 401:
+            logger.warning("Openstack rejected our token, re-authenticating on next use")
+            get_connection_manager().expire_token()
 
 
+@timed("openstack")
 def check_machine_exists(vm_data: VmData) -> bool:
     """
     Checks to see if the machine exists in Openstack.
     """
-    with OpenstackConnection() as conn:
+    with OpenstackConnection("find_server") as conn:
         return bool(conn.compute.find_server(vm_data.virtual_machine_id))
 
 
+@timed("openstack")
 def get_server_details(vm_data: VmData) -> Server:
     """
     Gets the server details from Openstack with details included
     """
-    with OpenstackConnection() as conn:
-        # Workaround for details missing from find_server
-        # on the current version of openstacksdk
-        found = list(
-            conn.compute.servers(uuid=vm_data.virtual_machine_id, all_projects=True)
-        )
-        if not found:
-            raise ValueError(f"Server not found for id: {vm_data.virtual_machine_id}")
-        return found[0]
+    with OpenstackConnection("get_server") as conn:
+        try:
+            return conn.compute.get_server(vm_data.virtual_machine_id)
+        except ResourceNotFound as err:
+            raise ValueError(
+                f"Server not found for id: {vm_data.virtual_machine_id}"
+            ) from err
+
+
+@timed("openstack")
+def list_servers() -> List[Server]:
+    """
+    Lists every server across all projects with their details,
+    which openstacksdk fetches a page at a time
+    """
+    with OpenstackConnection("list_servers") as conn:
+        return list(conn.compute.servers(details=True, all_projects=True))
 
 
-def get_server_networks(vm_data: VmData) -> List[OpenstackAddress]:
+def get_server_snapshot(vm_data: VmData) -> ServerSnapshot:
     """
-    Gets the networks from Openstack for the virtual machine as a list
+    Fetches the server once, returning a snapshot which can be passed
+    through the rest of the message handling
+    """
+    try:
+        server = get_server_details(vm_data)
+    except ValueError:
+        server = None
+    return ServerSnapshot(vm_data=vm_data, server=server)
+
+
+def get_server_networks(snapshot: ServerSnapshot) -> List[OpenstackAddress]:
+    """
+    Gets the networks of the virtual machine from its snapshot as a list
     of deserialized OpenstackAddresses.
     """
-    server = get_server_details(vm_data)
+    server = snapshot.server
     if "Internal" in server.addresses:
         return OpenstackAddress.get_internal_networks(server.addresses)
     if "Services" in server.addresses:
@@ -79,19 +259,19 @@ def get_server_networks(vm_data: VmData) -> List[OpenstackAddress]:
     return []
 
 
-def get_server_metadata(vm_data: VmData) -> dict:
+def get_server_metadata(snapshot: ServerSnapshot) -> dict:
     """
-    Gets the metadata from Openstack for the virtual machine.
+    Gets the metadata of the virtual machine from its snapshot.
     """
-    server = get_server_details(vm_data)
-    return server.metadata
+    return snapshot.server.metadata
 
 
-def get_image(vm_data: VmData) -> Optional[Image]:
+@timed("openstack")
+def get_image(snapshot: ServerSnapshot) -> Optional[Image]:
     """
     Gets the image name from Openstack for the virtual machine.
     """
-    server = get_server_details(vm_data)
+    server = snapshot.server
 
     try:
         # This is caused by the user booking from a volume or snapshot
@@ -103,17 +283,26 @@ def get_image(vm_data: VmData) -> Optional[Image]:
         logger.warning("No image or ID found for server %s", server.name)
         return None
 
-    with OpenstackConnection() as conn:
-        image = conn.compute.find_image(uuid)
+    image_cache = get_image_cache()
+    image = image_cache.get(uuid)
+    if image:
         return image
 
+    # Images are fetched from Glance through Nova's image proxy
+    with OpenstackConnection("find_image", upstream="glance") as conn:
+        image = conn.compute.find_image(uuid)
+
+    if image:
+        image_cache.put(uuid, image)
+    return image
+
 
-def update_metadata(vm_data: VmData, metadata) -> None:
+@timed("openstack")
+def update_metadata(snapshot: ServerSnapshot, metadata) -> None:
     """
     Updates the metadata for the virtual machine.
     """
-    server = get_server_details(vm_data)
-    with OpenstackConnection() as conn:
-        conn.compute.set_server_metadata(server, **metadata)
+    with OpenstackConnection("set_server_metadata") as conn:
+        conn.compute.set_server_metadata(snapshot.server, **metadata)
 
     logger.debug("Setting metadata successful")
@@ -4,20 +4,46 @@
 This file handles how messages from Rabbit are processed and the 
 message extracted
 """
+import re
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
 
 from mashumaro import field_options
 from mashumaro.mixins.json import DataClassJSONMixin
 
+SUPPORTED_MESSAGE_TYPES = {
+    "create": "compute.instance.create.end",
+    "delete": "compute.instance.delete.start",
+}
 
-@dataclass
-class MessageEventType(DataClassJSONMixin):
+_EVENT_TYPE_KEY = b"event_type"
+
+# Matches the value following an event_type key, where the oslo.message body
+# is itself a JSON encoded string, so its quotes may be escaped
+_EVENT_TYPE_VALUE = re.compile(rb'\\?"\s*:\s*\\?"([^"\\]+)')
+
+
+def sniff_event_type(raw_body: bytes) -> Optional[str]:
     """
-    Parses a raw message from RabbitMQ to determine the event_type
+    Finds the event type in a raw RabbitMQ message without decoding it,
+    so unsupported events can be skipped cheaply. Returns None if the
+    event type can't be found unambiguously, so the caller should then
+    decode the message fully.
     """
+    found = set()
+    start = raw_body.find(_EVENT_TYPE_KEY)
+    while start != -1:
+        # Only match the key itself, not keys ending with event_type
+        if raw_body[start - 1 : start] == b'"':
+            match = _EVENT_TYPE_VALUE.match(raw_body, start + len(_EVENT_TYPE_KEY))
+            if match:
+                found.add(match.group(1))
+        start = raw_body.find(_EVENT_TYPE_KEY, start + 1)
 
-    event_type: str
+    if len(found) != 1:
+        return None
+    return found.pop().decode("utf-8")
 
 
 @dataclass
@@ -31,6 +57,18 @@ class RabbitMeta(DataClassJSONMixin):
     )
 
 
+@dataclass
+class RabbitFixedIp(DataClassJSONMixin):
+    """
+    Deserialised fixed IP of a VM, as listed in the message payload
+    """
+
+    address: str
+    version: int
+    label: str
+    vif_mac: str
+
+
 @dataclass
 # pylint: disable=too-many-instance-attributes
 class RabbitPayload(DataClassJSONMixin):
@@ -46,6 +84,27 @@ class RabbitPayload(DataClassJSONMixin):
 
     metadata: RabbitMeta
 
+    # The following are only used in payload-first mode, and may be
+    # missing from some messages
+    instance_metadata: Dict[str, str] = field(
+        metadata=field_options(alias="metadata"), default_factory=dict
+    )
+    image_ref_url: Optional[str] = None
+    fixed_ips: List[RabbitFixedIp] = field(default_factory=list)
+
+    @property
+    def image_id(self) -> Optional[str]:
+        """
+        Returns the image UUID from the end of the image URL, if there is one.
+        Volume-backed VMs have a URL ending in the images collection itself.
+        """
+        if not self.image_ref_url:
+            return None
+        image_id = urlsplit(self.image_ref_url).path.rsplit("/", 1)[-1]
+        if not image_id or image_id == "images":
+            return None
+        return image_id
+
 
 @dataclass
 class RabbitMessage(DataClassJSONMixin):
@@ -58,3 +117,7 @@ class RabbitMessage(DataClassJSONMixin):
     project_id: str = field(metadata=field_options(alias="_context_project_id"))
     user_name: str = field(metadata=field_options(alias="_context_user_name"))
     payload: RabbitPayload
+    message_id: Optional[str] = None
+    # Set once decoded if the message was delayed on a retry queue, so the
+    # VM may have been deleted whilst it waited
+    retried: bool = False
@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file reconciles Aquilon with Openstack in a single pass, for
+catching up after a consumer outage or a purged queue. Every server
+and every vm-openstack machine are listed in bulk, then the missing
+machines are created and the orphaned ones deleted concurrently.
+
+Only machines named with this deployment's AQ_PREFIX are ever deleted,
+so deployments sharing an Aquilon don't delete each other's machines.
+
+Run from the openstack-rabbit-consumer directory with:
+python3 -m rabbit_consumer.reconcile [--dry-run] [--workers N] [--force]
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from openstack.compute.v2.server import Server
+
+from rabbit_consumer import aq_api, openstack_api
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.make_batcher import stop_make_batcher
+from rabbit_consumer.message_consumer import (
+    delete_machine,
+    handle_create_machine,
+    is_aq_managed_image,
+)
+from rabbit_consumer.rabbit_message import (
+    SUPPORTED_MESSAGE_TYPES,
+    RabbitMessage,
+    RabbitMeta,
+    RabbitPayload,
+)
+from rabbit_consumer.server_snapshot import ServerSnapshot
+from rabbit_consumer.vm_data import VmData
+
+logger = logging.getLogger(__name__)
+
+AQ_MACHINE_MODEL = "vm-openstack"
+
+# Plans deleting more machines than this are refused unless forced, as
+# they more likely come from a broken listing than a consumer outage
+DEFAULT_MAX_DELETES = 50
+
+
+@dataclass
+class ReconcilePlan:
+    """
+    The servers missing from Aquilon, and the machines, keyed by serial,
+    which no longer have a server
+    """
+
+    creates: List[Server] = field(default_factory=list)
+    deletes: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class ReconcileReport:
+    """
+    The outcome of applying a plan
+    """
+
+    succeeded: int = 0
+    failed: List[str] = field(default_factory=list)
+
+
+def server_to_message(server: Server) -> RabbitMessage:
+    """
+    Builds the create message Nova would have sent for the server. Project
+    names aren't listed with servers, so the project ID is used instead.
+    """
+    return RabbitMessage(
+        event_type=SUPPORTED_MESSAGE_TYPES["create"],
+        project_name=server.project_id,
+        project_id=server.project_id,
+        user_name=server.user_id,
+        payload=RabbitPayload(
+            instance_id=server.id,
+            vm_name=server.name,
+            vcpus=server.flavor.vcpus,
+            memory_mb=server.flavor.ram,
+            vm_host=server.compute_host,
+            metadata=RabbitMeta(),
+        ),
+    )
+
+
+def _image_id(server: Server) -> Optional[str]:
+    """
+    Returns the ID of the server's image, or None if booted from a volume
+    """
+    return getattr(getattr(server, "image", None), "id", None)
+
+
+def _is_aq_server(server: Server) -> bool:
+    """
+    Checks whether the server is on an Aquilon image
+    """
+    vm_data = VmData(project_id=server.project_id, virtual_machine_id=server.id)
+    return is_aq_managed_image(ServerSnapshot(vm_data=vm_data, server=server))
+
+
+def build_plan(
+    servers: List[Server], machines: Dict[str, str], prefix: str, workers: int = 16
+) -> ReconcilePlan:
+    """
+    Diffs the servers against the machines, keyed by serial. Only active
+    servers on Aquilon images need a machine, whilst a machine is only
+    orphaned once no server at all has its serial, and it was named with
+    our prefix. Each image is only checked once, with the checks run on a
+    bounded pool of threads.
+    """
+    plan = ReconcilePlan()
+    server_ids = {server.id for server in servers}
+    candidates = [
+        server
+        for server in servers
+        if server.id not in machines and server.status == "ACTIVE"
+    ]
+
+    by_image: Dict[Optional[str], Server] = {}
+    for server in candidates:
+        by_image.setdefault(_image_id(server), server)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as ex:
+        managed = dict(zip(by_image, ex.map(_is_aq_server, by_image.values())))
+    plan.creates = [server for server in candidates if managed[_image_id(server)]]
+
+    plan.deletes = {
+        serial: name
+        for serial, name in machines.items()
+        if serial not in server_ids and name.startswith(prefix)
+    }
+    return plan
+
+
+def fetch_plan(workers: int = 16) -> ReconcilePlan:
+    """
+    Lists the servers and machines in bulk, and plans the changes needed.
+    Machines are listed first, so a VM registered by the consumer in
+    between is seen as a server with a machine, rather than an orphan.
+    """
+    prefix = ConsumerConfig().aq_prefix
+    if not prefix:
+        raise ValueError("AQ_PREFIX must be set to tell which machines are ours")
+
+    start = time.monotonic()
+    machines = aq_api.search_machines_by_model(AQ_MACHINE_MODEL)
+    servers = openstack_api.list_servers()
+    logger.info(
+        "Listed %s servers and %s machines in %.1f s",
+        len(servers),
+        len(machines),
+        time.monotonic() - start,
+    )
+    return build_plan(servers, machines, prefix, workers)
+
+
+def _plan_tasks(plan: ReconcilePlan) -> List[Tuple[str, Callable[[], None]]]:
+    """
+    Returns a description and callable for each change in the plan
+    """
+    tasks = []
+    for server in plan.creates:
+        message = server_to_message(server)
+        tasks.append(
+            (f"create {server.id}", lambda m=message: handle_create_machine(m))
+        )
+    for serial, name in plan.deletes.items():
+        vm_data = VmData(project_id="", virtual_machine_id=serial)
+        tasks.append((f"delete {name}", lambda v=vm_data: delete_machine(v)))
+    return tasks
+
+
+def apply_plan(
+    plan: ReconcilePlan, workers: int, progress_interval: float = 10.0
+) -> ReconcileReport:
+    """
+    Applies the changes on a bounded pool of threads, printing the progress
+    at most every progress_interval seconds. A failed change is logged and
+    counted, so it doesn't stop the others.
+    """
+    tasks = _plan_tasks(plan)
+    report = ReconcileReport()
+    last_progress = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as ex:
+        futures = {ex.submit(task): desc for desc, task in tasks}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+                report.succeeded += 1
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to %s", futures[future])
+                report.failed.append(futures[future])
+
+            now = time.monotonic()
+            if now - last_progress >= progress_interval or done == len(tasks):
+                print(f"Progress: {done}/{len(tasks)} ({len(report.failed)} failed)")
+                last_progress = now
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Plans the changes needed, applying them unless this is a dry run
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="List the changes without applying them"
+    )
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent changes")
+    parser.add_argument(
+        "--max-deletes",
+        type=int,
+        default=DEFAULT_MAX_DELETES,
+        help="Refuse to apply plans deleting more machines than this",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Apply the plan however many deletes"
+    )
+    args = parser.parse_args(argv)
+
+    plan = fetch_plan(args.workers)
+    print(f"Creates needed: {len(plan.creates)}")
+    print(f"Deletes needed: {len(plan.deletes)}")
+    if args.dry_run:
+        for server in plan.creates:
+            print(f"Would create machine for {server.id} ({server.name})")
+        for serial, name in plan.deletes.items():
+            print(f"Would delete machine {name} ({serial})")
+        return
+    if len(plan.deletes) > args.max_deletes and not args.force:
+        raise SystemExit(
+            f"Refusing to delete {len(plan.deletes)} machines, more than "
+            f"--max-deletes {args.max_deletes}. Check the plan with --dry-run, "
+            "then pass --force to apply it."
+        )
+
+    try:
+        report = apply_plan(plan, args.workers)
+    finally:
+        # Make any hosts still queued, as nothing else will once we exit
+        stop_make_batcher()
+    print(f"Reconciled {report.succeeded} changes, {len(report.failed)} failed")
+    for desc in report.failed:
+        print(f"Failed: {desc}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file records raw messages from the queue, or from a dump, to a
+compact file and replays them through the consumer. This lets
+production bursts be reproduced against test Aquilon and Openstack
+instances.
+
+Run from the openstack-rabbit-consumer directory with:
+python3 -m rabbit_consumer.replay record --output FILE [--dump DUMP]
+python3 -m rabbit_consumer.replay replay FILE [--speed N]
+"""
+import argparse
+import base64
+import gzip
+import json
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.make_batcher import stop_make_batcher
+from rabbit_consumer.message_consumer import generate_login_str, on_message
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before checking an empty queue again when recording
+_POLL_INTERVAL = 0.5
+
+
+@dataclass
+class RecordedMessage:
+    """
+    A raw message body, and the seconds after the recording
+    started at which it was received
+    """
+
+    offset: float
+    body: bytes
+
+    def to_json(self) -> str:
+        """
+        Returns the message as a single JSON line. Bodies are kept as text
+        where possible, so recordings compress well and can be read by eye.
+        """
+        try:
+            return json.dumps({"t": round(self.offset, 4), "body": self.body.decode()})
+        except UnicodeDecodeError:
+            encoded = base64.b64encode(self.body).decode()
+            return json.dumps({"t": round(self.offset, 4), "body_b64": encoded})
+
+    @staticmethod
+    def from_json(line: str) -> "RecordedMessage":
+        """
+        Parses a message written by to_json
+        """
+        loaded = json.loads(line)
+        if "body_b64" in loaded:
+            body = base64.b64decode(loaded["body_b64"])
+        else:
+            body = loaded["body"].encode()
+        return RecordedMessage(offset=loaded["t"], body=body)
+
+
+class ReplayedMessage:
+    """
+    Stands in for a rabbitpy message when replaying, where acks do nothing
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.properties = {}
+
+    def ack(self, all_previous: bool = False) -> None:
+        """
+        Replayed messages don't come from a queue, so there is nothing to ack
+        """
+
+
+def write_recording(path: str, messages: Iterable[RecordedMessage]) -> int:
+    """
+    Writes messages to a gzipped JSON lines file, returning the count written
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        for message in messages:
+            file.write(message.to_json() + "\n")
+            count += 1
+    return count
+
+
+def read_recording(path: str) -> Iterator[RecordedMessage]:
+    """
+    Reads the messages from a recording
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield RecordedMessage.from_json(line)
+
+
+def read_dump(path: str) -> Iterator[RecordedMessage]:
+    """
+    Reads raw message bodies from a dump, one per line. Dumps have no
+    timings, so these messages will be replayed as fast as possible.
+    """
+    with open(path, "rb") as file:
+        for line in file:
+            if line.strip():
+                yield RecordedMessage(offset=0.0, body=line.strip())
+
+
+def tap_queue(
+    config: ConsumerConfig, count: Optional[int], duration: Optional[float]
+) -> Iterator[RecordedMessage]:
+    """
+    Copies messages from the Nova exchange onto a temporary queue and
+    yields them, so the real consumer still receives every message. The
+    queue is polled rather than consumed, so the duration is still
+    enforced when no messages arrive.
+    """
+    routing_key = os.getenv(key="CONSUMER_QUEUE", default="ral.info")
+    with rabbitpy.Connection(generate_login_str(config)) as conn:
+        with conn.channel() as channel:
+            # A server named, exclusive queue is removed when we disconnect
+            queue = rabbitpy.Queue(channel, exclusive=True, auto_delete=True)
+            queue.declare()
+            queue.bind("nova", routing_key=routing_key)
+            logger.info("Recording messages from %s", routing_key)
+
+            start = time.monotonic()
+            recorded = 0
+            while not count or recorded < count:
+                offset = time.monotonic() - start
+                if duration and offset >= duration:
+                    return
+                message = queue.get(acknowledge=False)
+                if message is None:
+                    wait = _POLL_INTERVAL
+                    if duration:
+                        wait = min(wait, duration - offset)
+                    time.sleep(wait)
+                    continue
+                yield RecordedMessage(offset=offset, body=message.body)
+                recorded += 1
+
+
+@dataclass
+class ReplayReport:
+    """
+    The results of replaying a recording
+    """
+
+    elapsed: float = 0.0
+    failed: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    @property
+    def count(self) -> int:
+        """
+        Returns the number of messages replayed
+        """
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Returns the messages handled per second
+        """
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns the given latency percentile, using the nearest rank
+        """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+        return ordered[rank - 1]
+
+    def summary(self) -> str:
+        """
+        Returns the report as human readable lines
+        """
+        lines = [
+            f"Messages:   {self.count} ({self.failed} failed)",
+            f"Elapsed:    {self.elapsed:.2f} s",
+            f"Throughput: {self.throughput:.1f} msgs/s",
+        ]
+        for percent in (50, 90, 99, 100):
+            name = "max" if percent == 100 else f"p{percent}"
+            lines.append(f"{name + ':':11} {self.percentile(percent) * 1000:.1f} ms")
+        return "\n".join(lines)
+
+
+def replay(
+    messages: Iterable[RecordedMessage],
+    speed: float = 1.0,
+    handler: Callable = on_message,
+) -> ReplayReport:
+    """
+    Feeds recorded messages through the handler. A speed of 1 replays at
+    the original rate, 2 at twice the rate, and 0 as fast as possible.
+    When paced, latency is measured from when a message was due, so it
+    includes any time spent waiting behind earlier messages.
+    """
+    report = ReplayReport()
+    start = time.monotonic()
+    for message in messages:
+        if speed > 0:
+            due = start + message.offset / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            due = time.monotonic()
+
+        try:
+            handler(ReplayedMessage(message.body))
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to handle replayed message")
+            report.failed += 1
+        report.latencies.append(time.monotonic() - due)
+
+    report.elapsed = time.monotonic() - start
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Records or replays messages, depending on the command given
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="Record messages to a file")
+    record.add_argument("--output", required=True, help="File to write")
+    record.add_argument("--dump", help="Convert a dump of raw bodies, one per line")
+    record.add_argument("--count", type=int, help="Stop after this many messages")
+    record.add_argument("--duration", type=float, help="Stop after this many seconds")
+
+    replay_cmd = commands.add_parser("replay", help="Replay a recording")
+    replay_cmd.add_argument("recording", help="File written by record")
+    replay_cmd.add_argument(
+        "--speed", type=float, default=1.0, help="Rate multiplier, 0 for max speed"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        if args.dump:
+            messages = read_dump(args.dump)
+        else:
+            messages = tap_queue(ConsumerConfig(), args.count, args.duration)
+        written = write_recording(args.output, messages)
+        print(f"Recorded {written} messages to {args.output}")
+        return
+
+    try:
+        report = replay(read_recording(args.recording), speed=args.speed)
+    finally:
+        # Make any hosts still queued, as nothing else will once we exit
+        stop_make_batcher()
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file parks messages which failed to be handled on delayed retry
+queues, or a dead-letter queue once they run out of attempts, so a
+single bad message can't stop the consumer
+"""
+import logging
+from typing import Callable, Dict, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer.circuit_breaker import CircuitOpenError
+from rabbit_consumer.consumer_config import ConsumerConfig
+
+logger = logging.getLogger(__name__)
+
+RETRY_COUNT_HEADER = "x-retry-count"
+LAST_ERROR_HEADER = "x-last-error"
+
+# Keep the error header short, as it is copied onto each retry
+_MAX_ERROR_LENGTH = 256
+
+
+class RetryHandler:
+    """
+    Handles failed messages for a queue. Each attempt is republished to a
+    retry queue with a TTL, which dead-letters back to the main queue once
+    the TTL passes. The delay doubles on each attempt, and once the max
+    attempts are used up the message is moved to the dead-letter queue.
+    """
+
+    def __init__(self, queue_name: str, config: Optional[ConsumerConfig] = None):
+        config = config if config else ConsumerConfig()
+        self.queue_name = queue_name
+        self.max_attempts = config.retry_max_attempts
+        self.base_delay = config.retry_base_delay
+        self.max_delay = config.retry_max_delay
+
+    @property
+    def dead_letter_queue(self) -> str:
+        """
+        Returns the name of the queue messages are moved to once they fail
+        """
+        return f"{self.queue_name}.dead"
+
+    def get_delay(self, attempt: int) -> int:
+        """
+        Returns the delay in seconds before the given retry attempt
+        """
+        return int(min(self.base_delay * 2 ** (attempt - 1), self.max_delay))
+
+    def get_retry_queue(self, attempt: int) -> str:
+        """
+        Returns the name of the retry queue for the given attempt. The delay
+        is part of the name, as a queue's TTL can't be changed once declared.
+        """
+        return f"{self.queue_name}.retry.{self.get_delay(attempt)}s"
+
+    def declare(self, channel: rabbitpy.Channel) -> None:
+        """
+        Declares the retry and dead-letter queues
+        """
+        names: List[str] = []
+        for attempt in range(1, self.max_attempts):
+            name = self.get_retry_queue(attempt)
+            if name in names:
+                # Later attempts share a queue once the delay is capped
+                continue
+            names.append(name)
+            rabbitpy.Queue(
+                channel,
+                name=name,
+                durable=True,
+                message_ttl=self.get_delay(attempt) * 1000,
+                dead_letter_routing_key=self.queue_name,
+                # The default exchange routes straight to the queue by name
+                arguments={"x-dead-letter-exchange": ""},
+            ).declare()
+
+        rabbitpy.Queue(channel, name=self.dead_letter_queue, durable=True).declare()
+        logger.debug("Declared retry queues %s and %s", names, self.dead_letter_queue)
+
+    def run(self, message: rabbitpy.Message, task: Callable[[], None]) -> bool:
+        """
+        Runs the task to handle a message, parking the message if it fails.
+        The message is acked either way, as any failure has been republished.
+        Returns True if the task succeeded.
+        """
+        succeeded = True
+        try:
+            task()
+        except CircuitOpenError as err:
+            succeeded = False
+            self.park(message, err)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            succeeded = False
+            self.retry(message, err)
+        message.ack()
+        return succeeded
+
+    def retry(self, message: rabbitpy.Message, err: Exception) -> None:
+        """
+        Republishes a failed message to the next retry queue, or to the
+        dead-letter queue if it has used all of its attempts
+        """
+        attempt = self.get_attempt(message) + 1
+        if attempt >= self.max_attempts:
+            logger.error(
+                "Message failed after %s attempts, moving to %s: %s",
+                attempt,
+                self.dead_letter_queue,
+                err,
+            )
+            self._publish(message, self.dead_letter_queue, attempt, err)
+            return
+
+        routing_key = self.get_retry_queue(attempt)
+        logger.warning(
+            "Message failed on attempt %s, retrying in %ss: %s",
+            attempt,
+            self.get_delay(attempt),
+            err,
+        )
+        self._publish(message, routing_key, attempt, err)
+
+    def park(self, message: rabbitpy.Message, err: Exception) -> None:
+        """
+        Republishes a message which wasn't attempted, as an upstream is
+        down, to a retry queue without using up an attempt
+        """
+        if self.max_attempts <= 1:
+            # There are no retry queues to park it on
+            self.retry(message, err)
+            return
+
+        attempt = self.get_attempt(message)
+        next_attempt = min(attempt + 1, self.max_attempts - 1)
+        logger.warning("Parking message for %ss: %s", self.get_delay(next_attempt), err)
+        self._publish(message, self.get_retry_queue(next_attempt), attempt, err)
+
+    def dead_letter(self, message: rabbitpy.Message, err: Exception) -> None:
+        """
+        Moves a message which can never succeed, e.g. one which
+        can't be decoded, straight to the dead-letter queue
+        """
+        logger.error("Moving message to %s: %s", self.dead_letter_queue, err)
+        self._publish(
+            message, self.dead_letter_queue, self.get_attempt(message) + 1, err
+        )
+
+    @staticmethod
+    def was_retried(message: rabbitpy.Message) -> bool:
+        """
+        Returns True if the message has been through a retry queue,
+        including being parked without using up an attempt
+        """
+        headers = message.properties.get("headers") or {}
+        return RETRY_COUNT_HEADER in headers
+
+    @staticmethod
+    def get_attempt(message: rabbitpy.Message) -> int:
+        """
+        Returns the number of times the message has already failed
+        """
+        headers = message.properties.get("headers") or {}
+        return int(headers.get(RETRY_COUNT_HEADER, 0))
+
+    @staticmethod
+    def _publish(
+        message: rabbitpy.Message, routing_key: str, attempt: int, err: Exception
+    ) -> None:
+        """
+        Publishes a copy of the message to a queue through the default
+        exchange, recording the attempt and error in its headers
+        """
+        properties: Dict = {
+            key: value for key, value in message.properties.items() if value
+        }
+        properties["headers"] = {
+            **(properties.get("headers") or {}),
+            RETRY_COUNT_HEADER: attempt,
+            LAST_ERROR_HEADER: f"{type(err).__name__}: {err}"[:_MAX_ERROR_LENGTH],
+        }
+        rabbitpy.Message(message.channel, message.body, properties).publish(
+            "", routing_key=routing_key
+        )
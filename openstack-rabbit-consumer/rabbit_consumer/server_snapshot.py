@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file has a dataclass holding the details of a server fetched once
+from Openstack, so they can be shared through the handling of a message
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from openstack.compute.v2.server import Server
+
+from rabbit_consumer.rabbit_message import RabbitPayload
+from rabbit_consumer.vm_data import VmData
+
+
+@dataclass
+class ServerSnapshot:
+    """
+    Holds the server details fetched from Nova at the start of handling
+    a message. The server is None if it did not exist at that point.
+    """
+
+    vm_data: VmData
+    server: Optional[Server]
+
+    @property
+    def exists(self) -> bool:
+        """
+        Returns True if the server existed when the snapshot was taken
+        """
+        return self.server is not None
+
+    @staticmethod
+    def from_payload(
+        vm_data: VmData, payload: RabbitPayload
+    ) -> Optional["ServerSnapshot"]:
+        """
+        Builds a snapshot from the details in a create message, without
+        querying Nova. The server is laid out as Nova returns it, so the
+        rest of the message handling is unchanged. Returns None if the
+        payload is missing the image or the fixed IPs.
+        """
+        if not payload.image_id or not payload.fixed_ips:
+            return None
+
+        addresses: Dict[str, List[Dict]] = {}
+        for fixed_ip in payload.fixed_ips:
+            addresses.setdefault(fixed_ip.label, []).append(
+                {
+                    "addr": fixed_ip.address,
+                    "version": fixed_ip.version,
+                    "OS-EXT-IPS-MAC:mac_addr": fixed_ip.vif_mac,
+                }
+            )
+        server = Server.existing(
+            id=payload.instance_id,
+            name=payload.vm_name,
+            image={"id": payload.image_id},
+            metadata=dict(payload.instance_metadata),
+            addresses=addresses,
+        )
+        return ServerSnapshot(vm_data=vm_data, server=server)
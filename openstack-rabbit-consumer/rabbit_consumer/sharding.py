@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file spreads messages across multiple consumer replicas. Nova
+publishes every notification with the same routing key, so a router
+republishes each message keyed on its instance ID to a consistent-hash
+exchange, which sends all messages for a VM to the same shard's queue.
+There is a fixed number of these logical shards, split between the shard
+replicas, so VMs don't move between shards as replicas come and go.
+This needs the rabbitmq_consistent_hash_exchange plugin.
+"""
+import logging
+import re
+from typing import Callable, Dict, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.health import HealthMonitor
+from rabbit_consumer.metrics import MESSAGES
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.shutdown import QueueStopper
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_ROLES = ("all", "router", "shard")
+
+# Each shard's queue is bound with the same weight, so VMs are spread evenly
+_SHARD_WEIGHT = "1"
+
+
+def get_shard_exchange(queue_name: str) -> str:
+    """
+    Returns the name of the exchange messages are routed to the shards through
+    """
+    return f"{queue_name}.sharded"
+
+
+def get_shard_queue(queue_name: str, shard: int) -> str:
+    """
+    Returns the name of the queue for a logical shard
+    """
+    return f"{queue_name}.shard.{shard}"
+
+
+def get_shard_name(config: ConsumerConfig) -> str:
+    """
+    Returns the name of this shard replica, which must be set explicitly,
+    as a hostname isn't stable across restarts
+    """
+    if not config.consumer_shard_name:
+        raise ValueError("CONSUMER_SHARD_NAME must be set to run as a shard")
+    return config.consumer_shard_name
+
+
+def get_assigned_shards(config: ConsumerConfig) -> List[int]:
+    """
+    Returns the logical shards this replica consumes. Replica N, taken from
+    the ordinal at the end of its name, consumes every Mth shard from N,
+    where M is the number of replicas, so every shard has a replica. If
+    fewer replicas are running, the router's health check reports the
+    shards left without a consumer.
+    """
+    name = get_shard_name(config)
+    match = re.search(r"(\d+)$", name)
+    if not match:
+        raise ValueError(f"Shard name {name} must end in the replica's ordinal")
+
+    ordinal = int(match.group(1))
+    replicas = config.consumer_shard_replicas
+    shards = list(range(ordinal, config.consumer_shard_count, replicas))
+    if ordinal >= replicas or not shards:
+        raise ValueError(
+            f"Shard replica {name} is outside the {replicas} replicas "
+            f"of {config.consumer_shard_count} shards"
+        )
+    return shards
+
+
+def declare_shard_exchange(channel: rabbitpy.Channel, queue_name: str) -> str:
+    """
+    Declares the consistent-hash exchange for the queue, returning its name
+    """
+    name = get_shard_exchange(queue_name)
+    rabbitpy.Exchange(
+        channel, name, exchange_type="x-consistent-hash", durable=True
+    ).declare()
+    return name
+
+
+def declare_shard_queue(
+    channel: rabbitpy.Channel, queue_name: str, shard: int
+) -> rabbitpy.Queue:
+    """
+    Declares the queue for a logical shard and binds it to the
+    consistent-hash exchange. Only one consumer is active on the queue at a
+    time, so whilst a shard moves between replicas, e.g. during a rollout,
+    its messages are still handled in order.
+    """
+    exchange = declare_shard_exchange(channel, queue_name)
+    queue = rabbitpy.Queue(
+        channel,
+        name=get_shard_queue(queue_name, shard),
+        durable=True,
+        arguments={"x-single-active-consumer": True},
+    )
+    queue.declare()
+    # The binding key of a consistent-hash exchange is the queue's weight
+    queue.bind(exchange, routing_key=_SHARD_WEIGHT)
+    return queue
+
+
+class ShardRouter:
+    """
+    Republishes messages from the main queue to the shards, keyed on their
+    instance ID. A single router consumes the main queue, so messages are
+    republished in the order they arrived. Each message is only acked once
+    the broker has confirmed its copy, so none are lost if the router stops.
+    Every shard's queue is declared up front, so the keys are always spread
+    over the same shards, even before their replicas have started.
+    """
+
+    def __init__(
+        self,
+        channel: rabbitpy.Channel,
+        queue_name: str,
+        decode: Callable[[rabbitpy.Message], Optional[RabbitMessage]],
+        shard_count: int,
+    ):
+        self.decode = decode
+        self.exchange = declare_shard_exchange(channel, queue_name)
+        for shard in range(shard_count):
+            declare_shard_queue(channel, queue_name, shard)
+        channel.enable_publisher_confirms()
+
+    def route(self, message: rabbitpy.Message) -> None:
+        """
+        Republishes a message to its shard. Messages we ignore are dropped
+        here, so shards never receive them.
+        """
+        decoded = self.decode(message)
+        if decoded:
+            properties: Dict = {
+                key: value for key, value in message.properties.items() if value
+            }
+            # Mandatory, so the broker returns the message if no shards are bound
+            confirmed = rabbitpy.Message(
+                message.channel, message.body, properties
+            ).publish(
+                self.exchange,
+                routing_key=decoded.payload.instance_id,
+                mandatory=True,
+            )
+            if not confirmed:
+                raise ConnectionError(
+                    f"Broker rejected message for {decoded.payload.instance_id}"
+                )
+            MESSAGES.labels(decoded.event_type, "routed").inc()
+        message.ack()
+
+    def run(
+        self, stopper: QueueStopper, monitor: Optional[HealthMonitor] = None
+    ) -> None:
+        """
+        Routes messages from the queue until the consumer is stopped,
+        tracking them for the health monitor if there is one
+        """
+        logger.info(
+            "Routing messages from %s to %s", stopper.queue.name, self.exchange
+        )
+        stopper.consume(
+            lambda message: self.route(monitor.track(message) if monitor else message)
+        )
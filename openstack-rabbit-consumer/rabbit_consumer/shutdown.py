@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file stops the consume loops between messages, e.g. on SIGTERM during
+a rollout, so a message is never interrupted part way through its handler
+"""
+import logging
+import signal
+import threading
+from typing import Callable, List
+
+import rabbitpy
+
+logger = logging.getLogger(__name__)
+
+# Set when the consumer should stop, by a signal or as a consume loop ended
+_stopping = threading.Event()
+
+
+def request_stop() -> None:
+    """
+    Asks every consume loop to stop once its current message is handled
+    """
+    _stopping.set()
+
+
+def reset_stop() -> None:
+    """
+    Clears a previous stop request, so a new consumer can be started
+    """
+    _stopping.clear()
+
+
+def _stop_on_signal(signum: int, _frame) -> None:
+    """
+    Requests a stop. This only sets a flag, as it runs on the main thread
+    part way through whatever that was doing.
+    """
+    logger.info("Received signal %s, stopping the consumer", signum)
+    request_stop()
+
+
+def stop_on_sigterm() -> None:
+    """
+    Stops the consumer on SIGTERM. Each consume loop stops between messages,
+    then the consumer's clean-up finishes in-flight messages and flushes
+    queued acks and makes. This must be called from the main thread.
+    """
+    signal.signal(signal.SIGTERM, _stop_on_signal)
+
+
+class QueueStopper:
+    """
+    Consumes a queue until a stop is requested. Whilst each message is
+    handled a lock is held, so the queue is only cancelled between messages.
+    """
+
+    def __init__(self, queue: rabbitpy.Queue):
+        self.queue = queue
+        self._busy = threading.Lock()
+
+    def consume(self, handle: Callable[[rabbitpy.Message], None]) -> None:
+        """
+        Handles messages from the queue, stopping before the next one once a
+        stop is requested. That message is left unacked, so it is
+        redelivered once the channel closes.
+        """
+        for message in self.queue:
+            with self._busy:
+                if _stopping.is_set():
+                    self._cancel()
+                    return
+                handle(message)
+
+    def stop(self) -> None:
+        """
+        Cancels the queue once the message being handled, if any, is done.
+        This wakes a loop which is waiting for its next message.
+        """
+        with self._busy:
+            self._cancel()
+
+    def _cancel(self) -> None:
+        if not self.queue.consuming:
+            return
+        try:
+            self.queue.stop_consuming()
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The channel may already be closed, which also stops the loop
+            logger.exception("Failed to stop consuming %s", self.queue.name)
+
+
+def stop_when_requested(stoppers: List[QueueStopper]) -> threading.Thread:
+    """
+    Starts a thread which stops each queue once a stop is requested. Join
+    it after requesting a stop, so no more messages are handled.
+    """
+
+    def watch() -> None:
+        _stopping.wait()
+        for stopper in stoppers:
+            stopper.stop()
+
+    thread = threading.Thread(target=watch, name="shutdown", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines a local SQLite store recording the Aquilon machine and
+host created for each VM, so deletes can skip looking them up, and the
+IDs of processed messages, so redelivered messages can be skipped
+"""
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+
+logger = logging.getLogger(__name__)
+
+# How often old message IDs are pruned, in seconds
+_PRUNE_INTERVAL = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vms (
+    instance_id TEXT PRIMARY KEY,
+    machine_name TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    address TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vms_hostname ON vms (hostname);
+CREATE TABLE IF NOT EXISTS processed_messages (
+    message_id TEXT PRIMARY KEY,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_messages_age
+    ON processed_messages (processed_at);
+"""
+
+
+@dataclass
+class VmRecord:
+    """
+    The Aquilon records created for a VM
+    """
+
+    instance_id: str
+    machine_name: str
+    hostname: str
+    address: str
+    state: str
+
+
+class StateStore:
+    """
+    Durable store shared by all worker threads. A single connection is
+    used under a lock, as SQLite only allows one writer at a time anyway.
+    """
+
+    CREATED = "created"
+    DELETED = "deleted"
+    # Another VM has since been created with the same hostname
+    SUPERSEDED = "superseded"
+
+    def __init__(self, path: str, dedupe_ttl: float):
+        self.dedupe_ttl = dedupe_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps commits cheap whilst surviving a crash of the consumer
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._last_prune = 0.0
+        self.prune_processed()
+        logger.info("Opened state store at %s", path)
+
+    def record_created(
+        self, instance_id: str, machine_name: str, hostname: str, address: str
+    ) -> None:
+        """
+        Records the machine and host created in Aquilon for a VM. Any other
+        VM still holding the hostname has had its host replaced, so its
+        records are dropped rather than deleting the new host later.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE vms SET state = ?, updated_at = ? "
+                "WHERE hostname = ? AND instance_id != ? AND state = ?",
+                (self.SUPERSEDED, time.time(), hostname, instance_id, self.CREATED),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO vms VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    instance_id,
+                    machine_name,
+                    hostname,
+                    address,
+                    self.CREATED,
+                    time.time(),
+                ),
+            )
+
+    def record_deleted(self, instance_id: str) -> None:
+        """
+        Marks the records for a VM as removed from Aquilon
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE vms SET state = ?, updated_at = ? WHERE instance_id = ?",
+                (self.DELETED, time.time(), instance_id),
+            )
+
+    def get_vm(self, instance_id: str) -> Optional[VmRecord]:
+        """
+        Returns the records for a VM if they are still in Aquilon
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT instance_id, machine_name, hostname, address, state "
+                "FROM vms WHERE instance_id = ? AND state = ?",
+                (instance_id, self.CREATED),
+            ).fetchone()
+        return VmRecord(*row) if row else None
+
+    def is_processed(self, message_id: str) -> bool:
+        """
+        Returns True if the message has already been handled
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM processed_messages WHERE message_id = ?",
+                (message_id,),
+            ).fetchone()
+        return row is not None
+
+    def mark_processed(self, message_id: str) -> None:
+        """
+        Records that a message has been handled, pruning old IDs periodically
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO processed_messages VALUES (?, ?)",
+                (message_id, time.time()),
+            )
+        if time.monotonic() - self._last_prune > _PRUNE_INTERVAL:
+            self.prune_processed()
+
+    def prune_processed(self) -> int:
+        """
+        Removes message IDs older than the dedupe TTL, as redeliveries
+        only happen shortly after a message is first received.
+        Returns the number removed.
+        """
+        self._last_prune = time.monotonic()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM processed_messages WHERE processed_at < ?",
+                (time.time() - self.dedupe_ttl,),
+            )
+        return cursor.rowcount
+
+    def close(self) -> None:
+        """
+        Closes the database connection
+        """
+        with self._lock:
+            self._conn.close()
+
+
+_state_store: Optional[StateStore] = None  # pylint: disable=invalid-name
+_state_store_loaded = False  # pylint: disable=invalid-name
+_state_store_lock = threading.Lock()
+
+
+def get_state_store() -> Optional[StateStore]:
+    """
+    Returns the shared state store, opening it on first use,
+    or None if no database path is configured
+    """
+    # pylint: disable=global-statement
+    global _state_store, _state_store_loaded
+    with _state_store_lock:
+        if not _state_store_loaded:
+            config = ConsumerConfig()
+            if config.state_db_path:
+                _state_store = StateStore(config.state_db_path, config.state_dedupe_ttl)
+            _state_store_loaded = True
+        return _state_store
+
+
+def close_state_store() -> None:
+    """
+    Closes the shared state store, it is re-opened on next use
+    """
+    # pylint: disable=global-statement
+    global _state_store, _state_store_loaded
+    with _state_store_lock:
+        if _state_store is not None:
+            _state_store.close()
+        _state_store = None
+        _state_store_loaded = False
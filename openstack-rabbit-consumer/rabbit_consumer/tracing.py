@@ -0,0 +1,170 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file records a trace of nested, timed spans for each message, and
+logs the full trace as a JSON line when a message is slow to handle
+"""
+import contextvars
+import functools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+
+logger = logging.getLogger(__name__)
+
+_Func = TypeVar("_Func", bound=Callable)
+
+
+@dataclass
+class Span:
+    """
+    A timed stage of handling a message, with any stages nested within it
+    """
+
+    name: str
+    start: float = field(default_factory=time.monotonic)
+    duration: Optional[float] = None
+    error: Optional[str] = None
+    children: List["Span"] = field(default_factory=list)
+
+    def finish(self) -> None:
+        """
+        Records the duration of the span, if it hasn't already finished
+        """
+        if self.duration is None:
+            self.duration = time.monotonic() - self.start
+
+    def to_dict(self, trace_start: float) -> Dict:
+        """
+        Returns the span and its children, with offsets from the trace start
+        """
+        as_dict = {
+            "name": self.name,
+            "offset": round(self.start - trace_start, 4),
+            "duration": round(self.duration, 4) if self.duration is not None else None,
+        }
+        if self.error:
+            as_dict["error"] = self.error
+        if self.children:
+            as_dict["spans"] = [i.to_dict(trace_start) for i in self.children]
+        return as_dict
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """
+    Times a stage as a child of the current span. This does nothing if
+    no message is being traced, e.g. when called from the tests.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as err:
+        child.error = type(err).__name__
+        raise
+    finally:
+        child.finish()
+        _current_span.reset(token)
+
+
+def traced(name: Optional[str] = None) -> Callable[[_Func], _Func]:
+    """
+    Decorates a function to record each call as a span,
+    named after the function unless a name is given
+    """
+
+    def decorator(func: _Func) -> _Func:
+        span_name = name if name else func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=1)
+def get_slow_message_threshold() -> float:
+    """
+    Returns the configured slow message threshold, read once as
+    building the config is too slow to do for every message
+    """
+    return ConsumerConfig().slow_message_threshold
+
+
+class MessageTrace:
+    """
+    The trace for a single message. This is started when the message is
+    received, and can be activated on whichever thread handles it.
+    """
+
+    def __init__(self, name: str = "message"):
+        self.root = Span(name)
+        self.fields: Dict[str, str] = {}
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Returns the seconds since the message was received
+        """
+        return time.monotonic() - self.root.start
+
+    @contextmanager
+    def activate(self) -> Iterator["MessageTrace"]:
+        """
+        Makes this the current trace, so spans on this thread are added to it
+        """
+        token = _current_span.set(self.root)
+        try:
+            yield self
+        finally:
+            _current_span.reset(token)
+
+    def finish(self, threshold: Optional[float] = None) -> bool:
+        """
+        Ends the trace, logging it as a single JSON line if it took at
+        least the threshold. Returns True if the trace was logged.
+        """
+        self.root.finish()
+        threshold = threshold if threshold is not None else get_slow_message_threshold()
+        if threshold <= 0 or self.root.duration < threshold:
+            return False
+
+        logger.warning(
+            json.dumps(
+                {
+                    "slow_message": True,
+                    **self.fields,
+                    **self.root.to_dict(self.root.start),
+                }
+            )
+        )
+        return True
+
+
+def run_in_context(func: Callable, *args, **kwargs):
+    """
+    Returns a callable which runs the function in a copy of the current
+    context, so spans started on another thread join the current trace
+    """
+    return functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
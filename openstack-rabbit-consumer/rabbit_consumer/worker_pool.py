@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines a pool of worker threads used to handle messages
+concurrently, whilst keeping messages for the same VM in order, and
+a pool split into lanes so cheap deletes aren't queued behind creates
+"""
+import logging
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from rabbit_consumer.metrics import LANE_QUEUED, LANE_WAIT
+from rabbit_consumer.shutdown import request_stop
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedWorkerPool:
+    """
+    Runs tasks on a fixed set of worker threads, where each worker has its
+    own queue. Tasks are sharded by key, so all tasks for a given key run on
+    the same worker in the order they were submitted, whilst tasks for
+    different keys run in parallel. Once a task fails, the consumer is
+    asked to stop and the remaining tasks are skipped.
+    """
+
+    def __init__(self, num_workers: int, name: str = "consumer"):
+        if num_workers < 1:
+            raise ValueError("The worker pool needs at least one worker")
+
+        self.num_workers = num_workers
+        self.error: Optional[BaseException] = None
+
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(num_workers)]
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(work_queue,),
+                name=f"{name}-worker-{i}",
+                daemon=True,
+            )
+            for i, work_queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info("Started %s %s workers", num_workers, name)
+
+    def get_shard(self, key: str) -> int:
+        """
+        Returns the index of the worker which handles the given key
+        """
+        return zlib.crc32(key.encode("utf-8")) % self.num_workers
+
+    def submit(
+        self,
+        key: str,
+        task: Callable[[], None],
+        on_skip: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Queues a task to run on the worker for the given key, calling
+        on_skip instead if it is skipped as an earlier task failed.
+        If a previous task has failed, its error is raised instead.
+        """
+        if self.error:
+            raise self.error
+        self._queues[self.get_shard(key)].put((task, on_skip))
+
+    def shutdown(self) -> None:
+        """
+        Waits for all queued tasks to finish, then stops the workers
+        """
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, work_queue: queue.Queue) -> None:
+        """
+        Runs tasks from the given queue until a None sentinel is received
+        """
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            task, on_skip = item
+            if self.error:
+                # Stop handling further messages once one has failed, so
+                # later messages for the same VM aren't handled out of order
+                if on_skip:
+                    on_skip()
+                continue
+
+            try:
+                task()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                # The message is left unacked, so it will be redelivered
+                # once the consumer restarts
+                logger.exception("Worker failed to handle message")
+                if not self.error:
+                    self.error = err
+                    request_stop()
+
+
+class LanedWorkerPool:
+    """
+    Runs tasks in separate lanes, each a sharded pool with its own workers,
+    so a burst of slow tasks in one lane doesn't hold up the others. Lanes
+    may share a pool. Whilst a VM has tasks queued or running in one lane,
+    its later tasks join that lane too, so they still run in order.
+    """
+
+    def __init__(self, lanes: Dict[str, ShardedWorkerPool]):
+        self.lanes = lanes
+        self._lock = threading.Lock()
+        # The lane and number of outstanding tasks for each key
+        self._outstanding: Dict[str, Tuple[str, int]] = {}
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        """
+        Returns the first error raised by a task in any lane
+        """
+        return next((i.error for i in self.lanes.values() if i.error), None)
+
+    def submit(self, lane: str, key: str, task: Callable[[], None]) -> str:
+        """
+        Queues a task in the given lane, unless the key already has tasks
+        outstanding in another lane. Returns the lane the task was queued in.
+        """
+        with self._lock:
+            current_lane, count = self._outstanding.get(key, (lane, 0))
+            self._outstanding[key] = (current_lane, count + 1)
+
+        if current_lane != lane:
+            logger.debug("Queueing %s behind its earlier %s task", key, current_lane)
+        LANE_QUEUED.labels(current_lane).inc()
+        queued_at = time.monotonic()
+
+        def finish() -> None:
+            LANE_QUEUED.labels(current_lane).dec()
+            self._finish(key)
+
+        def run() -> None:
+            LANE_WAIT.labels(current_lane).observe(time.monotonic() - queued_at)
+            try:
+                task()
+            finally:
+                finish()
+
+        try:
+            self.lanes[current_lane].submit(key, run, on_skip=finish)
+        except BaseException:
+            finish()
+            raise
+        return current_lane
+
+    def shutdown(self) -> None:
+        """
+        Waits for all queued tasks in every lane to finish, then stops the workers
+        """
+        for pool in {id(i): i for i in self.lanes.values()}.values():
+            pool.shutdown()
+
+    def _finish(self, key: str) -> None:
+        with self._lock:
+            lane, count = self._outstanding[key]
+            if count > 1:
+                self._outstanding[key] = (lane, count - 1)
+            else:
+                del self._outstanding[key]
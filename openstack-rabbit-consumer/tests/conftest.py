@@ -4,15 +4,59 @@
 Fixtures for unit tests, used to create mock objects
 """
 import uuid
+from unittest.mock import NonCallableMock
 
 import pytest
 
+from rabbit_consumer.aq_api import close_aq_client
 from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.circuit_breaker import reset_breakers
+from rabbit_consumer.concurrency_limiter import reset_limiters
+from rabbit_consumer.dns_resolver import reset_dns_resolver
+from rabbit_consumer.health import stop_health_monitor
+from rabbit_consumer.image_cache import reset_image_cache
+from rabbit_consumer.kerberos_ticket import reset_ticket_cache
+from rabbit_consumer.make_batcher import stop_make_batcher
+from rabbit_consumer.openstack_api import close_openstack_connection
 from rabbit_consumer.openstack_address import OpenstackAddress
 from rabbit_consumer.rabbit_message import RabbitMessage, RabbitMeta, RabbitPayload
+from rabbit_consumer.server_snapshot import ServerSnapshot
+from rabbit_consumer.shutdown import reset_stop
+from rabbit_consumer.state_store import close_state_store
 from rabbit_consumer.vm_data import VmData
 
 
+@pytest.fixture(autouse=True)
+def fixture_reset_shared_clients():
+    """
+    Drops any long-lived clients between tests, so a mock session
+    from one test is not re-used by the next
+    """
+    close_aq_client()
+    reset_ticket_cache()
+    close_openstack_connection()
+    reset_image_cache()
+    reset_dns_resolver()
+    close_state_store()
+    stop_make_batcher()
+    reset_limiters()
+    reset_breakers()
+    stop_health_monitor()
+    reset_stop()
+    yield
+    close_aq_client()
+    reset_ticket_cache()
+    close_openstack_connection()
+    reset_image_cache()
+    reset_dns_resolver()
+    close_state_store()
+    stop_make_batcher()
+    reset_limiters()
+    reset_breakers()
+    stop_health_monitor()
+    reset_stop()
+
+
 @pytest.fixture(name="image_metadata")
 def fixture_image_metadata():
     """
@@ -61,6 +105,14 @@ def fixture_vm_data():
     )
 
 
+@pytest.fixture(name="server_snapshot")
+def fixture_server_snapshot(vm_data):
+    """
+    Creates a ServerSnapshot object holding a mock server
+    """
+    return ServerSnapshot(vm_data=vm_data, server=NonCallableMock())
+
+
 @pytest.fixture(name="openstack_address")
 def fixture_openstack_address():
     """
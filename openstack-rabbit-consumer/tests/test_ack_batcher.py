@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that acks are batched into cumulative acks in delivery order
+"""
+from unittest.mock import NonCallableMock, call
+
+import pytest
+
+from rabbit_consumer.ack_batcher import AckBatcher
+
+
+def _messages(count: int):
+    messages = []
+    for tag in range(1, count + 1):
+        message = NonCallableMock()
+        message.delivery_tag = tag
+        messages.append(message)
+    return messages
+
+
+@pytest.fixture(name="batcher")
+def fixture_batcher():
+    """
+    Creates a batcher which only flushes when asked, or when full
+    """
+    batcher = AckBatcher(max_batch=3, interval=3600)
+    yield batcher
+    batcher.stop()
+
+
+def test_acks_when_batch_full(batcher):
+    """
+    Tests that one cumulative ack is sent once the batch is full
+    """
+    messages = _messages(4)
+    tracked = [batcher.track(i) for i in messages]
+
+    for message in tracked[:3]:
+        message.ack()
+
+    messages[2].ack.assert_called_once_with(all_previous=True)
+    messages[0].ack.assert_not_called()
+    messages[1].ack.assert_not_called()
+    assert batcher.flushes == 1
+
+
+def test_waits_for_earlier_messages(batcher):
+    """
+    Tests that the cumulative ack only covers messages where every
+    earlier message has completed
+    """
+    messages = _messages(4)
+    tracked = [batcher.track(i) for i in messages]
+
+    for message in tracked[1:]:
+        message.ack()
+    assert batcher.flushes == 0
+
+    tracked[0].ack()
+    messages[3].ack.assert_called_once_with(all_previous=True)
+
+
+def test_flush_acks_out_of_order_individually(batcher):
+    """
+    Tests that a timed flush acks the completed prefix cumulatively,
+    and later completed messages individually
+    """
+    messages = _messages(4)
+    tracked = [batcher.track(i) for i in messages]
+    tracked[0].ack()
+    tracked[3].ack()
+
+    batcher.flush()
+
+    messages[0].ack.assert_called_once_with(all_previous=True)
+    messages[1].ack.assert_not_called()
+    messages[2].ack.assert_not_called()
+    messages[3].ack.assert_called_once_with()
+
+    # The prefix now continues past the individually acked message
+    tracked[1].ack()
+    tracked[2].ack()
+    batcher.flush()
+    assert messages[2].ack.call_args_list == [call(all_previous=True)]
+
+
+def test_stop_flushes():
+    """
+    Tests that stopping flushes any remaining acks
+    """
+    batcher = AckBatcher(max_batch=10, interval=3600)
+    messages = _messages(2)
+    for message in messages:
+        batcher.track(message).ack()
+
+    batcher.stop()
+    messages[1].ack.assert_called_once_with(all_previous=True)
+
+
+def test_timed_flush():
+    """
+    Tests that a partial batch is flushed by the background thread
+    """
+    batcher = AckBatcher(max_batch=10, interval=0.01)
+    message = _messages(1)[0]
+    batcher.track(message).ack()
+
+    batcher._stopped.wait(0.2)  # pylint: disable=protected-access
+    message.ack.assert_called_once_with(all_previous=True)
+    batcher.stop()
+
+
+def test_wrapper_passes_through(batcher):
+    """
+    Tests that the wrapper exposes the message, but refuses cumulative acks
+    """
+    message = _messages(1)[0]
+    tracked = batcher.track(message)
+
+    assert tracked.body == message.body
+    with pytest.raises(ValueError):
+        tracked.ack(all_previous=True)
@@ -4,16 +4,22 @@
 Tests that we perform the correct REST requests against
 the Aquilon API
 """
+import threading
+from contextlib import suppress
 from unittest import mock
 from unittest.mock import patch, call, NonCallableMock
 
 import pytest
+from requests.exceptions import Timeout
+
+from rabbit_consumer.circuit_breaker import CircuitOpenError
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.aq_api import (
     verify_kerberos_ticket,
     setup_requests,
     aq_make,
+    aq_make_hosts,
     aq_manage,
     create_machine,
     delete_machine,
@@ -24,41 +30,43 @@ from rabbit_consumer.aq_api import (
     AquilonError,
     add_machine_nics,
     search_machine_by_serial,
+    search_machines_by_model,
     search_host_by_machine,
+    get_aq_client,
+    close_aq_client,
+    AquilonClient,
 )
 
 
-def test_verify_kerberos_ticket_valid():
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_verify_kerberos_ticket_valid(ticket_cache):
     """
     Test that verify_kerberos_ticket returns True when the ticket is valid
     """
-    with patch("rabbit_consumer.aq_api.subprocess.call") as mocked_call:
-        # Exit code 0 - i.e. valid ticket
-        mocked_call.return_value = 0
-        assert verify_kerberos_ticket()
-        mocked_call.assert_called_once_with(["klist", "-s"])
+    ticket_cache.return_value.is_valid.return_value = True
+    assert verify_kerberos_ticket()
+    ticket_cache.return_value.is_valid.assert_called_once_with()
 
 
-@patch("rabbit_consumer.aq_api.subprocess.call")
-def test_verify_kerberos_ticket_invalid(subprocess):
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_verify_kerberos_ticket_invalid(ticket_cache):
     """
     Test that verify_kerberos_ticket raises an exception when the ticket is invalid
     """
-    # Exit code 1 - i.e. invalid ticket
-    # Then 0 (kinit), 0 (klist -s)
-    subprocess.side_effect = [1]
+    ticket_cache.return_value.is_valid.return_value = False
 
     with pytest.raises(RuntimeError):
         verify_kerberos_ticket()
 
-    subprocess.assert_called_once_with(["klist", "-s"])
+    ticket_cache.return_value.is_valid.assert_called_once_with()
 
 
+@patch("rabbit_consumer.aq_api.ConsumerConfig")
 @patch("rabbit_consumer.aq_api.requests")
 @patch("rabbit_consumer.aq_api.Retry")
 @patch("rabbit_consumer.aq_api.HTTPAdapter")
 @patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
-def test_setup_requests(verify_kerb, adapter, retry, requests):
+def test_setup_requests(verify_kerb, adapter, retry, requests, config):
     """
     Test that setup_requests sets up the Kerberos ticket and the requests session
     correctly
@@ -75,7 +83,11 @@ def test_setup_requests(verify_kerb, adapter, retry, requests):
 
     verify_kerb.assert_called_once()
     retry.assert_called_once_with(total=5, backoff_factor=0.1, status_forcelist=[503])
-    adapter.assert_called_once_with(max_retries=retry.return_value)
+    adapter.assert_called_once_with(
+        pool_connections=1,
+        pool_maxsize=config.return_value.aq_pool_size,
+        max_retries=retry.return_value,
+    )
     session.mount.assert_called_once_with("https://", adapter.return_value)
 
 
@@ -101,16 +113,85 @@ def test_setup_requests_throws_for_failed(verify_kerb, adapter, retry, requests)
 
     verify_kerb.assert_called_once()
     retry.assert_called_once_with(total=5, backoff_factor=0.1, status_forcelist=[503])
-    adapter.assert_called_once_with(max_retries=retry.return_value)
+    adapter.assert_called_once()
     session.mount.assert_called_once_with("https://", adapter.return_value)
     session.get.assert_called_once()
 
 
+@pytest.mark.parametrize(
+    "status_code,dropped", [(200, False), (400, False), (500, False), (504, True)]
+)
+@patch("rabbit_consumer.aq_api.get_limiter")
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_limited(_, requests, get_limiter, status_code, dropped):
+    """
+    Test that each request holds a slot under the limit, and overloaded
+    responses are reported to the limiter
+    """
+    requests.Session.return_value.get.return_value.status_code = status_code
+    with suppress(AquilonError, ConnectionError):
+        setup_requests("url", "get", "desc")
+
+    get_limiter.assert_called_once_with("aquilon")
+    get_limiter.return_value.limit_call.assert_called_once_with("desc")
+    limited = get_limiter.return_value.limit_call.return_value.__enter__.return_value
+    assert limited.dropped == dropped
+
+
+@patch("rabbit_consumer.aq_api.get_breaker")
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_circuit_open(_, requests, get_breaker):
+    """
+    Test that no request is sent while Aquilon's circuit is open
+    """
+    get_breaker.return_value.protect.side_effect = CircuitOpenError("aquilon", 30)
+    with pytest.raises(CircuitOpenError):
+        setup_requests("url", "get", "desc")
+
+    get_breaker.assert_called_once_with("aquilon")
+    requests.Session.return_value.get.assert_not_called()
+
+
+@pytest.mark.parametrize("status_code,failed", [(400, False), (503, True)])
+@patch("rabbit_consumer.aq_api.get_breaker")
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_records_failure(_, requests, get_breaker, status_code, failed):
+    """
+    Test that overloaded responses count against Aquilon's circuit,
+    whilst other errors show Aquilon is up
+    """
+    requests.Session.return_value.get.return_value.status_code = status_code
+    with suppress(AquilonError, ConnectionError):
+        setup_requests("url", "get", "desc")
+
+    guarded = get_breaker.return_value.protect.return_value.__enter__.return_value
+    assert guarded.failed == failed
+
+
+@patch("rabbit_consumer.aq_api.get_limiter")
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_limited_timeout(_, requests, get_limiter):
+    """
+    Test that timeouts are reported to the limiter as overload
+    """
+    requests.Session.return_value.get.side_effect = Timeout()
+    with pytest.raises(Timeout):
+        setup_requests("url", "get", "desc")
+
+    limited = get_limiter.return_value.limit_call.return_value.__enter__.return_value
+    assert limited.dropped
+
+
 @pytest.mark.parametrize("rest_verb", ["get", "post", "put", "delete"])
+@patch("rabbit_consumer.aq_api.ConsumerConfig")
 @patch("rabbit_consumer.aq_api.requests")
 @patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
 @patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
-def test_setup_requests_rest_methods(_, kerb_auth, requests, rest_verb):
+def test_setup_requests_rest_methods(_, kerb_auth, requests, config, rest_verb):
     """
     Test that setup_requests calls the correct REST method
     """
@@ -123,7 +204,81 @@ def test_setup_requests_rest_methods(_, kerb_auth, requests, rest_verb):
     response.status_code = 200
 
     assert setup_requests(url, rest_verb, desc, params) == response.text
-    rest_method.assert_called_once_with(url, auth=kerb_auth.return_value, params=params)
+    rest_method.assert_called_once_with(
+        url,
+        auth=kerb_auth.return_value,
+        params=params,
+        timeout=(
+            config.return_value.aq_connect_timeout,
+            config.return_value.aq_read_timeout,
+        ),
+    )
+
+
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_reuses_client(_, kerb_auth, requests):
+    """
+    Test that repeated requests share a single session and auth handler
+    """
+    session = requests.Session.return_value
+    session.get.return_value.status_code = 200
+
+    for _ in range(3):
+        setup_requests(NonCallableMock(), "get", NonCallableMock())
+
+    requests.Session.assert_called_once()
+    kerb_auth.assert_called_once()
+    assert session.get.call_count == 3
+
+
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_client_auth_per_thread(kerb_auth, _):
+    """
+    Test that each thread gets its own auth handler, as they aren't thread-safe
+    """
+    kerb_auth.side_effect = NonCallableMock
+    client = AquilonClient()
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(client.auth))
+    thread.start()
+    thread.join()
+
+    main_auth = client.auth
+    assert client.auth is main_auth
+    assert seen[0] is not main_auth
+    assert kerb_auth.call_count == 2
+
+
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+@patch("rabbit_consumer.aq_api.requests")
+@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
+def test_setup_requests_invalidates_ticket_on_401(_, requests, ticket_cache):
+    """
+    Test that an auth failure from Aquilon forces the ticket to be re-checked
+    """
+    requests.Session.return_value.get.return_value.status_code = 401
+
+    with pytest.raises(ConnectionError):
+        setup_requests(NonCallableMock(), "get", NonCallableMock())
+
+    ticket_cache.return_value.invalidate.assert_called_once_with()
+
+
+@patch("rabbit_consumer.aq_api.requests")
+def test_close_aq_client(requests):
+    """
+    Test that closing the client closes the session and a new one is
+    created on the next use
+    """
+    first = get_aq_client()
+    close_aq_client()
+
+    requests.Session.return_value.close.assert_called_once()
+    assert get_aq_client() is not first
+    assert requests.Session.call_count == 2
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
@@ -161,6 +316,34 @@ def test_aq_make_aquilon_error(config, setup, openstack_address_list):
     setup.assert_called_once_with(expected_url, "post", mock.ANY)
 
 
+@patch("rabbit_consumer.aq_api.setup_requests")
+@patch("rabbit_consumer.aq_api.ConsumerConfig")
+def test_aq_make_hosts(config, setup):
+    """
+    Test that aq_make_hosts reconfigures every host in one request
+    """
+    domain = "domain"
+    config.return_value.aq_url = domain
+
+    aq_make_hosts(["host1", "host2"])
+
+    setup.assert_called_once_with(
+        f"{domain}/host/command/reconfigure_list",
+        "post",
+        mock.ANY,
+        params={"list": "host1\nhost2"},
+    )
+
+
+@patch("rabbit_consumer.aq_api.setup_requests")
+def test_aq_make_hosts_empty(setup):
+    """
+    Test that aq_make_hosts doesn't send a request without any hosts
+    """
+    aq_make_hosts([])
+    setup.assert_not_called()
+
+
 @pytest.mark.parametrize("hostname", ["  ", "", None])
 @patch("rabbit_consumer.aq_api.setup_requests")
 @patch("rabbit_consumer.aq_api.ConsumerConfig")
@@ -441,6 +624,42 @@ def test_search_machine_by_serial_not_found(config, setup, vm_data):
     assert response is None
 
 
+@patch("rabbit_consumer.aq_api.setup_requests")
+@patch("rabbit_consumer.aq_api.ConsumerConfig")
+def test_search_machines_by_model(config, setup):
+    """
+    Test that all machines of a model are found in one search, keyed by serial
+    """
+    config.return_value.aq_url = "https://example.com"
+    setup.return_value = (
+        "Virtual_machine: vm-1\n"
+        "  Primary Name: host1.example.com [10.0.0.1]\n"
+        "  Serial: serial-1\n"
+        "Virtual_machine: vm-2\n"
+        "  Serial: serial-2\n"
+        "Virtual_machine: vm-3\n"
+    )
+    response = search_machines_by_model("vm-openstack")
+
+    expected_url = "https://example.com/find/machine?fullinfo"
+    expected_args = {"model": "vm-openstack"}
+    setup.assert_called_once_with(expected_url, "get", mock.ANY, params=expected_args)
+    assert response == {"serial-1": "vm-1", "serial-2": "vm-2"}
+
+
+@patch("rabbit_consumer.aq_api.setup_requests")
+@patch("rabbit_consumer.aq_api.ConsumerConfig")
+def test_search_machines_by_model_unparsable(config, setup):
+    """
+    Test that output which can't be parsed raises, rather than appearing
+    as if there were no machines
+    """
+    config.return_value.aq_url = "https://example.com"
+    setup.return_value = "Unexpected output"
+    with pytest.raises(ValueError):
+        search_machines_by_model("vm-openstack")
+
+
 @patch("rabbit_consumer.aq_api.setup_requests")
 @patch("rabbit_consumer.aq_api.ConsumerConfig")
 def test_search_host_by_machine(config, setup):
@@ -0,0 +1,276 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that the Aquilon clean-up only makes the lookups
+and deletes which are required
+"""
+from unittest.mock import call, patch
+
+import pytest
+
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.aq_delete_plan import (
+    AqDeletePlan,
+    AqMachineState,
+    fetch_machine_state,
+    plan_deletion,
+    plan_from_record,
+    run_deletion_plan,
+)
+from rabbit_consumer.message_consumer import delete_machine
+from rabbit_consumer.state_store import StateStore, VmRecord
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_fetch_machine_state_no_machine(aq_api, vm_data):
+    """
+    Tests that the machine lookups are skipped if no machine is found
+    """
+    aq_api.check_host_exists.return_value = True
+    aq_api.search_machine_by_serial.return_value = None
+
+    state = fetch_machine_state(vm_data, "host.example.com")
+
+    assert state == AqMachineState(hostname="host.example.com", hostname_exists=True)
+    aq_api.check_host_exists.assert_called_once_with("host.example.com")
+    aq_api.search_machine_by_serial.assert_called_once_with(vm_data)
+    aq_api.search_host_by_machine.assert_not_called()
+    aq_api.get_machine_details.assert_not_called()
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_fetch_machine_state_with_machine(aq_api, vm_data):
+    """
+    Tests that the machine's host and details are looked up once found
+    """
+    aq_api.check_host_exists.return_value = False
+    aq_api.search_machine_by_serial.return_value = "machine"
+    aq_api.search_host_by_machine.return_value = "other.example.com"
+    aq_api.get_machine_details.return_value = "details"
+
+    state = fetch_machine_state(vm_data, "host.example.com")
+
+    assert state == AqMachineState(
+        hostname="host.example.com",
+        hostname_exists=False,
+        machine_name="machine",
+        machine_host="other.example.com",
+        machine_details="details",
+    )
+    aq_api.search_host_by_machine.assert_called_once_with("machine")
+    aq_api.get_machine_details.assert_called_once_with("machine")
+
+
+@patch("rabbit_consumer.aq_delete_plan.run_in_context")
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_fetch_machine_state_in_trace(aq_api, run_in_context, vm_data):
+    """
+    Tests that lookups on the executor run in the message's trace context
+    """
+    run_in_context.side_effect = lambda func, *args: lambda: func(*args)
+    aq_api.search_machine_by_serial.return_value = "machine"
+
+    fetch_machine_state(vm_data, None)
+
+    run_in_context.assert_has_calls(
+        [
+            call(aq_api.search_machine_by_serial, vm_data),
+            call(aq_api.get_machine_details, "machine"),
+        ]
+    )
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_fetch_machine_state_no_hostname(aq_api, vm_data):
+    """
+    Tests that the host check is skipped without a hostname
+    """
+    aq_api.search_machine_by_serial.return_value = None
+
+    assert not fetch_machine_state(vm_data, None).hostname_exists
+    aq_api.check_host_exists.assert_not_called()
+
+
+def test_plan_deletion_hostname_only():
+    """
+    Tests that only the host is deleted if no machine is found
+    """
+    state = AqMachineState(hostname="host.example.com", hostname_exists=True)
+    assert plan_deletion(state) == AqDeletePlan(hosts=["host.example.com"])
+
+
+def test_plan_deletion_nothing_found():
+    """
+    Tests that nothing is deleted if no records are found
+    """
+    assert plan_deletion(AqMachineState(hostname="host.example.com")) == AqDeletePlan()
+
+
+def test_plan_deletion_same_host():
+    """
+    Tests that a machine pointing at the message host only deletes it once
+    """
+    state = AqMachineState(
+        hostname="host.example.com",
+        hostname_exists=True,
+        machine_name="machine",
+        machine_host="host.example.com",
+        machine_details="eth0: 127.0.0.1",
+    )
+    assert plan_deletion(state) == AqDeletePlan(
+        hosts=["host.example.com"], machine_name="machine"
+    )
+
+
+def test_plan_deletion_different_host():
+    """
+    Tests that a machine pointing at another host has that host deleted
+    without checking it exists again
+    """
+    state = AqMachineState(
+        hostname="host.example.com",
+        hostname_exists=True,
+        machine_name="machine",
+        machine_host="other.example.com",
+    )
+    assert plan_deletion(state) == AqDeletePlan(
+        hosts=["host.example.com", "other.example.com"], machine_name="machine"
+    )
+
+
+@patch("rabbit_consumer.aq_delete_plan.get_dns_resolver")
+def test_plan_deletion_stale_host(resolver):
+    """
+    Tests that the address and interface are removed when the machine
+    points at a host which no longer exists
+    """
+    ip_address = "127.0.0.1"
+    resolver.return_value.get_address.return_value = ip_address
+    state = AqMachineState(
+        hostname="host.example.com",
+        machine_name="machine",
+        machine_host="host.example.com",
+        machine_details=f"eth0: {ip_address}",
+    )
+
+    assert plan_deletion(state) == AqDeletePlan(
+        address=ip_address, delete_interface=True, machine_name="machine"
+    )
+    resolver.return_value.get_address.assert_called_once_with("host.example.com")
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_run_deletion_plan_order(aq_api):
+    """
+    Tests that the deletes are run in the order Aquilon requires
+    """
+    plan = AqDeletePlan(
+        hosts=["a.example.com", "b.example.com"],
+        address="127.0.0.1",
+        delete_interface=True,
+        machine_name="machine",
+    )
+    run_deletion_plan(plan)
+
+    assert aq_api.mock_calls == [
+        call.delete_host("a.example.com"),
+        call.delete_host("b.example.com"),
+        call.delete_address("127.0.0.1", "machine"),
+        call.delete_interface("machine"),
+        call.delete_machine("machine"),
+    ]
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_run_deletion_plan_empty(aq_api):
+    """
+    Tests that an empty plan makes no calls
+    """
+    run_deletion_plan(AqDeletePlan())
+    assert not aq_api.mock_calls
+
+
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_plan_from_record(aq_api):
+    """
+    Tests that a stored record plans the host then machine deletes
+    """
+    aq_api.search_host_by_machine.return_value = "host"
+    record = VmRecord("instance", "machine", "host", "10.0.0.1", StateStore.CREATED)
+    plan = plan_from_record(record)
+
+    aq_api.search_host_by_machine.assert_called_once_with("machine")
+    assert plan == AqDeletePlan(hosts=["host"], machine_name="machine")
+
+
+@pytest.mark.parametrize("machine_host", [None, "other"])
+@patch("rabbit_consumer.aq_delete_plan.aq_api")
+def test_plan_from_record_host_moved(aq_api, machine_host):
+    """
+    Tests that a record is not trusted once its host has left the machine,
+    e.g. as another VM has taken over the hostname
+    """
+    aq_api.search_host_by_machine.return_value = machine_host
+    record = VmRecord("instance", "machine", "host", "10.0.0.1", StateStore.CREATED)
+    assert plan_from_record(record) is None
+
+
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+@patch("rabbit_consumer.message_consumer.get_state_store")
+def test_delete_machine_uses_stored_records(state_store, aq_delete_plan, vm_data):
+    """
+    Tests that stored records are deleted without looking anything up
+    """
+    store = state_store.return_value
+    delete_machine(vm_data)
+
+    store.get_vm.assert_called_once_with(vm_data.virtual_machine_id)
+    aq_delete_plan.plan_from_record.assert_called_once_with(store.get_vm.return_value)
+    aq_delete_plan.run_deletion_plan.assert_called_once_with(
+        aq_delete_plan.plan_from_record.return_value
+    )
+    aq_delete_plan.fetch_machine_state.assert_not_called()
+    store.record_deleted.assert_called_once_with(vm_data.virtual_machine_id)
+
+
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+@patch("rabbit_consumer.message_consumer.get_state_store")
+def test_delete_machine_stale_records(state_store, aq_delete_plan, vm_data):
+    """
+    Tests that records are looked up if the stored ones are out of date
+    """
+    aq_delete_plan.run_deletion_plan.side_effect = [AquilonError(), None]
+    delete_machine(vm_data)
+
+    aq_delete_plan.fetch_machine_state.assert_called_once_with(vm_data, None)
+    aq_delete_plan.run_deletion_plan.assert_called_with(
+        aq_delete_plan.plan_deletion.return_value
+    )
+    state_store.return_value.record_deleted.assert_called_once_with(
+        vm_data.virtual_machine_id
+    )
+
+
+@patch("rabbit_consumer.message_consumer.get_make_batcher")
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+@patch("rabbit_consumer.message_consumer.get_state_store")
+def test_delete_machine_host_moved(state_store, aq_delete_plan, make_batcher, vm_data):
+    """
+    Tests that records whose host has moved to another VM are looked up,
+    without deleting or dropping the make of the recorded host
+    """
+    aq_delete_plan.plan_from_record.return_value = None
+    aq_delete_plan.plan_deletion.return_value.hosts = []
+    delete_machine(vm_data)
+
+    make_batcher.return_value.discard.assert_not_called()
+    aq_delete_plan.fetch_machine_state.assert_called_once_with(vm_data, None)
+    aq_delete_plan.run_deletion_plan.assert_called_once_with(
+        aq_delete_plan.plan_deletion.return_value
+    )
+    aq_delete_plan.run_deletion_plan.assert_called_with(
+        aq_delete_plan.plan_deletion.return_value
+    )
+    state_store.return_value.record_deleted.assert_called_once_with(
+        vm_data.virtual_machine_id
+    )
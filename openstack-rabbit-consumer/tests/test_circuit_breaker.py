@@ -0,0 +1,149 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that circuit breakers open after repeated failures,
+then probe before letting calls through again
+"""
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    get_breaker,
+    reset_breakers,
+)
+
+
+def _fail(breaker: CircuitBreaker, times: int) -> None:
+    for _ in range(times):
+        breaker.allow()
+        breaker.record(True)
+
+
+def test_opens_after_threshold():
+    """
+    Tests that the circuit opens once enough calls in a row fail
+    """
+    breaker = CircuitBreaker("aquilon", failure_threshold=3, reset_timeout=30)
+    _fail(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    _fail(breaker, 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as err:
+        breaker.allow()
+    assert err.value.upstream == "aquilon"
+    assert 0 < err.value.retry_after <= 30
+
+
+def test_success_resets_failures():
+    """
+    Tests that only failures in a row open the circuit
+    """
+    breaker = CircuitBreaker("aquilon", failure_threshold=3, reset_timeout=30)
+    _fail(breaker, 2)
+    breaker.allow()
+    breaker.record(False)
+    _fail(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@patch("rabbit_consumer.circuit_breaker.time")
+def test_probe_closes_circuit(time):
+    """
+    Tests that a single probe is let through once the timeout passes,
+    closing the circuit if it succeeds
+    """
+    time.monotonic.return_value = 100
+    breaker = CircuitBreaker("nova", failure_threshold=1, reset_timeout=30)
+    _fail(breaker, 1)
+
+    time.monotonic.return_value = 131
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.allow()
+
+
+@patch("rabbit_consumer.circuit_breaker.time")
+def test_failed_probe_reopens(time):
+    """
+    Tests that a failed probe opens the circuit for another timeout
+    """
+    time.monotonic.return_value = 100
+    breaker = CircuitBreaker("nova", failure_threshold=5, reset_timeout=30)
+    _fail(breaker, 5)
+
+    time.monotonic.return_value = 131
+    _fail(breaker, 1)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.monotonic.return_value = 150
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+@patch("rabbit_consumer.circuit_breaker.time")
+def test_probe_without_outcome(time):
+    """
+    Tests that another probe is let through if one never reached the upstream
+    """
+    time.monotonic.return_value = 100
+    breaker = CircuitBreaker("nova", failure_threshold=1, reset_timeout=30)
+    _fail(breaker, 1)
+
+    time.monotonic.return_value = 131
+    breaker.allow()
+    breaker.record(None)
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_protect_records_outcome():
+    """
+    Tests that errors only count as failures when marked as failed
+    """
+    breaker = CircuitBreaker("aquilon", failure_threshold=1, reset_timeout=30)
+    with pytest.raises(ValueError):
+        with breaker.protect():
+            raise ValueError()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    with breaker.protect() as guarded:
+        guarded.failed = True
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_disabled_breaker():
+    """
+    Tests that a threshold of 0 never opens the circuit
+    """
+    breaker = CircuitBreaker("aquilon", failure_threshold=0, reset_timeout=30)
+    _fail(breaker, 10)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@patch("rabbit_consumer.circuit_breaker.ConsumerConfig")
+def test_get_breaker(config):
+    """
+    Tests that each upstream has its own shared breaker
+    """
+    config.return_value.circuit_failure_threshold = 3
+    config.return_value.circuit_reset_timeout = 10
+
+    breaker = get_breaker("keystone")
+    assert get_breaker("keystone") is breaker
+    assert get_breaker("nova") is not breaker
+    assert (breaker.failure_threshold, breaker.reset_timeout) == (3, 10)
+
+    reset_breakers()
+    assert get_breaker("keystone") is not breaker
+
+    with pytest.raises(ValueError):
+        get_breaker("unknown")
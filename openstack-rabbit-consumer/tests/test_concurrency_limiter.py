@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that the adaptive concurrency limit grows and shrinks
+with the latency and errors of the calls it limits
+"""
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer.concurrency_limiter import (
+    AdaptiveLimiter,
+    get_limiter,
+    reset_limiters,
+)
+
+
+def _run(limiter: AdaptiveLimiter, calls: int, latency: float = 0.0, name=""):
+    """
+    Runs a full round of concurrent calls, each taking the given latency
+    """
+    held = [limiter.acquire(name) for _ in range(calls)]
+    for call in held:
+        call.started -= latency
+        limiter.release(call)
+
+
+@pytest.mark.parametrize("min_limit,max_limit", [(0, 4), (5, 4)])
+def test_limiter_requires_valid_limits(min_limit, max_limit):
+    """
+    Tests that the limits must be positive and ordered
+    """
+    with pytest.raises(ValueError):
+        AdaptiveLimiter("test", min_limit, max_limit)
+
+
+def test_limiter_starts_at_half_max():
+    """
+    Tests that the limit starts between the min and max
+    """
+    assert AdaptiveLimiter("test", 1, 10).limit == 5
+    assert AdaptiveLimiter("test", 10, 10).limit == 10
+
+
+def test_limit_grows_while_saturated():
+    """
+    Tests that the limit grows whilst at least half of it is in use
+    """
+    limiter = AdaptiveLimiter("test", 1, 10)
+    for _ in range(3):
+        _run(limiter, limiter.limit)
+    assert limiter.limit > 5
+
+    for _ in range(20):
+        _run(limiter, limiter.limit)
+    assert limiter.limit == 10
+
+
+def test_limit_unchanged_when_not_saturated():
+    """
+    Tests that the limit doesn't grow while calls aren't using it
+    """
+    limiter = AdaptiveLimiter("test", 1, 10)
+    for _ in range(10):
+        _run(limiter, 1)
+    assert limiter.limit == 5
+
+
+def test_dropped_call_halves_limit_once():
+    """
+    Tests that a round of dropped calls only halves the limit once
+    """
+    limiter = AdaptiveLimiter("test", 1, 16)
+    held = [limiter.acquire() for _ in range(8)]
+    for call in held:
+        call.dropped = True
+        limiter.release(call)
+
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
+
+
+def test_limit_stays_above_min():
+    """
+    Tests that the limit is never cut below the min
+    """
+    limiter = AdaptiveLimiter("test", 2, 16)
+    for _ in range(5):
+        call = limiter.acquire()
+        call.dropped = True
+        limiter.release(call)
+    assert limiter.limit == 2
+
+
+def test_rising_latency_cuts_limit():
+    """
+    Tests that the limit is cut once latency rises above the tolerance
+    """
+    limiter = AdaptiveLimiter("test", 1, 20, latency_tolerance=2)
+    _run(limiter, 1, latency=0.01)
+    for _ in range(10):
+        _run(limiter, 1, latency=1)
+    assert limiter.limit < 10
+
+
+def test_latency_tracked_per_call():
+    """
+    Tests that a slow call doesn't count as rising latency for a quick one
+    """
+    limiter = AdaptiveLimiter("test", 1, 20, latency_tolerance=2)
+    _run(limiter, 1, latency=0.01, name="search")
+    for _ in range(10):
+        _run(limiter, 1, latency=1, name="make")
+    assert limiter.limit == 10
+
+
+def test_acquire_waits_for_free_slot():
+    """
+    Tests that calls over the limit wait for a slot to be released
+    """
+    limiter = AdaptiveLimiter("test", 1, 1)
+    held = limiter.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.release(limiter.acquire())
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.05)
+    assert not acquired.is_set()
+
+    limiter.release(held)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_limit_call_releases_on_error():
+    """
+    Tests that the slot is released if the call raises
+    """
+    limiter = AdaptiveLimiter("test", 1, 4)
+    with pytest.raises(RuntimeError):
+        with limiter.limit_call():
+            raise RuntimeError()
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize("adaptive,min_limit", [(True, 1), (False, 8)])
+@patch("rabbit_consumer.concurrency_limiter.ConsumerConfig")
+def test_get_limiter(config, adaptive, min_limit):
+    """
+    Tests that the shared limiters are built from the config,
+    with a fixed limit if adaptive concurrency is disabled
+    """
+    config.return_value.adaptive_concurrency = adaptive
+    config.return_value.aq_pool_size = 8
+    config.return_value.concurrency_latency_tolerance = 2
+
+    limiter = get_limiter("aquilon")
+    assert get_limiter("aquilon") is limiter
+    assert (limiter.min_limit, limiter.max_limit) == (min_limit, 8)
+
+    reset_limiters()
+    assert get_limiter("aquilon") is not limiter
+
+
+def test_get_limiter_unknown_api():
+    """
+    Tests that only known APIs have a limiter
+    """
+    with pytest.raises(ValueError):
+        get_limiter("unknown")
@@ -13,6 +13,10 @@ AQ_FIELDS = [
     ("aq_url", "AQ_URL"),
 ]
 
+KERBEROS_FIELDS = [
+    ("krb5_ccname", "KRB5CCNAME"),
+]
+
 OPENSTACK_FIELDS = [
     ("openstack_auth_url", "OPENSTACK_AUTH_URL"),
     ("openstack_compute_url", "OPENSTACK_COMPUTE_URL"),
@@ -29,7 +33,8 @@ RABBIT_FIELDS = [
 
 
 @pytest.mark.parametrize(
-    "config_name,env_var", AQ_FIELDS + OPENSTACK_FIELDS + RABBIT_FIELDS
+    "config_name,env_var",
+    AQ_FIELDS + KERBEROS_FIELDS + OPENSTACK_FIELDS + RABBIT_FIELDS,
 )
 def test_config_gets_os_env_vars(monkeypatch, config_name, env_var):
     """
@@ -38,3 +43,23 @@ def test_config_gets_os_env_vars(monkeypatch, config_name, env_var):
     expected = "MOCK_ENV"
     monkeypatch.setenv(env_var, expected)
     assert getattr(ConsumerConfig(), config_name) == expected
+
+
+@pytest.mark.parametrize(
+    "config_name,env_var,expected",
+    [
+        ("aq_pool_size", "AQ_POOL_SIZE", 4),
+        ("aq_connect_timeout", "AQ_CONNECT_TIMEOUT", 2.5),
+        ("aq_read_timeout", "AQ_READ_TIMEOUT", 60.0),
+        ("krb5_expiry_margin", "KRB5_EXPIRY_MARGIN", 120.0),
+        ("krb5_recheck_interval", "KRB5_RECHECK_INTERVAL", 30.0),
+        ("dns_timeout", "DNS_TIMEOUT", 1.5),
+        ("dns_workers", "DNS_WORKERS", 4),
+    ],
+)
+def test_config_parses_numeric_env_vars(monkeypatch, config_name, env_var, expected):
+    """
+    Test that numeric config values are converted from their environment variables.
+    """
+    monkeypatch.setenv(env_var, str(expected))
+    assert getattr(ConsumerConfig(), config_name) == expected
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that create messages are held back, and cancelled
+by a delete for the same VM within the window
+"""
+import threading
+from unittest.mock import Mock, NonCallableMock
+
+import pytest
+
+from rabbit_consumer.create_debouncer import CreateDebouncer
+from rabbit_consumer.rabbit_message import SUPPORTED_MESSAGE_TYPES
+
+
+def _decoded(event: str, instance_id: str = "instance_id_mock") -> NonCallableMock:
+    decoded = NonCallableMock()
+    decoded.event_type = SUPPORTED_MESSAGE_TYPES.get(event, event)
+    decoded.payload.instance_id = instance_id
+    return decoded
+
+
+@pytest.fixture(name="dispatch")
+def fixture_dispatch():
+    """
+    Provides a dispatch mock which signals each time it is called
+    """
+    dispatch = Mock()
+    dispatch.called_event = threading.Event()
+    dispatch.side_effect = lambda *_: dispatch.called_event.set()
+    return dispatch
+
+
+def test_create_released_after_window(dispatch):
+    """
+    Tests that a create is dispatched once the window has passed
+    """
+    debouncer = CreateDebouncer(0.01, dispatch)
+    message, decoded = Mock(), _decoded("create")
+    debouncer.submit(message, decoded)
+
+    assert dispatch.called_event.wait(5)
+    debouncer.stop()
+    dispatch.assert_called_once_with(message, decoded)
+    message.ack.assert_not_called()
+
+
+def test_delete_cancels_pending_create(dispatch):
+    """
+    Tests that a delete within the window acks the create without
+    handling it, but the delete is still dispatched
+    """
+    debouncer = CreateDebouncer(60, dispatch)
+    create, delete = Mock(), Mock()
+    delete_decoded = _decoded("delete")
+    debouncer.submit(create, _decoded("create"))
+    debouncer.submit(delete, delete_decoded)
+    debouncer.stop()
+
+    create.ack.assert_called_once()
+    dispatch.assert_called_once_with(delete, delete_decoded)
+    assert debouncer.cancelled == 1
+
+
+def test_delete_for_other_vm_does_not_cancel(dispatch):
+    """
+    Tests that a delete for a different VM leaves the create pending
+    """
+    debouncer = CreateDebouncer(60, dispatch)
+    create = Mock()
+    debouncer.submit(create, _decoded("create"))
+    debouncer.submit(Mock(), _decoded("delete", instance_id="other"))
+    debouncer.stop()
+
+    create.ack.assert_not_called()
+    dispatch.assert_called_once()
+    assert debouncer.cancelled == 0
+
+
+def test_other_event_releases_pending_create(dispatch):
+    """
+    Tests that another event for the same VM releases the create first,
+    so messages are still handled in order
+    """
+    debouncer = CreateDebouncer(60, dispatch)
+    create, other = Mock(), Mock()
+    create_decoded, other_decoded = _decoded("create"), _decoded("other")
+    debouncer.submit(create, create_decoded)
+    debouncer.submit(other, other_decoded)
+    debouncer.stop()
+
+    assert dispatch.call_args_list == [
+        ((create, create_decoded),),
+        ((other, other_decoded),),
+    ]
+
+
+def test_repeated_create_releases_first(dispatch):
+    """
+    Tests that a second create releases the first and is held itself
+    """
+    debouncer = CreateDebouncer(60, dispatch)
+    first, second = Mock(), Mock()
+    first_decoded = _decoded("create")
+    debouncer.submit(first, first_decoded)
+    debouncer.submit(second, _decoded("create"))
+    debouncer.stop()
+
+    dispatch.assert_called_once_with(first, first_decoded)
+    second.ack.assert_not_called()
+
+
+def test_stop_leaves_pending_unacked(dispatch):
+    """
+    Tests that creates still pending on stop are neither handled nor acked
+    """
+    debouncer = CreateDebouncer(60, dispatch)
+    message = Mock()
+    debouncer.submit(message, _decoded("create"))
+    debouncer.stop()
+
+    dispatch.assert_not_called()
+    message.ack.assert_not_called()
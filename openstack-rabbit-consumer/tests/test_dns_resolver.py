@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that DNS lookups are cached and bounded by a timeout
+"""
+import socket
+import threading
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.dns_resolver import DnsResolver
+
+
+def _sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture(name="resolver")
+def fixture_resolver():
+    """
+    Provides a resolver with a short timeout, closing it after the test
+    """
+    config = NonCallableMock()
+    config.dns_timeout = 0.5
+    config.dns_cache_ttl = 300
+    config.dns_negative_ttl = 30
+    config.dns_workers = 4
+    resolver = DnsResolver(config)
+    yield resolver
+    resolver.close()
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_get_hostname_is_cached(gethostbyaddr, resolver):
+    """
+    Tests that a hostname is only looked up once
+    """
+    gethostbyaddr.return_value = ("host.example.com", [], [])
+    lookups = "rabbit_consumer_cache_lookups_total"
+    hits = _sample(lookups, cache="dns", result="hit")
+    misses = _sample(lookups, cache="dns", result="miss")
+
+    assert resolver.get_hostname("127.0.0.1") == "host.example.com"
+    assert resolver.get_hostname("127.0.0.1") == "host.example.com"
+
+    gethostbyaddr.assert_called_once_with("127.0.0.1")
+    assert _sample(lookups, cache="dns", result="hit") == hits + 1
+    assert _sample(lookups, cache="dns", result="miss") == misses + 1
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_failed_lookup_is_cached(gethostbyaddr, resolver):
+    """
+    Tests that a missing hostname raises each time, but is only looked up once
+    """
+    gethostbyaddr.side_effect = socket.herror(1, "Unknown host")
+
+    for _ in range(2):
+        with pytest.raises(socket.herror):
+            resolver.get_hostname("127.0.0.1")
+    gethostbyaddr.assert_called_once()
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_cache_expires(gethostbyaddr, resolver):
+    """
+    Tests that an expired lookup is made again
+    """
+    resolver.ttl = 0
+    gethostbyaddr.return_value = ("host.example.com", [], [])
+
+    resolver.get_hostname("127.0.0.1")
+    resolver.get_hostname("127.0.0.1")
+    assert gethostbyaddr.call_count == 2
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_get_hostnames_runs_concurrently(gethostbyaddr, resolver):
+    """
+    Tests that addresses are looked up at the same time, and
+    returned in the order they were requested
+    """
+    barrier = threading.Barrier(2, timeout=5)
+
+    def lookup(ip_addr):
+        # Both lookups must be running for either to pass the barrier
+        barrier.wait()
+        return f"host-{ip_addr}", [], []
+
+    gethostbyaddr.side_effect = lookup
+    assert resolver.get_hostnames(["127.0.0.2", "127.0.0.1"]) == [
+        "host-127.0.0.2",
+        "host-127.0.0.1",
+    ]
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_lookup_timeout(gethostbyaddr, resolver):
+    """
+    Tests that a stuck lookup raises a timeout rather than blocking
+    """
+    release = threading.Event()
+    gethostbyaddr.side_effect = lambda _: release.wait(5)
+    resolver.timeout = 0.01
+    timeouts = _sample("rabbit_consumer_dns_timeouts_total")
+
+    with pytest.raises(socket.timeout):
+        resolver.get_hostname("127.0.0.1")
+    release.set()
+    assert _sample("rabbit_consumer_dns_timeouts_total") == timeouts + 1
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyname")
+def test_get_address(gethostbyname, resolver):
+    """
+    Tests that a hostname is resolved to an address
+    """
+    gethostbyname.return_value = "127.0.0.1"
+    assert resolver.get_address("host.example.com") == "127.0.0.1"
+    gethostbyname.assert_called_once_with("host.example.com")
@@ -0,0 +1,261 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that the consumer's health and lag are reported
+"""
+import json
+import urllib.error
+import urllib.request
+from unittest.mock import Mock, NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.health import (
+    HealthMonitor,
+    get_health_monitor,
+    start_health_server,
+    stop_health_monitor,
+)
+
+
+def _message(tag, channel=1):
+    message = NonCallableMock()
+    message.channel.id = channel
+    message.delivery_tag = tag
+    return message
+
+
+@pytest.fixture(name="monitor")
+def fixture_monitor():
+    """
+    Creates a monitor which checks the queue once an hour
+    """
+    monitor = HealthMonitor(interval=3600)
+    yield monitor
+    monitor.stop()
+
+
+def test_ack_untracks_message(monitor):
+    """
+    Tests that an acked message is no longer unacked, and counts towards the rate
+    """
+    message = _message(1)
+    first = monitor.track(message)
+    monitor.track(_message(2))
+
+    first.ack()
+    message.ack.assert_called_once_with(all_previous=False)
+
+    snapshot = monitor.snapshot()
+    assert snapshot["unacked"] == 1
+    assert snapshot["processing_rate"] > 0
+
+
+def test_cumulative_ack_untracks_earlier_messages(monitor):
+    """
+    Tests that a cumulative ack untracks every message up to its own
+    """
+    messages = [monitor.track(_message(tag)) for tag in range(1, 5)]
+    messages[2].ack(all_previous=True)
+
+    assert monitor.snapshot()["unacked"] == 1
+
+
+def test_cumulative_ack_per_channel(monitor):
+    """
+    Tests that a cumulative ack only untracks messages on its own channel,
+    as delivery tags are only unique per channel
+    """
+    first = monitor.track(_message(1, channel=1))
+    monitor.track(_message(1, channel=2))
+    monitor.track(_message(2, channel=2))
+
+    first.ack(all_previous=True)
+    assert monitor.snapshot()["unacked"] == 2
+
+
+@patch("rabbit_consumer.health.time")
+def test_oldest_unacked_age(time, monitor):
+    """
+    Tests that the age of the oldest unacked message is reported
+    """
+    time.monotonic.return_value = 100
+    first = monitor.track(_message(1))
+    time.monotonic.return_value = 105
+    monitor.track(_message(2))
+
+    time.monotonic.return_value = 110
+    assert monitor.snapshot()["oldest_unacked_seconds"] == 10
+    first.ack()
+    assert monitor.snapshot()["oldest_unacked_seconds"] == 5
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_check_queue_depth(rabbitpy, monitor):
+    """
+    Tests that the depth is fetched with a passive declare, giving the lag
+    """
+    rabbitpy.Queue.return_value.declare.return_value = (30, 1)
+    monitor.queue_names = ("ral.info",)
+    monitor.check()
+
+    rabbitpy.Queue.return_value.declare.assert_called_once_with(passive=True)
+    monitor.track(_message(1)).ack()
+    snapshot = monitor.snapshot()
+    assert snapshot["queue_depth"] == 30
+    # One ack in the last minute
+    assert snapshot["lag_seconds"] == pytest.approx(30 * 60)
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_check_depth_of_each_queue(rabbitpy, monitor):
+    """
+    Tests that the depth covers every queue being consumed
+    """
+    rabbitpy.Queue.return_value.declare.side_effect = [(30, 1), (12, 1)]
+    monitor.queue_names = ("ral.info.shard.0", "ral.info.shard.2")
+    monitor.check()
+
+    assert monitor.snapshot()["queue_depth"] == 42
+    assert monitor.snapshot()["queue"] == "ral.info.shard.0,ral.info.shard.2"
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_check_unreachable_reconnects(rabbitpy, monitor):
+    """
+    Tests that a failed check drops the connection, so the next reconnects
+    """
+    rabbitpy.Connection.return_value.channel.side_effect = ConnectionError()
+    monitor.check()
+    rabbitpy.Connection.return_value.close.assert_called_once_with()
+    assert monitor.snapshot()["queue_depth"] is None
+
+    monitor.check()
+    assert rabbitpy.Connection.call_count == 2
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_ready_once_watching(rabbitpy, monitor):
+    """
+    Tests that the consumer is only ready while watching a reachable queue
+    """
+    rabbitpy.Queue.return_value.declare.return_value = (0, 1)
+    assert not monitor.ready
+
+    monitor.watch("login", "ral.info")
+    monitor.check()
+    rabbitpy.Connection.assert_called_with("login")
+    assert monitor.ready
+
+    monitor.stop()
+    assert not monitor.ready
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_check_consumers_elsewhere(rabbitpy, monitor, caplog):
+    """
+    Tests that a queue consumed elsewhere without consumers is reported,
+    and the consumer isn't ready, without its depth counting towards ours
+    """
+    rabbitpy.Queue.return_value.declare.side_effect = [(5, 1), (7, 1), (9, 0)]
+    monitor.queue_names = ("ral.info",)
+    monitor.consumed_elsewhere = ("ral.info.shard.0", "ral.info.shard.1")
+    monitor.check()
+
+    snapshot = monitor.snapshot()
+    assert snapshot["queue_depth"] == 5
+    assert snapshot["unconsumed_queues"] == ["ral.info.shard.1"]
+    assert "No consumers on ral.info.shard.1" in caplog.text
+    assert (
+        REGISTRY.get_sample_value(
+            "rabbit_consumer_queue_consumers", {"queue": "ral.info.shard.1"}
+        )
+        == 0
+    )
+
+
+@patch("rabbit_consumer.health.rabbitpy")
+def test_not_ready_without_consumers(rabbitpy, monitor):
+    """
+    Tests that the consumer isn't ready until every watched queue has a consumer
+    """
+    rabbitpy.Queue.return_value.declare.return_value = (0, 0)
+    monitor.watch("login", "ral.info")
+    monitor.check()
+    assert not monitor.ready
+
+    rabbitpy.Queue.return_value.declare.return_value = (0, 1)
+    monitor.check()
+    assert monitor.ready
+
+
+def test_health_server(monitor):
+    """
+    Tests that the lag is served as JSON, with 503 until ready
+    """
+    server = start_health_server(monitor, 0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{url}/healthz") as response:
+            assert json.load(response) == {"alive": True}
+
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(  # pylint: disable=consider-using-with
+                f"{url}/readyz"
+            )
+        assert err.value.code == 503
+        assert json.load(err.value)["ready"] is False
+
+        with patch.object(HealthMonitor, "ready", True):
+            with urllib.request.urlopen(f"{url}/readyz") as response:
+                assert json.load(response)["ready"] is True
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@patch("rabbit_consumer.health.start_health_server")
+@patch("rabbit_consumer.health.ConsumerConfig")
+def test_get_health_monitor(config, start_server):
+    """
+    Tests that the shared monitor is only served when a port is configured
+    """
+    config.return_value.health_port = 0
+    assert get_health_monitor() is None
+
+    stop_health_monitor()
+    config.return_value.health_port = 8080
+    config.return_value.health_interval = 5
+    monitor = get_health_monitor()
+    assert monitor.interval == 5
+    assert get_health_monitor() is monitor
+    start_server.assert_called_once_with(monitor, 8080)
+
+    stop_health_monitor()
+    start_server.return_value.shutdown.assert_called_once_with()
+
+
+def test_unknown_path(monitor):
+    """
+    Tests that other paths are not found
+    """
+    server = start_health_server(monitor, 0)
+    try:
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(  # pylint: disable=consider-using-with
+                f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            )
+        assert err.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_tracked_message_passes_through(monitor):
+    """
+    Tests that the wrapper passes everything else to the message
+    """
+    message = _message(1)
+    message.body = Mock()
+    assert monitor.track(message).body is message.body
@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the LRU cache of Openstack images and their Aquilon metadata
+"""
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.image_cache import ImageCache
+
+
+@pytest.fixture(name="config")
+def fixture_config():
+    """
+    Provides a config for a small image cache
+    """
+    config = NonCallableMock()
+    config.image_cache_size = 2
+    config.image_cache_ttl = 60
+    return config
+
+
+def _sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, {"cache": "image", **labels}) or 0
+
+
+def _image(uuid: str) -> NonCallableMock:
+    image = NonCallableMock()
+    image.id = uuid
+    image.metadata = {
+        "AQ_ARCHETYPE": "archetype",
+        "AQ_DOMAIN": "domain",
+        "AQ_PERSONALITY": "personality",
+        "AQ_OS": "os",
+        "AQ_OSVERSION": "os_version",
+    }
+    return image
+
+
+def test_image_cache_hit_and_miss(config):
+    """
+    Tests that cached images are returned and counted
+    """
+    cache = ImageCache(config)
+    image = _image("uuid-1")
+    hits = _sample("rabbit_consumer_cache_lookups_total", result="hit")
+    misses = _sample("rabbit_consumer_cache_lookups_total", result="miss")
+
+    assert cache.get("uuid-1") is None
+    cache.put("uuid-1", image)
+    assert cache.get("uuid-1") == image
+
+    assert _sample("rabbit_consumer_cache_lookups_total", result="hit") == hits + 1
+    assert _sample("rabbit_consumer_cache_lookups_total", result="miss") == misses + 1
+    assert len(cache) == 1
+
+
+def test_image_cache_evicts_least_recently_used(config):
+    """
+    Tests that the least recently used image is evicted when full
+    """
+    cache = ImageCache(config)
+    evictions = _sample("rabbit_consumer_cache_evictions_total")
+    cache.put("uuid-1", _image("uuid-1"))
+    cache.put("uuid-2", _image("uuid-2"))
+
+    # Touch the first entry, so the second is now the oldest
+    cache.get("uuid-1")
+    cache.put("uuid-3", _image("uuid-3"))
+
+    assert cache.get("uuid-1")
+    assert cache.get("uuid-2") is None
+    assert cache.get("uuid-3")
+    assert _sample("rabbit_consumer_cache_evictions_total") == evictions + 1
+
+
+@patch("rabbit_consumer.image_cache.time.monotonic")
+def test_image_cache_expires_entries(monotonic, config):
+    """
+    Tests that entries older than the TTL are treated as a miss
+    """
+    cache = ImageCache(config)
+    monotonic.return_value = 100
+    cache.put("uuid-1", _image("uuid-1"))
+
+    monotonic.return_value = 159
+    assert cache.get("uuid-1")
+
+    monotonic.return_value = 160
+    assert cache.get("uuid-1") is None
+    assert not cache
+
+
+def test_image_cache_disabled(config):
+    """
+    Tests that a size of 0 disables the cache
+    """
+    config.image_cache_size = 0
+    cache = ImageCache(config)
+    cache.put("uuid-1", _image("uuid-1"))
+    assert cache.get("uuid-1") is None
+
+
+@patch("rabbit_consumer.image_cache.AqMetadata")
+def test_get_aq_metadata_parses_once(aq_metadata, config):
+    """
+    Tests that the Aquilon metadata is only parsed once for a cached image
+    """
+    cache = ImageCache(config)
+    image = _image("uuid-1")
+    cache.put("uuid-1", image)
+
+    with patch("rabbit_consumer.image_cache.dataclasses.replace") as replace:
+        first = cache.get_aq_metadata(image)
+        second = cache.get_aq_metadata(image)
+
+    aq_metadata.from_dict.assert_called_once_with(image.metadata)
+    assert first == second == replace.return_value
+
+
+def test_get_aq_metadata_returns_copy(config):
+    """
+    Tests that changing the returned metadata does not change the cached template
+    """
+    cache = ImageCache(config)
+    image = _image("uuid-1")
+    cache.put("uuid-1", image)
+
+    first = cache.get_aq_metadata(image)
+    first.override_from_vm_meta({"AQ_DOMAIN": "overridden"})
+
+    assert first.aq_domain == "overridden"
+    assert cache.get_aq_metadata(image).aq_domain == "domain"
+
+
+def test_get_aq_metadata_uncached_image(config):
+    """
+    Tests that metadata can still be parsed for an image not in the cache
+    """
+    cache = ImageCache(config)
+    assert cache.get_aq_metadata(_image("uuid-1")).aq_os == "os"
+    assert not cache
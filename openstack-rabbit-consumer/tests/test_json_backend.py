@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the selection of the JSON library used to decode messages
+"""
+import json
+from unittest.mock import patch
+
+import orjson
+import pytest
+
+from rabbit_consumer.json_backend import get_configured_json_loads, get_json_loads
+
+
+@pytest.fixture(autouse=True, name="clear_backend_cache")
+def fixture_clear_backend_cache():
+    """
+    Clears the cached backend lookup between tests
+    """
+    get_json_loads.cache_clear()
+    get_configured_json_loads.cache_clear()
+    yield
+    get_json_loads.cache_clear()
+    get_configured_json_loads.cache_clear()
+
+
+@pytest.mark.parametrize(
+    "backend,expected",
+    [("json", json.loads), ("orjson", orjson.loads), (" ORJSON ", orjson.loads)],
+)
+def test_get_json_loads(backend, expected):
+    """
+    Tests that the requested backend is returned
+    """
+    assert get_json_loads(backend) is expected
+
+
+@pytest.mark.parametrize("backend", ["auto", "", None])
+def test_get_json_loads_auto_prefers_orjson(backend):
+    """
+    Tests that orjson is used by default when it is installed
+    """
+    assert get_json_loads(backend) is orjson.loads
+
+
+@patch("rabbit_consumer.json_backend.orjson", None)
+def test_get_json_loads_auto_without_orjson():
+    """
+    Tests that json is used by default when orjson is not installed
+    """
+    assert get_json_loads("auto") is json.loads
+
+
+@patch("rabbit_consumer.json_backend.orjson", None)
+def test_get_json_loads_orjson_missing():
+    """
+    Tests that requesting orjson when it is not installed raises
+    """
+    with pytest.raises(ValueError):
+        get_json_loads("orjson")
+
+
+def test_get_json_loads_unknown():
+    """
+    Tests that an unknown backend raises
+    """
+    with pytest.raises(ValueError):
+        get_json_loads("yaml")
+
+
+def test_get_configured_json_loads(monkeypatch):
+    """
+    Tests that the configured backend is used, and only resolved once
+    """
+    monkeypatch.setenv("CONSUMER_JSON_BACKEND", "json")
+    assert get_configured_json_loads() is json.loads
+
+    monkeypatch.setenv("CONSUMER_JSON_BACKEND", "orjson")
+    assert get_configured_json_loads() is json.loads
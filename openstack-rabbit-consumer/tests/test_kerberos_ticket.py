@@ -0,0 +1,183 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that the Kerberos ticket cache reads the ticket through GSSAPI
+and only falls back to klist when it has to
+"""
+import os
+import time
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+
+from rabbit_consumer.kerberos_ticket import (
+    KerberosTicketCache,
+    get_ccache_path,
+    read_ticket_expiry,
+)
+
+
+class _GSSError(Exception):
+    """
+    Stands in for gssapi's base exception
+    """
+
+
+@pytest.fixture(name="gssapi")
+def fixture_gssapi():
+    """
+    Provides a mock gssapi module, holding credentials with an hour left
+    """
+    with patch("rabbit_consumer.kerberos_ticket.gssapi") as gssapi:
+        gssapi.exceptions.GSSError = _GSSError
+        gssapi.Credentials.return_value.lifetime = 3600
+        yield gssapi
+
+
+@pytest.fixture(name="config")
+def fixture_config(tmp_path):
+    """
+    Provides a config pointing at a temporary credential cache
+    """
+    config = NonCallableMock()
+    config.krb5_ccname = f"FILE:{tmp_path / 'krb5cc'}"
+    config.krb5_expiry_margin = 300
+    config.krb5_recheck_interval = 60
+    return config
+
+
+def test_read_ticket_expiry(gssapi):
+    """
+    Tests that the expiry is worked out from the credentials' lifetime
+    """
+    expiry = read_ticket_expiry()
+    assert time.time() + 3590 < expiry <= time.time() + 3600
+    gssapi.Credentials.assert_called_once_with(usage="initiate")
+
+
+def test_read_ticket_expiry_no_credentials(gssapi):
+    """
+    Tests that missing or expired credentials have already expired
+    """
+    gssapi.Credentials.side_effect = _GSSError()
+    assert read_ticket_expiry() == 0
+
+
+def test_read_ticket_expiry_without_gssapi():
+    """
+    Tests that None is returned if gssapi isn't installed
+    """
+    with patch("rabbit_consumer.kerberos_ticket.gssapi", None):
+        assert read_ticket_expiry() is None
+
+
+@pytest.mark.parametrize(
+    "ccname,expected",
+    [
+        ("FILE:/tmp/krb5cc_test", "/tmp/krb5cc_test"),
+        ("/tmp/krb5cc_test", "/tmp/krb5cc_test"),
+        ("KEYRING:persistent:0", None),
+        (None, f"/tmp/krb5cc_{os.getuid()}"),
+    ],
+)
+def test_get_ccache_path(ccname, expected):
+    """
+    Tests that the KRB5CCNAME value is converted to a file path
+    """
+    assert get_ccache_path(ccname) == expected
+
+
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_uses_cached_expiry(klist, config, gssapi):
+    """
+    Tests that a valid ticket is only read once, and klist is never forked
+    """
+    cache = KerberosTicketCache(config)
+    assert all(cache.is_valid() for _ in range(5))
+
+    gssapi.Credentials.assert_called_once()
+    klist.assert_not_called()
+    assert cache.forks_saved == 4
+
+
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_rechecks_near_expiry(klist, config, gssapi):
+    """
+    Tests that a ticket within the margin is still valid but re-read each time
+    """
+    gssapi.Credentials.return_value.lifetime = 60
+
+    cache = KerberosTicketCache(config)
+    assert cache.is_valid()
+    assert cache.is_valid()
+
+    assert gssapi.Credentials.call_count == 2
+    assert cache.forks_saved == 0
+    klist.assert_not_called()
+
+
+def test_ticket_cache_expired(config, gssapi):
+    """
+    Tests that an expired ticket is reported as invalid
+    """
+    gssapi.Credentials.side_effect = _GSSError()
+    assert not KerberosTicketCache(config).is_valid()
+
+
+def test_ticket_cache_renewed(config, gssapi, tmp_path):
+    """
+    Tests that a ticket renewed by the sidecar is re-read straight away
+    """
+    path = tmp_path / "krb5cc"
+    path.write_bytes(b"old")
+
+    cache = KerberosTicketCache(config)
+    cache.is_valid()
+    path.unlink()
+    path.write_bytes(b"new")
+    os.utime(path, ns=(0, 0))
+    cache.is_valid()
+
+    assert gssapi.Credentials.call_count == 2
+
+
+def test_ticket_cache_invalidate(config, gssapi):
+    """
+    Tests that invalidating the cache forces the ticket to be re-read
+    """
+    cache = KerberosTicketCache(config)
+    cache.is_valid()
+    cache.invalidate()
+    cache.is_valid()
+
+    assert gssapi.Credentials.call_count == 2
+
+
+@pytest.mark.parametrize("exit_code,expected", [(0, True), (1, False)])
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+@patch("rabbit_consumer.kerberos_ticket.gssapi", None)
+def test_ticket_cache_falls_back_to_klist(klist, config, exit_code, expected):
+    """
+    Tests that klist is used when gssapi isn't installed
+    """
+    klist.return_value = exit_code
+
+    cache = KerberosTicketCache(config)
+    assert cache.is_valid() == expected
+    klist.assert_called_once_with(["klist", "-s"])
+
+
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+@patch("rabbit_consumer.kerberos_ticket.gssapi", None)
+def test_ticket_cache_klist_fallback_is_cached(klist, config):
+    """
+    Tests that the klist result is re-used until the recheck interval passes
+    """
+    klist.return_value = 0
+
+    cache = KerberosTicketCache(config)
+    for _ in range(3):
+        assert cache.is_valid()
+
+    klist.assert_called_once()
+    assert cache.forks_saved == 2
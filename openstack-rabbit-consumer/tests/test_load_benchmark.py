@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the consumer end to end against the fake Aquilon and Openstack
+servers used by the load benchmark
+"""
+import pytest
+import requests
+
+from benchmarks.fake_servers import FakeAquilon, FakeOpenstack, FaultInjection
+from benchmarks.load_benchmark import fake_environment, make_load, run_load
+
+
+@pytest.fixture(name="fakes")
+def fakes_fixture():
+    """
+    Starts a fake Aquilon and Openstack for the test
+    """
+    with FakeAquilon() as aquilon, FakeOpenstack() as openstack:
+        yield aquilon, openstack
+
+
+def test_make_load_deletes_after_create():
+    """
+    Tests that every VM gets a create followed later by its delete
+    """
+    openstack = FakeOpenstack()
+    load = make_load(openstack, vms=5, lag=2)
+
+    assert len(load) == 10
+    assert len(openstack.servers) == 5
+    for instance_id in openstack.servers:
+        positions = [i for i, (key, _) in enumerate(load) if key == instance_id]
+        assert len(positions) == 2
+        assert b"create.end" in load[positions[0]][1]
+        assert b"delete.start" in load[positions[1]][1]
+
+
+def test_load_creates_and_deletes(fakes):
+    """
+    Tests that a create then delete leaves nothing behind in Aquilon,
+    and the Aquilon details are written to the server metadata
+    """
+    aquilon, openstack = fakes
+    load = make_load(openstack, vms=4, lag=4)
+
+    with fake_environment(aquilon, openstack):
+        report = run_load(load[:4], workers=2)
+        assert len(aquilon.hosts) == 4
+        assert all(i.makes == 1 for i in aquilon.hosts.values())
+        assert all("AQ_MACHINE" in i["metadata"] for i in openstack.servers.values())
+
+        report = run_load(load[4:], workers=2)
+
+    assert report.count == 4
+    assert report.failed == 0
+    assert not aquilon.machines
+    assert not aquilon.hosts
+
+
+def test_fake_aquilon_enforces_ordering(fakes):
+    """
+    Tests that a machine can't be deleted while it still has a host
+    """
+    aquilon, _ = fakes
+    name = requests.put(
+        f"{aquilon.url}/next_machine/vm-", params={"serial": "serial"}, timeout=5
+    ).text
+    requests.put(
+        f"{aquilon.url}/host/host.example.com",
+        params={"machine": name, "ip": "10.0.0.1"},
+        timeout=5,
+    )
+
+    response = requests.delete(f"{aquilon.url}/machine/{name}", timeout=5)
+    assert response.status_code == 400
+    assert name in aquilon.machines
+
+
+def test_fault_injection_fails_requests():
+    """
+    Tests that injected errors are returned instead of calling the route
+    """
+    with FakeAquilon(FaultInjection(error_rate=1.0)) as aquilon:
+        response = requests.get(f"{aquilon.url}/host/missing", timeout=5)
+    assert response.status_code == 503
+    assert aquilon.requests == 0
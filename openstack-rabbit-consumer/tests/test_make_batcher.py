@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that new hosts are made together in batches
+"""
+import threading
+from unittest.mock import call, patch
+
+import pytest
+
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.make_batcher import (
+    MakeBatcher,
+    get_make_batcher,
+    stop_make_batcher,
+)
+
+
+@pytest.fixture(name="batcher")
+def fixture_batcher():
+    """
+    Creates a batcher which only flushes when asked, or when full
+    """
+    batcher = MakeBatcher(max_batch=3, interval=3600)
+    yield batcher
+    batcher.stop()
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_flush_makes_hosts_together(aq_api, batcher):
+    """
+    Tests that queued hosts are made in one request, once each
+    """
+    futures = [batcher.add(i) for i in ["host1", "host2", "host1"]]
+    assert futures[0] is futures[2]
+    assert not futures[0].done()
+
+    assert not batcher.flush()
+    aq_api.aq_make_hosts.assert_called_once_with(["host1", "host2"])
+    assert batcher.flushes == 1
+    assert all(future.result() is None for future in futures)
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_flush_without_hosts(aq_api, batcher):
+    """
+    Tests that nothing is sent when no hosts are queued
+    """
+    assert not batcher.flush()
+    aq_api.aq_make_hosts.assert_not_called()
+
+
+@pytest.mark.parametrize("hostname", ["  ", "", None])
+def test_add_requires_hostname(batcher, hostname):
+    """
+    Tests that an empty hostname can't be queued
+    """
+    with pytest.raises(ValueError):
+        batcher.add(hostname)
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_discarded_hosts_not_made(aq_api, batcher):
+    """
+    Tests that a host discarded before the flush is not made
+    """
+    discarded = batcher.add("host1")
+    batcher.add("host2")
+    batcher.discard("host1")
+    batcher.flush()
+
+    aq_api.aq_make_hosts.assert_called_once_with(["host2"])
+    with pytest.raises(AquilonError):
+        discarded.result()
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_failed_batch_reports_each_host(aq_api, batcher):
+    """
+    Tests that a rejected batch is retried per host, returning the failures
+    """
+
+    def make(hostnames):
+        if "bad" in hostnames:
+            raise AquilonError("Invalid host")
+
+    aq_api.aq_make_hosts.side_effect = make
+    futures = {i: batcher.add(i) for i in ["host1", "bad", "host2"]}
+
+    assert batcher.flush() == ["bad"]
+    assert futures["host1"].result() is None
+    assert futures["host2"].result() is None
+    with pytest.raises(AquilonError):
+        futures["bad"].result()
+    aq_api.aq_make_hosts.assert_has_calls(
+        [
+            call(["host1", "bad", "host2"]),
+            call(["host1"]),
+            call(["bad"]),
+            call(["host2"]),
+        ]
+    )
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_unreachable_keeps_hosts(aq_api, batcher):
+    """
+    Tests that hosts are kept for the next batch if Aquilon can't be reached
+    """
+    aq_api.aq_make_hosts.side_effect = ConnectionError()
+    first = batcher.add("host1")
+    with pytest.raises(ConnectionError):
+        batcher.flush()
+    assert not first.done()
+
+    # Queued again whilst the first batch was being made
+    second = batcher.add("host1")
+    aq_api.aq_make_hosts.side_effect = None
+    batcher.flush()
+    aq_api.aq_make_hosts.assert_called_with(["host1"])
+    assert first.result() is None
+    assert second.result() is None
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_unreachable_during_fallback_keeps_hosts(aq_api, batcher):
+    """
+    Tests that hosts not yet made one at a time are kept for the next
+    batch if Aquilon becomes unreachable part way
+    """
+    aq_api.aq_make_hosts.side_effect = [
+        AquilonError("Invalid host"),
+        None,
+        ConnectionError(),
+    ]
+    for hostname in ["a", "b", "c"]:
+        batcher.add(hostname)
+
+    with pytest.raises(ConnectionError):
+        batcher.flush()
+
+    aq_api.aq_make_hosts.side_effect = None
+    batcher.flush()
+    aq_api.aq_make_hosts.assert_called_with(["b", "c"])
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_full_batch_flushed_in_background(aq_api, batcher):
+    """
+    Tests that a full batch is made without waiting for the interval
+    """
+    made = threading.Event()
+    aq_api.aq_make_hosts.side_effect = lambda _: made.set()
+
+    for hostname in ["host1", "host2", "host3"]:
+        batcher.add(hostname)
+
+    assert made.wait(5)
+    aq_api.aq_make_hosts.assert_called_once_with(["host1", "host2", "host3"])
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_stop_makes_remaining_hosts(aq_api):
+    """
+    Tests that queued hosts are made when the batcher is stopped
+    """
+    batcher = MakeBatcher(max_batch=10, interval=3600)
+    future = batcher.add("host1")
+    batcher.stop()
+
+    aq_api.aq_make_hosts.assert_called_once_with(["host1"])
+    assert future.result() is None
+
+
+@patch("rabbit_consumer.make_batcher.aq_api")
+def test_stop_fails_unmade_hosts(aq_api):
+    """
+    Tests that hosts which can't be made on stopping fail their futures,
+    so nothing is left waiting on them
+    """
+    aq_api.aq_make_hosts.side_effect = ConnectionError()
+    batcher = MakeBatcher(max_batch=10, interval=3600)
+    future = batcher.add("host1")
+    with pytest.raises(ConnectionError):
+        batcher.stop()
+
+    with pytest.raises(RuntimeError):
+        future.result()
+
+
+@patch("rabbit_consumer.make_batcher.ConsumerConfig")
+def test_get_make_batcher(config):
+    """
+    Tests that the shared batcher is only started when configured
+    """
+    config.return_value.aq_make_batch = 0
+    assert get_make_batcher() is None
+
+    stop_make_batcher()
+    config.return_value.aq_make_batch = 5
+    config.return_value.aq_make_interval = 3600
+    batcher = get_make_batcher()
+    assert batcher.max_batch == 5
+    assert get_make_batcher() is batcher
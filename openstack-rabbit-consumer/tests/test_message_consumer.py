@@ -4,14 +4,21 @@
 Tests the message consumption flow
 for the consumer
 """
-from unittest.mock import Mock, NonCallableMock, patch, call, MagicMock
+import json
+from unittest.mock import ANY, Mock, NonCallableMock, patch, call, MagicMock
 
 import pytest
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer import message_consumer
 from rabbit_consumer.message_consumer import (
     on_message,
+    dispatch_message,
+    create_worker_pool,
+    get_ack_batch_size,
+    get_lane,
+    get_prefetch_count,
     initiate_consumer,
     add_aq_details_to_metadata,
     handle_create_machine,
@@ -23,85 +30,253 @@ from rabbit_consumer.message_consumer import (
     delete_machine,
     generate_login_str,
 )
-from rabbit_consumer.vm_data import VmData
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.json_backend import get_configured_json_loads
+from rabbit_consumer.rabbit_message import RabbitMessage
 
 
-@pytest.fixture(name="valid_event_type")
-def fixture_valid_event_type():
+def _raw_message(event_type: str) -> bytes:
     """
-    Fixture for a valid event type
+    Returns a raw message body as it arrives from RabbitMQ, where the
+    oslo.message is itself a JSON encoded string
     """
-    mock = NonCallableMock()
-    mock.event_type = SUPPORTED_MESSAGE_TYPES["create"]
-    return mock
+    payload = {
+        "instance_id": "instance_id_mock",
+        "display_name": "vm_name_mock",
+        "host": "vm_host_mock",
+        "vcpus": 2,
+        "memory_mb": 2048,
+        "metadata": {},
+    }
+    oslo_message = {
+        "event_type": event_type,
+        "_context_project_id": "project_id_mock",
+        "_context_project_name": "project_name_mock",
+        "_context_user_name": "user_name_mock",
+        "payload": payload,
+    }
+    envelope = {"oslo.version": "2.0", "oslo.message": json.dumps(oslo_message)}
+    return json.dumps(envelope).encode("utf-8")
+
+
+@pytest.fixture(name="valid_message")
+def fixture_valid_message():
+    """
+    Fixture for a message with a valid event type
+    """
+    message = Mock()
+    message.body = _raw_message(SUPPORTED_MESSAGE_TYPES["create"])
+    return message
 
 
 @patch("rabbit_consumer.message_consumer.consume")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-@patch("rabbit_consumer.message_consumer.RabbitMessage")
-def test_on_message_parses_json(
-    message_parser, message_event_type, consume, valid_event_type
-):
+def test_on_message_parses_json(consume, valid_message):
     """
     Test that the function parses the message body as JSON
     """
-    message_event_type.from_json.return_value = valid_event_type
+    on_message(valid_message)
 
-    with (
-        patch("rabbit_consumer.message_consumer.json") as json,
-        patch("rabbit_consumer.message_consumer.is_aq_managed_image"),
-    ):
-        message = Mock()
-        on_message(message)
+    consume.assert_called_once()
+    decoded = consume.call_args[0][0]
+    assert isinstance(decoded, RabbitMessage)
+    assert decoded.event_type == SUPPORTED_MESSAGE_TYPES["create"]
+    assert decoded.project_id == "project_id_mock"
+    assert decoded.payload.instance_id == "instance_id_mock"
+    valid_message.ack.assert_called_once()
+
+
+@patch("rabbit_consumer.message_consumer.consume")
+@patch("rabbit_consumer.message_consumer.get_configured_json_loads")
+def test_on_message_ignores_wrong_message_type(json_loads, consume):
+    """
+    Test that the function ignores messages with the wrong message type,
+    without decoding them
+    """
+    message = Mock()
+    message.body = _raw_message("compute.instance.update")
+    on_message(message)
 
-    decoded_body = json.loads.return_value
-    message_parser.from_json.assert_called_once_with(decoded_body["oslo.message"])
-    consume.assert_called_once_with(message_parser.from_json.return_value)
+    json_loads.assert_not_called()
+    consume.assert_not_called()
     message.ack.assert_called_once()
 
 
 @patch("rabbit_consumer.message_consumer.consume")
-@patch("rabbit_consumer.message_consumer.is_aq_managed_image")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-def test_on_message_ignores_wrong_message_type(message_event_type, is_managed, consume):
+@patch("rabbit_consumer.message_consumer.sniff_event_type")
+def test_on_message_ignores_wrong_message_type_without_sniff(sniff, consume):
     """
-    Test that the function ignores messages with the wrong message type
+    Test that a message is still ignored after decoding if the
+    event type could not be sniffed
     """
-    message_event = NonCallableMock()
-    message_event.event_type = "wrong"
-    message_event_type.from_json.return_value = message_event
-
-    with patch("rabbit_consumer.message_consumer.json"):
-        message = Mock()
-        on_message(message)
+    sniff.return_value = None
+    message = Mock()
+    message.body = _raw_message("compute.instance.update")
+    on_message(message)
 
-    is_managed.assert_not_called()
     consume.assert_not_called()
     message.ack.assert_called_once()
 
 
+@patch("rabbit_consumer.message_consumer.MESSAGE_DURATION")
+@patch("rabbit_consumer.message_consumer.MESSAGES")
+@patch("rabbit_consumer.message_consumer.consume")
+def test_on_message_records_metrics(consume, messages, duration, valid_message):
+    """
+    Test that the outcome and latency of each message are recorded
+    """
+    event_type = SUPPORTED_MESSAGE_TYPES["create"]
+    on_message(valid_message)
+    messages.labels.assert_called_once_with(event_type, "succeeded")
+    duration.labels.assert_called_once_with(event_type)
+
+    messages.reset_mock()
+    consume.side_effect = ValueError
+    with pytest.raises(ValueError):
+        on_message(valid_message)
+    messages.labels.assert_called_once_with(event_type, "failed")
+
+
 @pytest.mark.parametrize("event_type", SUPPORTED_MESSAGE_TYPES.values())
 @patch("rabbit_consumer.message_consumer.consume")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-def test_on_message_accepts_event_types(message_event_type, consume, event_type):
+def test_on_message_accepts_event_types(consume, event_type):
     """
     Test that the function accepts the correct event types
     """
-    message_event = NonCallableMock()
-    message_event.event_type = event_type
-    message_event_type.from_json.return_value = message_event
+    message = Mock()
+    message.body = _raw_message(event_type)
+    on_message(message)
 
-    with (
-        patch("rabbit_consumer.message_consumer.RabbitMessage"),
-        patch("rabbit_consumer.message_consumer.json"),
-    ):
-        message = Mock()
-        on_message(message)
+    consume.assert_called_once()
+    message.ack.assert_called_once()
 
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+@patch("rabbit_consumer.message_consumer.consume")
+def test_on_message_json_backends(consume, valid_message, monkeypatch, backend):
+    """
+    Test that messages decode the same with each JSON backend
+    """
+    monkeypatch.setenv("CONSUMER_JSON_BACKEND", backend)
+    get_configured_json_loads.cache_clear()
+    on_message(valid_message)
+    get_configured_json_loads.cache_clear()
+
+    assert consume.call_args[0][0].payload.vm_name == "vm_name_mock"
+
+
+def test_dispatch_message_shards_by_instance(valid_message):
+    """
+    Test that supported messages are handed to the pool keyed by instance ID,
+    and are only acked once the worker handles them
+    """
+    pool = Mock()
+    dispatch_message(valid_message, pool)
+
+    pool.submit.assert_called_once()
+    lane, key, task = pool.submit.call_args[0]
+    assert lane == "create"
+    assert key == "instance_id_mock"
+    valid_message.ack.assert_not_called()
+
+    with patch("rabbit_consumer.message_consumer.consume") as consume:
+        task()
     consume.assert_called_once()
+    valid_message.ack.assert_called_once()
+
+
+def test_dispatch_message_acks_ignored():
+    """
+    Test that ignored messages are acked straight away without using the pool
+    """
+    pool = Mock()
+    message = Mock()
+    message.body = _raw_message("compute.instance.update")
+    dispatch_message(message, pool)
+
+    pool.submit.assert_not_called()
     message.ack.assert_called_once()
 
 
+def test_on_message_parks_failures(valid_message):
+    """
+    Test that a failing message is handed to the retry handler,
+    which takes over acking it
+    """
+    retry_handler = Mock()
+    with patch("rabbit_consumer.message_consumer.consume") as consume:
+        on_message(valid_message, retry_handler)
+
+    retry_handler.run.assert_called_once()
+    message, task = retry_handler.run.call_args[0]
+    assert message == valid_message
+    task()
+    consume.assert_called_once()
+    valid_message.ack.assert_not_called()
+
+
+def test_on_message_dead_letters_bad_message():
+    """
+    Test that a message which can't be decoded is dead-lettered and acked
+    """
+    retry_handler = Mock()
+    message = Mock()
+    message.body = b"not json"
+    on_message(message, retry_handler)
+
+    retry_handler.dead_letter.assert_called_once()
+    assert retry_handler.dead_letter.call_args[0][0] == message
+    message.ack.assert_called_once()
+
+
+def test_on_message_raises_without_retry_handler():
+    """
+    Test that decode errors still raise when retries are disabled
+    """
+    message = Mock()
+    message.body = b"not json"
+    with pytest.raises(ValueError):
+        on_message(message)
+    message.ack.assert_not_called()
+
+
+def test_dispatch_message_uses_debouncer(valid_message):
+    """
+    Test that supported messages go through the debouncer when one is set
+    """
+    pool = Mock()
+    debouncer = Mock()
+    dispatch_message(valid_message, pool, debouncer)
+
+    debouncer.submit.assert_called_once()
+    assert debouncer.submit.call_args[0][0] == valid_message
+    pool.submit.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "workers,delete_workers,prefetch,window,expected",
+    [
+        (1, 0, 0, 0, 0),
+        (1, 0, 5, 0, 5),
+        (4, 0, 0, 0, 8),
+        (4, 0, 3, 0, 3),
+        (4, 2, 0, 0, 12),
+        (4, 0, 0, 30, 0),
+        (4, 0, 50, 30, 50),
+    ],
+)
+def test_get_prefetch_count(workers, delete_workers, prefetch, window, expected):
+    """
+    Test that the prefetch is bounded when running workers, unless
+    creates are held by the debouncer
+    """
+    config = NonCallableMock()
+    config.consumer_workers = workers
+    config.consumer_delete_workers = delete_workers
+    config.consumer_prefetch = prefetch
+    config.consumer_debounce_window = window
+    assert get_prefetch_count(config) == expected
+
+
 @pytest.fixture(name="mocked_config")
 def mocked_config_fixture() -> ConsumerConfig:
     """
@@ -163,11 +338,15 @@ def test_password_does_not_get_logged(logging, mocked_config):
     assert mocked_config.rabbit_username in logging_arg
     assert mocked_config.rabbit_password not in logging_arg
 
+
+@patch("rabbit_consumer.message_consumer.RetryHandler")
 @patch("rabbit_consumer.message_consumer.os")
 @patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
 @patch("rabbit_consumer.message_consumer.generate_login_str")
 @patch("rabbit_consumer.message_consumer.rabbitpy")
-def test_initiate_consumer_channel_setup(rabbitpy, gen_login, _, mock_os, mocked_config):
+def test_initiate_consumer_channel_setup(
+    rabbitpy, gen_login, _, mock_os, retry_handler, mocked_config
+):
     """
     Test that the function sets up the channel and queue correctly
     """
@@ -182,15 +361,25 @@ def test_initiate_consumer_channel_setup(rabbitpy, gen_login, _, mock_os, mocked
     connection.channel.assert_called_once()
     channel = connection.channel.return_value.__enter__.return_value
 
-    rabbitpy.Queue.assert_called_once_with(channel, name=mock_os.getenv(key="CONSUMER_QUEUE", default="ral.info"), durable=True)
+    rabbitpy.Queue.assert_called_once_with(
+        channel,
+        name=mock_os.getenv(key="CONSUMER_QUEUE", default="ral.info"),
+        durable=True,
+    )
     queue = rabbitpy.Queue.return_value
-    queue.bind.assert_called_once_with('nova', routing_key=mock_os.getenv(key="CONSUMER_QUEUE", default="ral.info"))
+    queue.bind.assert_called_once_with(
+        "nova", routing_key=mock_os.getenv(key="CONSUMER_QUEUE", default="ral.info")
+    )
+
+    retry_handler.assert_called_once_with(queue.name, mocked_config)
+    retry_handler.return_value.declare.assert_called_once_with(channel)
 
 
+@patch("rabbit_consumer.message_consumer.RetryHandler")
 @patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
 @patch("rabbit_consumer.message_consumer.on_message")
 @patch("rabbit_consumer.message_consumer.rabbitpy")
-def test_initiate_consumer_actual_consumption(rabbitpy, message_mock, _):
+def test_initiate_consumer_actual_consumption(rabbitpy, message_mock, _, retry_handler):
     """
     Test that the function actually consumes messages
     """
@@ -201,44 +390,65 @@ def test_initiate_consumer_actual_consumption(rabbitpy, message_mock, _):
     with patch("rabbit_consumer.message_consumer.generate_login_str"):
         initiate_consumer()
 
-    message_mock.assert_has_calls([call(message) for message in queue_messages])
+    message_mock.assert_has_calls(
+        [call(message, retry_handler.return_value) for message in queue_messages]
+    )
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
 @patch("rabbit_consumer.message_consumer.aq_api")
 def test_add_aq_details_to_metadata(
-    aq_api, openstack_api, vm_data, openstack_address_list
+    aq_api, openstack_api, server_snapshot, openstack_address_list
 ):
     """
-    Test that the function adds the hostname to the metadata when the machine exists
+    Test that the function adds the hostname and machine to the metadata
+    when the machine exists, without looking the machine up again
     """
+    vm_data = server_snapshot.vm_data
     openstack_api.check_machine_exists.return_value = True
-    add_aq_details_to_metadata(vm_data, openstack_address_list)
+    add_aq_details_to_metadata(server_snapshot, openstack_address_list, "machine")
 
     hostnames = [i.hostname for i in openstack_address_list]
     expected = {
         "HOSTNAMES": ",".join(hostnames),
         "AQ_STATUS": "SUCCESS",
-        "AQ_MACHINE": aq_api.search_machine_by_serial.return_value,
+        "AQ_MACHINE": "machine",
     }
 
     openstack_api.check_machine_exists.assert_called_once_with(vm_data)
-    aq_api.search_machine_by_serial.assert_called_once_with(vm_data)
-    openstack_api.update_metadata.assert_called_with(vm_data, expected)
+    aq_api.search_machine_by_serial.assert_not_called()
+    openstack_api.update_metadata.assert_called_with(server_snapshot, expected)
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_add_hostname_to_metadata_machine_does_not_exist(openstack_api, vm_data):
+def test_add_hostname_to_metadata_machine_does_not_exist(
+    openstack_api, server_snapshot
+):
     """
     Test that the function does not add the hostname to the metadata when the machine does not exist
     """
     openstack_api.check_machine_exists.return_value = False
-    add_aq_details_to_metadata(vm_data, [])
+    add_aq_details_to_metadata(server_snapshot, [], "machine")
 
-    openstack_api.check_machine_exists.assert_called_once_with(vm_data)
+    openstack_api.check_machine_exists.assert_called_once_with(server_snapshot.vm_data)
     openstack_api.update_metadata.assert_not_called()
 
 
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+def test_add_aq_details_to_metadata_without_recheck(
+    openstack_api, _, server_snapshot, monkeypatch
+):
+    """
+    Test that the existence re-check is skipped when it has been disabled
+    """
+    monkeypatch.setenv("OPENSTACK_RECHECK_EXISTS", "false")
+    add_aq_details_to_metadata(server_snapshot, [], "machine")
+
+    openstack_api.check_machine_exists.assert_not_called()
+    openstack_api.update_metadata.assert_called_once()
+
+
 @patch("rabbit_consumer.message_consumer.check_machine_valid")
 @patch("rabbit_consumer.message_consumer.openstack_api")
 def test_handle_create_machine_skips_invalid(openstack_api, machine_valid):
@@ -250,7 +460,9 @@ def test_handle_create_machine_skips_invalid(openstack_api, machine_valid):
 
     handle_create_machine(vm_data)
 
-    machine_valid.assert_called_once_with(vm_data)
+    machine_valid.assert_called_once_with(
+        vm_data, openstack_api.get_server_snapshot.return_value
+    )
     openstack_api.get_server_networks.assert_not_called()
 
 
@@ -278,10 +490,15 @@ def test_consume_create_machine_hostnames_good_path(
         handle_create_machine(rabbit_message)
 
         vm_data = data_patch.from_message.return_value
+        snapshot = openstack.get_server_snapshot.return_value
         network_details = openstack.get_server_networks.return_value
 
     data_patch.from_message.assert_called_with(rabbit_message)
-    openstack.get_server_networks.assert_called_with(vm_data)
+    # The server should only be fetched once for the whole message
+    openstack.get_server_snapshot.assert_called_once_with(vm_data)
+    check_machine.assert_called_once_with(rabbit_message, snapshot)
+    get_image_meta.assert_called_once_with(snapshot)
+    openstack.get_server_networks.assert_called_with(snapshot)
 
     # Check main Aq Flow
     delete_machine_mock.assert_called_once_with(vm_data, network_details[0])
@@ -299,7 +516,63 @@ def test_consume_create_machine_hostnames_good_path(
     aq_api.aq_make.assert_called_once_with(network_details)
 
     # Metadata
-    metadata.assert_called_once_with(vm_data, network_details)
+    metadata.assert_called_once_with(snapshot, network_details, machine_name)
+
+
+@patch("rabbit_consumer.message_consumer.get_make_batcher")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_consume_create_machine_batched_make(
+    _, aq_api, openstack, get_make_batcher, rabbit_message, image_metadata
+):
+    """
+    Test that new hosts are queued to be made when batching makes
+    """
+    with (
+        patch("rabbit_consumer.message_consumer.check_machine_valid") as check_machine,
+        patch(
+            "rabbit_consumer.message_consumer.get_aq_build_metadata"
+        ) as get_image_meta,
+        patch("rabbit_consumer.message_consumer.delete_machine"),
+    ):
+        check_machine.return_value = True
+        get_image_meta.return_value = image_metadata
+        handle_create_machine(rabbit_message)
+
+    network_details = openstack.get_server_networks.return_value
+    aq_api.aq_make.assert_not_called()
+    get_make_batcher.return_value.add.assert_called_once_with(
+        network_details[0].hostname
+    )
+    # The message isn't acked until the host has been made
+    get_make_batcher.return_value.add.return_value.result.assert_called_once_with()
+
+
+@patch("rabbit_consumer.message_consumer.get_make_batcher")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+def test_create_machine_make_fails(
+    metadata, _, openstack, get_make_batcher, rabbit_message
+):
+    """
+    Test that a host which fails to make is reported on the VM, and the
+    message fails rather than being marked a success
+    """
+    future = get_make_batcher.return_value.add.return_value
+    future.result.side_effect = AquilonError("Invalid host")
+    with (
+        patch("rabbit_consumer.message_consumer.check_machine_valid"),
+        patch("rabbit_consumer.message_consumer.get_aq_build_metadata"),
+        patch("rabbit_consumer.message_consumer.delete_machine"),
+        pytest.raises(AquilonError),
+    ):
+        handle_create_machine(rabbit_message)
+
+    openstack.update_metadata.assert_called_once_with(ANY, {"AQ_STATUS": "FAILED"})
+    metadata.assert_not_called()
 
 
 @patch("rabbit_consumer.message_consumer.delete_machine")
@@ -319,177 +592,407 @@ def test_consume_delete_machine_good_path(delete_machine_mock, rabbit_message):
 
 @patch("rabbit_consumer.message_consumer.is_aq_managed_image")
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_check_machine_valid(openstack_api, is_aq_managed):
+def test_check_machine_valid(openstack_api, is_aq_managed, server_snapshot):
     """
     Test that the function returns True when the machine is valid
     """
     mock_message = NonCallableMock()
     is_aq_managed.return_value = True
 
-    vm_data = VmData.from_message(mock_message)
-
-    openstack_api.check_machine_exists.return_value = True
-
-    assert check_machine_valid(mock_message)
-    is_aq_managed.assert_called_once_with(vm_data)
-    openstack_api.check_machine_exists.assert_called_once_with(vm_data)
+    assert check_machine_valid(mock_message, server_snapshot)
+    is_aq_managed.assert_called_once_with(server_snapshot)
+    # Existence comes from the snapshot, rather than another lookup
+    openstack_api.check_machine_exists.assert_not_called()
 
 
 @patch("rabbit_consumer.message_consumer.is_aq_managed_image")
-@patch("rabbit_consumer.message_consumer.openstack_api")
-def test_check_machine_invalid_image(openstack_api, is_aq_managed):
+def test_check_machine_invalid_image(is_aq_managed, server_snapshot):
     """
     Test that the function returns False when the image is not AQ managed
     """
     mock_message = NonCallableMock()
     is_aq_managed.return_value = False
-    openstack_api.check_machine_exists.return_value = True
-    vm_data = VmData.from_message(mock_message)
 
-    assert not check_machine_valid(mock_message)
-
-    openstack_api.check_machine_exists.assert_called_once_with(vm_data)
-    is_aq_managed.assert_called_once_with(vm_data)
+    assert not check_machine_valid(mock_message, server_snapshot)
+    is_aq_managed.assert_called_once_with(server_snapshot)
 
 
 @patch("rabbit_consumer.message_consumer.is_aq_managed_image")
-@patch("rabbit_consumer.message_consumer.openstack_api")
-def test_check_machine_invalid_machine(openstack_api, is_aq_managed):
+def test_check_machine_invalid_machine(is_aq_managed, server_snapshot):
     """
     Test that the function returns False when the machine does not exist
     """
     mock_message = NonCallableMock()
-    openstack_api.check_machine_exists.return_value = False
-
-    assert not check_machine_valid(mock_message)
+    server_snapshot.server = None
 
+    assert not check_machine_valid(mock_message, server_snapshot)
     is_aq_managed.assert_not_called()
-    openstack_api.check_machine_exists.assert_called_once_with(
-        VmData.from_message(mock_message)
-    )
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_is_aq_managed_image(openstack_api, vm_data):
+def test_is_aq_managed_image(openstack_api, server_snapshot):
     """
     Test that the function returns True when the image is AQ managed
     """
     openstack_api.get_image.return_value.metadata = {"AQ_OS": "True"}
 
-    assert is_aq_managed_image(vm_data)
-    openstack_api.get_image.assert_called_once_with(vm_data)
+    assert is_aq_managed_image(server_snapshot)
+    openstack_api.get_image.assert_called_once_with(server_snapshot)
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_is_aq_managed_image_missing_image(openstack_api, vm_data):
+def test_is_aq_managed_image_missing_image(openstack_api, server_snapshot):
     """
     Test that the function returns False when the image is not AQ managed
     """
     openstack_api.get_image.return_value = None
 
-    assert not is_aq_managed_image(vm_data)
-    openstack_api.get_image.assert_called_once_with(vm_data)
+    assert not is_aq_managed_image(server_snapshot)
+    openstack_api.get_image.assert_called_once_with(server_snapshot)
 
 
-@patch("rabbit_consumer.message_consumer.VmData")
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_is_aq_managed_image_missing_key(openstack_api, vm_data):
+def test_is_aq_managed_image_missing_key(openstack_api, server_snapshot):
     """
     Test that the function returns False when the image is not AQ managed
     """
     openstack_api.get_image.return_value.metadata = {}
 
-    assert not is_aq_managed_image(vm_data)
-    openstack_api.get_image.assert_called_once_with(vm_data)
+    assert not is_aq_managed_image(server_snapshot)
+    openstack_api.get_image.assert_called_once_with(server_snapshot)
 
 
-@patch("rabbit_consumer.message_consumer.AqMetadata")
+@patch("rabbit_consumer.message_consumer.get_image_cache")
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_get_aq_build_metadata(openstack_api, aq_metadata_class, vm_data):
+def test_get_aq_build_metadata(openstack_api, image_cache, server_snapshot):
     """
     Test that the function returns the correct metadata
     """
-    aq_metadata_obj: MagicMock = get_aq_build_metadata(vm_data)
+    aq_metadata_obj: MagicMock = get_aq_build_metadata(server_snapshot)
 
-    # We should first construct from an image
-    assert aq_metadata_obj == aq_metadata_class.from_dict.return_value
-    aq_metadata_class.from_dict.assert_called_once_with(
-        openstack_api.get_image.return_value.metadata
+    # We should first construct from the (cached) image metadata
+    image_cache.return_value.get_aq_metadata.assert_called_once_with(
+        openstack_api.get_image.return_value
     )
+    assert aq_metadata_obj == image_cache.return_value.get_aq_metadata.return_value
 
     # Then override with an object
-    openstack_api.get_server_metadata.assert_called_once_with(vm_data)
+    openstack_api.get_server_metadata.assert_called_once_with(server_snapshot)
     aq_metadata_obj.override_from_vm_meta.assert_called_once_with(
         openstack_api.get_server_metadata.return_value
     )
 
 
-@patch("rabbit_consumer.message_consumer.aq_api")
-def test_delete_machine_hostname_only(aq_api, vm_data, openstack_address):
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+def test_delete_machine_runs_plan(aq_delete_plan, vm_data, openstack_address):
     """
-    Tests that the function deletes a host then exits if no machine is found
+    Tests that the function plans the deletes from the current state, then runs them
     """
-    aq_api.check_host_exists.return_value = True
-    aq_api.search_machine_by_serial.return_value = None
-
     delete_machine(vm_data, openstack_address)
-    aq_api.delete_host.assert_called_once_with(openstack_address.hostname)
-    aq_api.delete_machine.assert_not_called()
 
+    aq_delete_plan.fetch_machine_state.assert_called_once_with(
+        vm_data, openstack_address.hostname
+    )
+    aq_delete_plan.plan_deletion.assert_called_once_with(
+        aq_delete_plan.fetch_machine_state.return_value
+    )
+    aq_delete_plan.run_deletion_plan.assert_called_once_with(
+        aq_delete_plan.plan_deletion.return_value
+    )
 
-@patch("rabbit_consumer.message_consumer.aq_api")
-def test_delete_machine_by_serial(aq_api, vm_data, openstack_address):
+
+@patch("rabbit_consumer.message_consumer.get_make_batcher")
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+def test_delete_machine_discards_make(aq_delete_plan, get_make_batcher, vm_data):
     """
-    Tests that the function deletes a host then a machine
-    assuming both were found
+    Tests that hosts being deleted are no longer queued to be made
     """
-    # Assume our host address doesn't match the machine record
-    # but the machine does have a hostname which is valid...
-    aq_api.check_host_exists.side_effect = [False, True]
+    aq_delete_plan.plan_deletion.return_value.hosts = ["host1"]
+    delete_machine(vm_data)
+    get_make_batcher.return_value.discard.assert_called_once_with("host1")
 
-    aq_api.search_host_by_machine.return_value = "host.example.com"
-    aq_api.get_machine_details.return_value = ""
 
-    delete_machine(vm_data, openstack_address)
+@patch("rabbit_consumer.message_consumer.aq_delete_plan")
+def test_delete_machine_no_network_details(aq_delete_plan, vm_data):
+    """
+    Tests that the host lookup is skipped without network details
+    """
+    delete_machine(vm_data)
+    aq_delete_plan.fetch_machine_state.assert_called_once_with(vm_data, None)
+
+
+@patch("rabbit_consumer.message_consumer.RetryHandler")
+@patch("rabbit_consumer.message_consumer.create_worker_pool")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.dispatch_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_with_workers(
+    rabbitpy, dispatch, _, pool, retry_handler, mocked_config
+):
+    """
+    Test that the consumer sets the prefetch and dispatches to the pool
+    when running with multiple workers
+    """
+    mocked_config.consumer_workers = 4
+    mocked_config.consumer_prefetch = 10
+    pool.return_value.error = None
+    queue_messages = [NonCallableMock(), NonCallableMock()]
+    rabbitpy.Queue.return_value.__iter__.return_value = queue_messages
 
-    aq_api.check_host_exists.assert_has_calls(
-        [call(openstack_address.hostname), call("host.example.com")]
+    with (
+        patch("rabbit_consumer.message_consumer.generate_login_str"),
+        patch("rabbit_consumer.message_consumer.ConsumerConfig") as config,
+    ):
+        config.return_value = mocked_config
+        initiate_consumer()
+
+    connection = rabbitpy.Connection.return_value.__enter__.return_value
+    channel = connection.channel.return_value.__enter__.return_value
+    channel.prefetch_count.assert_called_once_with(10)
+
+    pool.assert_called_once_with(mocked_config)
+    dispatch.assert_has_calls(
+        [
+            call(message, pool.return_value, None, retry_handler.return_value)
+            for message in queue_messages
+        ]
     )
-    aq_api.delete_host.assert_called_once_with("host.example.com")
+    pool.return_value.shutdown.assert_called_once()
 
 
-@patch("rabbit_consumer.message_consumer.aq_api")
-@patch("rabbit_consumer.message_consumer.socket")
-def test_delete_machine_no_hostname(socket_api, aq_api, vm_data):
+@patch("rabbit_consumer.message_consumer.create_worker_pool")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_worker_failed(rabbitpy, _, pool, mocked_config):
     """
-    Tests
+    Test that a worker failure which stopped the consumer is raised
     """
-    aq_api.check_host_exists.return_value = False
+    mocked_config.consumer_workers = 4
+    mocked_config.retry_max_attempts = 0
+    pool.return_value.error = RuntimeError("failed")
+    rabbitpy.Queue.return_value.__iter__.return_value = []
 
-    ip_address = "127.0.0.1"
-    socket_api.gethostbyname.return_value = ip_address
+    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+        config.return_value = mocked_config
+        with pytest.raises(RuntimeError):
+            initiate_consumer()
+    pool.return_value.shutdown.assert_called_once()
 
-    machine_name = aq_api.search_machine_by_serial.return_value
-    aq_api.get_machine_details.return_value = f"eth0: {ip_address}"
 
-    delete_machine(vm_data, NonCallableMock())
-    aq_api.delete_address.assert_called_once_with(ip_address, machine_name)
-    aq_api.delete_interface.assert_called_once_with(machine_name)
+@patch("rabbit_consumer.message_consumer.RetryHandler")
+@patch("rabbit_consumer.message_consumer.CreateDebouncer")
+@patch("rabbit_consumer.message_consumer.create_worker_pool")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.dispatch_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_initiate_consumer_with_debounce(
+    rabbitpy, dispatch, _, pool, debouncer, retry_handler, mocked_config
+):
+    """
+    Test that a debounce window runs messages through the debouncer,
+    using a worker pool even with a single worker
+    """
+    mocked_config.consumer_debounce_window = 5.0
+    pool.return_value.error = None
+    queue_messages = [NonCallableMock()]
+    rabbitpy.Queue.return_value.__iter__.return_value = queue_messages
+
+    with (
+        patch("rabbit_consumer.message_consumer.generate_login_str"),
+        patch("rabbit_consumer.message_consumer.ConsumerConfig") as config,
+    ):
+        config.return_value = mocked_config
+        initiate_consumer()
+
+    pool.assert_called_once_with(mocked_config)
+    assert debouncer.call_args[0][0] == 5.0
+    dispatch.assert_called_once_with(
+        queue_messages[0],
+        pool.return_value,
+        debouncer.return_value,
+        retry_handler.return_value,
+    )
+    debouncer.return_value.stop.assert_called_once()
+    pool.return_value.shutdown.assert_called_once()
 
 
+@patch("rabbit_consumer.message_consumer.handle_create_machine")
+@patch("rabbit_consumer.message_consumer.get_state_store")
+def test_consume_skips_processed_message(state_store, create, rabbit_message):
+    """
+    Tests that a redelivered message is skipped, and new messages are recorded
+    """
+    store = state_store.return_value
+    rabbit_message.event_type = SUPPORTED_MESSAGE_TYPES["create"]
+    rabbit_message.message_id = "message_id_mock"
+
+    store.is_processed.return_value = True
+    message_consumer.consume(rabbit_message)
+    create.assert_not_called()
+
+    store.is_processed.return_value = False
+    message_consumer.consume(rabbit_message)
+    create.assert_called_once_with(rabbit_message)
+    store.mark_processed.assert_called_once_with("message_id_mock")
+
+
+@patch("rabbit_consumer.message_consumer.get_state_store")
+@patch("rabbit_consumer.message_consumer.openstack_api")
 @patch("rabbit_consumer.message_consumer.aq_api")
-@patch("rabbit_consumer.message_consumer.socket")
-def test_delete_machine_always_called(socket_api, aq_api, vm_data):
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_handle_create_machine_records_state(
+    _, aq_api, openstack, state_store, rabbit_message, openstack_address
+):
     """
-    Tests that the function always calls the delete machine function
+    Tests that the machine and host created are recorded in the state store
     """
-    aq_api.check_host_exists.return_value = False
-    socket_api.gethostbyname.return_value = "123123"
+    openstack.get_server_networks.return_value = [openstack_address]
+    with (
+        patch("rabbit_consumer.message_consumer.VmData") as data_patch,
+        patch("rabbit_consumer.message_consumer.check_machine_valid"),
+        patch("rabbit_consumer.message_consumer.get_aq_build_metadata"),
+        patch("rabbit_consumer.message_consumer.delete_machine"),
+    ):
+        handle_create_machine(rabbit_message)
+
+    state_store.return_value.record_created.assert_called_once_with(
+        data_patch.from_message.return_value.virtual_machine_id,
+        aq_api.create_machine.return_value,
+        openstack_address.hostname,
+        openstack_address.addr,
+    )
+
+
+@patch("rabbit_consumer.message_consumer.get_state_store")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_handle_create_machine_retried_deleted(
+    _, aq_api, openstack, __, rabbit_message, openstack_address
+):
+    """
+    Tests that a retried create is skipped if the VM was deleted whilst it
+    waited, before anything is created in Aquilon
+    """
+    rabbit_message.retried = True
+    openstack.get_server_networks.return_value = [openstack_address]
+    openstack.check_machine_exists.return_value = False
+    with (
+        patch("rabbit_consumer.message_consumer.check_machine_valid"),
+        patch("rabbit_consumer.message_consumer.get_aq_build_metadata"),
+        patch("rabbit_consumer.message_consumer.delete_machine"),
+    ):
+        handle_create_machine(rabbit_message)
+
+    aq_api.create_machine.assert_not_called()
+    aq_api.create_host.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "batch,prefetch,expected", [(1, 0, 1), (50, 0, 50), (50, 20, 10), (50, 1, 1)]
+)
+def test_get_ack_batch_size(batch, prefetch, expected):
+    """
+    Tests that the ack batch is capped at half the prefetch
+    """
+    config = NonCallableMock()
+    config.consumer_ack_batch = batch
+    assert get_ack_batch_size(config, prefetch) == expected
+
+
+@patch("rabbit_consumer.message_consumer.RetryHandler")
+@patch("rabbit_consumer.message_consumer.AckBatcher")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_initiate_consumer_batches_acks(
+    rabbitpy, message_mock, _, batcher, retry_handler, mocked_config
+):
+    """
+    Tests that messages are tracked by the ack batcher before being handled,
+    and remaining acks are flushed when the consumer stops
+    """
+    mocked_config.consumer_ack_batch = 20
+    mocked_config.consumer_ack_interval = 1
+    queue_messages = [NonCallableMock(), NonCallableMock()]
+    rabbitpy.Queue.return_value.__iter__.return_value = queue_messages
+
+    with (
+        patch("rabbit_consumer.message_consumer.generate_login_str"),
+        patch("rabbit_consumer.message_consumer.ConsumerConfig") as config,
+    ):
+        config.return_value = mocked_config
+        initiate_consumer()
+
+    batcher.assert_called_once_with(20, 1)
+    batcher.return_value.track.assert_has_calls([call(i) for i in queue_messages])
+    message_mock.assert_called_with(
+        batcher.return_value.track.return_value, retry_handler.return_value
+    )
+    batcher.return_value.stop.assert_called_once()
+
 
-    aq_api.get_machine_details.return_value = "Machine Details"
+@patch("rabbit_consumer.message_consumer.get_health_monitor")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_tracks_health(
+    rabbitpy, message_mock, _, get_monitor, mocked_config
+):
+    """
+    Tests that the health monitor watches the queue and tracks each message
+    """
+    mocked_config.retry_max_attempts = 0
+    rabbitpy.Queue.return_value.__iter__.return_value = ["message"]
+    monitor = get_monitor.return_value
 
-    machine_name = "machine_name"
-    aq_api.search_machine_by_serial.return_value = machine_name
+    with (
+        patch("rabbit_consumer.message_consumer.generate_login_str") as login,
+        patch("rabbit_consumer.message_consumer.ConsumerConfig") as config,
+    ):
+        config.return_value = mocked_config
+        initiate_consumer()
+
+    monitor.watch.assert_called_once_with(
+        login.return_value, rabbitpy.Queue.return_value.name
+    )
+    monitor.track.assert_called_once_with("message")
+    message_mock.assert_called_once_with(monitor.track.return_value, None)
+
+
+@pytest.mark.parametrize(
+    "event_type,lane",
+    [
+        (SUPPORTED_MESSAGE_TYPES["create"], "create"),
+        (SUPPORTED_MESSAGE_TYPES["delete"], "delete"),
+    ],
+)
+def test_get_lane(rabbit_message, event_type, lane):
+    """
+    Tests that deletes are handled in their own lane
+    """
+    rabbit_message.event_type = event_type
+    assert get_lane(rabbit_message) == lane
+
+
+@pytest.mark.parametrize("delete_workers", [0, 2])
+@patch("rabbit_consumer.message_consumer.ShardedWorkerPool")
+def test_create_worker_pool(pool, mocked_config, delete_workers):
+    """
+    Tests that deletes only get their own workers if configured
+    """
+    mocked_config.consumer_workers = 4
+    mocked_config.consumer_delete_workers = delete_workers
+    laned = create_worker_pool(mocked_config)
 
-    delete_machine(vm_data, NonCallableMock())
-    aq_api.delete_machine.assert_called_once_with(machine_name)
+    assert laned.lanes["create"] == pool.return_value
+    if delete_workers:
+        pool.assert_any_call(4, name="create")
+        pool.assert_any_call(2, name="delete")
+    else:
+        pool.assert_called_once_with(4, name="create")
+        assert laned.lanes["delete"] is laned.lanes["create"]
@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the Prometheus metrics and the server which exposes them
+"""
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.metrics import start_metrics_server, timed
+
+
+def _sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_timed_records_latency():
+    """
+    Tests that each call to a timed function is recorded against its name
+    """
+
+    @timed("test_api")
+    def example_call(value):
+        return value
+
+    labels = {"api": "test_api", "call": "example_call"}
+    before = _sample("rabbit_consumer_api_call_duration_seconds_count", **labels)
+
+    assert example_call("value") == "value"
+    assert example_call.__name__ == "example_call"
+    assert (
+        _sample("rabbit_consumer_api_call_duration_seconds_count", **labels)
+        == before + 1
+    )
+
+
+def test_timed_counts_errors():
+    """
+    Tests that a call which raises is counted as an error, and still re-raises
+    """
+
+    @timed("test_api")
+    def failing_call():
+        raise ValueError()
+
+    labels = {"api": "test_api", "call": "failing_call"}
+    before = _sample("rabbit_consumer_api_call_errors_total", **labels)
+
+    with pytest.raises(ValueError):
+        failing_call()
+    assert _sample("rabbit_consumer_api_call_errors_total", **labels) == before + 1
+
+
+@pytest.mark.parametrize("port,expected", [(0, False), (9100, True)])
+@patch("rabbit_consumer.metrics.start_http_server")
+def test_start_metrics_server(start_http_server, port, expected):
+    """
+    Tests that the server is only started when a port is set
+    """
+    config = NonCallableMock()
+    config.metrics_port = port
+
+    assert start_metrics_server(config) == expected
+    assert start_http_server.called == expected
@@ -75,15 +75,16 @@ def test_openstack_address_populate_internal(
     """
     Tests the OpenstackAddress class with multiple internal network addresses
     """
-    mock_socket.side_effect = [("hostname", None, None), ("hostname2", None, None)]
+    # Lookups run concurrently, so return hostnames by address not call order
+    hostnames = {"127.0.0.63": "hostname", "127.0.0.64": "hostname2"}
+    mock_socket.side_effect = lambda ip: (hostnames[ip], None, None)
     result = OpenstackAddress.get_internal_networks(example_dict_two_entries_internal)
 
     assert result[0].hostname == "hostname"
     assert result[1].hostname == "hostname2"
 
     assert mock_socket.call_count == 2
-    assert mock_socket.call_args_list[0][0][0] == "127.0.0.63"
-    assert mock_socket.call_args_list[1][0][0] == "127.0.0.64"
+    assert {i[0][0] for i in mock_socket.call_args_list} == set(hostnames)
 
 
 @pytest.fixture(name="example_dict_services")
@@ -150,12 +151,13 @@ def test_openstack_address_populate_services(
     """
     Tests the OpenstackAddress class with services multiple network addresses
     """
-    mock_socket.side_effect = [("hostname", None, None), ("hostname2", None, None)]
+    # Lookups run concurrently, so return hostnames by address not call order
+    hostnames = {"127.0.0.63": "hostname", "127.0.0.64": "hostname2"}
+    mock_socket.side_effect = lambda ip: (hostnames[ip], None, None)
     result = OpenstackAddress.get_services_networks(example_dict_two_entries_services)
 
     assert result[0].hostname == "hostname"
     assert result[1].hostname == "hostname2"
 
     assert mock_socket.call_count == 2
-    assert mock_socket.call_args_list[0][0][0] == "127.0.0.63"
-    assert mock_socket.call_args_list[1][0][0] == "127.0.0.64"
+    assert {i[0][0] for i in mock_socket.call_args_list} == set(hostnames)
@@ -4,15 +4,26 @@
 Tests that the Openstack API functions are invoked
 as expected with the correct params
 """
-from unittest.mock import NonCallableMock, patch
+from datetime import datetime, timedelta, timezone
+from unittest.mock import NonCallableMagicMock, NonCallableMock, patch
+
+import pytest
+from keystoneauth1.exceptions import ConnectFailure
+from openstack.exceptions import HttpException, ResourceNotFound
+
+from rabbit_consumer.circuit_breaker import CircuitOpenError
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.openstack_api import (
     update_metadata,
     OpenstackConnection,
+    OpenstackConnectionManager,
     check_machine_exists,
     get_server_details,
+    get_server_metadata,
+    list_servers,
     get_server_networks,
+    get_server_snapshot,
     get_image,
 )
 
@@ -36,12 +47,187 @@ def test_openstack_connection(mock_connect, mock_config):
         # Pylint is unable to see that openstack.connect returns a mock
         # pylint: disable=no-member
         assert conn == mock_connect.return_value
-        # pylint: disable=no-member
-        assert conn.close.call_count == 0
+        conn.authorize.assert_called_once_with()
 
-    # Check close is called when the context manager exits
+    # The connection is shared, so it should stay open after the context exits
     # pylint: disable=no-member
-    assert conn.close.call_count == 1
+    assert conn.close.call_count == 0
+
+
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_is_reused(mock_connect, _):
+    """
+    Test that the connection is only authenticated once across many uses
+    """
+    for _ in range(3):
+        with OpenstackConnection() as conn:
+            assert conn == mock_connect.return_value
+
+    mock_connect.assert_called_once()
+    mock_connect.return_value.authorize.assert_called_once_with()
+
+
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_connection_manager_refreshes_expiring_token(mock_connect):
+    """
+    Test that a token expiring within the margin is refreshed before use
+    """
+    config = NonCallableMock()
+    config.openstack_token_margin = 300
+    auth = mock_connect.return_value.session.auth
+    auth.auth_ref.expires = datetime.now(timezone.utc) + timedelta(seconds=60)
+
+    manager = OpenstackConnectionManager(config)
+    manager.get_connection()
+    auth.invalidate.assert_not_called()
+
+    manager.get_connection()
+    auth.invalidate.assert_called_once_with()
+    assert mock_connect.return_value.authorize.call_count == 2
+    mock_connect.assert_called_once()
+
+
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_connection_manager_keeps_valid_token(mock_connect):
+    """
+    Test that a token outside the margin is re-used as is
+    """
+    config = NonCallableMock()
+    config.openstack_token_margin = 300
+    auth = mock_connect.return_value.session.auth
+    auth.auth_ref.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    manager = OpenstackConnectionManager(config)
+    manager.get_connection()
+    manager.get_connection()
+
+    auth.invalidate.assert_not_called()
+    mock_connect.return_value.authorize.assert_called_once_with()
+
+
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_reauthenticates_on_401(mock_connect, config):
+    """
+    Test that the shared connection re-authenticates when Openstack returns
+    a 401, without closing it under other threads
+    """
+    config.return_value.openstack_token_margin = 300
+    auth = mock_connect.return_value.session.auth
+    auth.auth_ref.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    with pytest.raises(HttpException):
+        with OpenstackConnection():
+            error = HttpException()
+            error.status_code = 401
+            raise error
+
+    mock_connect.return_value.close.assert_not_called()
+    auth.invalidate.assert_not_called()
+
+    with OpenstackConnection():
+        pass
+    auth.invalidate.assert_called_once_with()
+    assert mock_connect.return_value.authorize.call_count == 2
+    mock_connect.assert_called_once()
+
+
+@pytest.mark.parametrize("status_code,dropped", [(503, True), (404, False)])
+@patch("rabbit_consumer.openstack_api.get_limiter")
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_reports_overload(
+    _, __, get_limiter, status_code, dropped
+):
+    """
+    Test that each use holds a slot under the limit, and overloaded
+    responses are reported to the limiter
+    """
+    limiter = get_limiter.return_value
+    with pytest.raises(HttpException):
+        with OpenstackConnection("get_server"):
+            limiter.acquire.assert_called_once_with("get_server")
+            error = HttpException()
+            error.status_code = status_code
+            raise error
+
+    get_limiter.assert_called_once_with("openstack")
+    call = limiter.acquire.return_value
+    limiter.release.assert_called_once_with(call)
+    assert call.dropped == dropped
+
+
+@patch("rabbit_consumer.openstack_api.get_breaker")
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_circuit_open(mock_connect, _, get_breaker):
+    """
+    Test that nothing is sent while the upstream's circuit is open
+    """
+    get_breaker.return_value.allow.side_effect = CircuitOpenError("glance", 30)
+    with pytest.raises(CircuitOpenError):
+        with OpenstackConnection("find_image", upstream="glance"):
+            pass
+
+    get_breaker.assert_called_once_with("glance")
+    mock_connect.assert_not_called()
+
+
+@pytest.mark.parametrize("status_code,failed", [(404, False), (503, True)])
+@patch("rabbit_consumer.openstack_api.get_breaker")
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_records_outcome(_, __, get_breaker, status_code, failed):
+    """
+    Test that the outcome of each use is recorded against Nova's circuit
+    """
+    with pytest.raises(HttpException):
+        with OpenstackConnection():
+            error = HttpException()
+            error.status_code = status_code
+            raise error
+
+    get_breaker.assert_any_call("nova")
+    get_breaker.return_value.record.assert_called_with(failed)
+
+
+@patch("rabbit_consumer.openstack_api.get_breaker")
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_keystone_down(mock_connect, _, get_breaker):
+    """
+    Test that a Keystone outage counts against Keystone's circuit, not Nova's,
+    and the connection is rebuilt on next use
+    """
+    nova, keystone = NonCallableMagicMock(), NonCallableMagicMock()
+    get_breaker.side_effect = lambda upstream: {"nova": nova, "keystone": keystone}[
+        upstream
+    ]
+    mock_connect.return_value.authorize.side_effect = ConnectFailure()
+
+    for _ in range(2):
+        with pytest.raises(ConnectFailure):
+            with OpenstackConnection():
+                pass
+
+    assert mock_connect.call_count == 2
+    assert keystone.protect.return_value.__enter__.return_value.failed
+    nova.record.assert_called_with(None)
+
+
+@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_keeps_connection_on_other_errors(mock_connect, _):
+    """
+    Test that other errors do not drop the shared connection
+    """
+    with pytest.raises(HttpException):
+        with OpenstackConnection():
+            error = HttpException()
+            error.status_code = 404
+            raise error
+
+    mock_connect.return_value.close.assert_not_called()
 
 
 @patch("rabbit_consumer.openstack_api.OpenstackConnection")
@@ -53,7 +239,7 @@ def test_check_machine_exists_existing_machine(conn, vm_data):
     context.compute.find_server.return_value = NonCallableMock()
     found = check_machine_exists(vm_data)
 
-    conn.assert_called_once_with()
+    conn.assert_called_once_with("find_server")
     context.compute.find_server.assert_called_with(vm_data.virtual_machine_id)
     assert isinstance(found, bool) and found
 
@@ -67,27 +253,23 @@ def test_check_machine_exists_deleted_machine(conn, vm_data):
     context.compute.find_server.return_value = None
     found = check_machine_exists(vm_data)
 
-    conn.assert_called_once_with()
+    conn.assert_called_once_with("find_server")
     context = conn.return_value.__enter__.return_value
     context.compute.find_server.assert_called_with(vm_data.virtual_machine_id)
     assert isinstance(found, bool) and not found
 
 
 @patch("rabbit_consumer.openstack_api.OpenstackConnection")
-@patch("rabbit_consumer.openstack_api.get_server_details")
-def test_update_metadata(server_details, conn, vm_data):
+def test_update_metadata(conn, server_snapshot):
     """
     Test that the function calls the correct functions to update the metadata on a VM
     """
-    server_details.return_value = NonCallableMock()
-    update_metadata(vm_data, {"key": "value"})
-
-    server_details.assert_called_once_with(vm_data)
+    update_metadata(server_snapshot, {"key": "value"})
 
-    conn.assert_called_once_with()
+    conn.assert_called_once_with("set_server_metadata")
     context = conn.return_value.__enter__.return_value
     context.compute.set_server_metadata.assert_called_once_with(
-        server_details.return_value, **{"key": "value"}
+        server_snapshot.server, **{"key": "value"}
     )
 
 
@@ -97,97 +279,168 @@ def test_get_server_details(conn, vm_data):
     Test that the function calls the correct functions to get the details of a VM
     """
     context = conn.return_value.__enter__.return_value
-    context.compute.servers.return_value = [NonCallableMock()]
 
     result = get_server_details(vm_data)
 
-    context.compute.servers.assert_called_once_with(
-        uuid=vm_data.virtual_machine_id, all_projects=True
-    )
+    context.compute.get_server.assert_called_once_with(vm_data.virtual_machine_id)
+    assert result == context.compute.get_server.return_value
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_server_details_not_found(conn, vm_data):
+    """
+    Test that the function raises a ValueError when the VM does not exist
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.get_server.side_effect = ResourceNotFound()
 
-    assert result == context.compute.servers.return_value[0]
+    with pytest.raises(ValueError):
+        get_server_details(vm_data)
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_list_servers(conn):
+    """
+    Test that every server across all projects is listed with its details
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = iter(["server1", "server2"])
+
+    assert list_servers() == ["server1", "server2"]
+    context.compute.servers.assert_called_once_with(details=True, all_projects=True)
 
 
 @patch("rabbit_consumer.openstack_api.get_server_details")
+def test_get_server_snapshot(server_details, vm_data):
+    """
+    Test that the snapshot holds the server fetched from Openstack
+    """
+    snapshot = get_server_snapshot(vm_data)
+
+    server_details.assert_called_once_with(vm_data)
+    assert snapshot.vm_data == vm_data
+    assert snapshot.server == server_details.return_value
+    assert snapshot.exists
+
+
+@patch("rabbit_consumer.openstack_api.get_server_details")
+def test_get_server_snapshot_missing_server(server_details, vm_data):
+    """
+    Test that the snapshot records a server which no longer exists
+    """
+    server_details.side_effect = ValueError()
+    snapshot = get_server_snapshot(vm_data)
+
+    assert snapshot.server is None
+    assert not snapshot.exists
+
+
 @patch("rabbit_consumer.openstack_api.OpenstackAddress")
-def test_get_server_networks_internal(address, server_details, vm_data):
+def test_get_server_networks_internal(address, server_snapshot):
     """
     Test that the function calls the correct functions to get the networks of a VM
     """
-    server_details.return_value.addresses = {"Internal": []}
+    server_snapshot.server.addresses = {"Internal": []}
 
-    get_server_networks(vm_data)
+    get_server_networks(server_snapshot)
     address.get_internal_networks.assert_called_once_with(
-        server_details.return_value.addresses
+        server_snapshot.server.addresses
     )
 
 
-@patch("rabbit_consumer.openstack_api.get_server_details")
 @patch("rabbit_consumer.openstack_api.OpenstackAddress")
-def test_get_server_networks_services(address, server_details, vm_data):
+def test_get_server_networks_services(address, server_snapshot):
     """
     Test that the function calls the correct functions to get the networks of a VM
     """
-    server_details.return_value.addresses = {"Services": []}
+    server_snapshot.server.addresses = {"Services": []}
 
-    get_server_networks(vm_data)
+    get_server_networks(server_snapshot)
     address.get_services_networks.assert_called_once_with(
-        server_details.return_value.addresses
+        server_snapshot.server.addresses
     )
 
 
-@patch("rabbit_consumer.openstack_api.get_server_details")
-def test_get_server_networks_no_network(server_details, vm_data):
+def test_get_server_networks_no_network(server_snapshot):
     """
     Tests that an empty list is returned when there are no networks
     """
-    server_details.return_value = NonCallableMock()
-    server_details.return_value.addresses = {}
+    server_snapshot.server.addresses = {}
 
-    result = get_server_networks(vm_data)
+    result = get_server_networks(server_snapshot)
     assert not result
 
 
-@patch("rabbit_consumer.openstack_api.get_server_details")
-def test_get_image_no_image_id(server_details, vm_data):
+def test_get_server_metadata(server_snapshot):
+    """
+    Tests that the metadata is taken from the snapshot without another lookup
+    """
+    assert get_server_metadata(server_snapshot) == server_snapshot.server.metadata
+
+
+def test_get_image_no_image_id(server_snapshot):
     """
     Tests that get image handles an empty image UUID
     usually when a volume was used instead of an image
     """
-    server_details.return_value = NonCallableMock()
-    server_details.return_value.image.id = None
+    server_snapshot.server.image.id = None
 
-    result = get_image(vm_data)
+    result = get_image(server_snapshot)
     assert not result
 
 
-@patch("rabbit_consumer.openstack_api.get_server_details")
-def test_get_image_no_image(server_details, vm_data):
+def test_get_image_no_image(server_snapshot):
     """
     Tests that get image handles a None type image, since this
     is another edge-case we've seen when a volume was used
     """
-    server_details.return_value = NonCallableMock()
-    server_details.return_value.image = None
+    server_snapshot.server.image = None
 
-    result = get_image(vm_data)
+    result = get_image(server_snapshot)
     assert not result
 
 
 @patch("rabbit_consumer.openstack_api.OpenstackConnection")
-@patch("rabbit_consumer.openstack_api.get_server_details")
-def test_get_image_valid_data(server_details, conn, vm_data):
+def test_get_image_valid_data(conn, server_snapshot):
     """
     Tests that get image handles a valid image
     """
-    server_details.return_value = NonCallableMock()
-    server_details.return_value.image.id = "UUID-1234"
+    server_snapshot.server.image.id = "UUID-1234"
 
     openstack_connection = conn.return_value.__enter__.return_value
     find_image_result = NonCallableMock()
     openstack_connection.compute.find_image.return_value = find_image_result
 
-    result = get_image(vm_data)
+    result = get_image(server_snapshot)
 
     openstack_connection.compute.find_image.assert_called_once_with("UUID-1234")
     assert result == find_image_result
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_image_uses_cache(conn, server_snapshot):
+    """
+    Tests that repeated lookups for the same image only query Openstack once
+    """
+    server_snapshot.server.image.id = "UUID-1234"
+    openstack_connection = conn.return_value.__enter__.return_value
+
+    first = get_image(server_snapshot)
+    second = get_image(server_snapshot)
+
+    openstack_connection.compute.find_image.assert_called_once_with("UUID-1234")
+    assert first == second == openstack_connection.compute.find_image.return_value
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_image_does_not_cache_missing(conn, server_snapshot):
+    """
+    Tests that a missing image is looked up again next time
+    """
+    server_snapshot.server.image.id = "UUID-1234"
+    openstack_connection = conn.return_value.__enter__.return_value
+    openstack_connection.compute.find_image.return_value = None
+
+    assert not get_image(server_snapshot)
+    assert not get_image(server_snapshot)
+    assert openstack_connection.compute.find_image.call_count == 2
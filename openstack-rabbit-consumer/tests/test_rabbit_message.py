@@ -8,7 +8,7 @@ from typing import Dict
 
 import pytest
 
-from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.rabbit_message import RabbitMessage, sniff_event_type
 
 
 def _example_dict(with_metadata: bool) -> Dict:
@@ -74,3 +74,94 @@ def test_with_metadata(example_json_with_metadata):
     """
     deserialized = RabbitMessage.from_json(example_json_with_metadata)
     assert deserialized.payload.metadata.machine_name == "machine_name"
+
+
+def test_payload_first_fields():
+    """
+    Tests that the image, instance metadata and fixed IPs are decoded
+    for payload-first mode, keeping the metadata the same as before
+    """
+    example = _example_dict(with_metadata=True)
+    example["payload"]["image_ref_url"] = "https://image.example.com/images/image_id"
+    example["payload"]["fixed_ips"] = [
+        {
+            "address": "10.0.0.1",
+            "version": 4,
+            "label": "Internal",
+            "vif_mac": "fa:16:3e:00:00:01",
+            "type": "fixed",
+            "meta": {},
+        }
+    ]
+    deserialized = RabbitMessage.from_json(json.dumps(example))
+
+    payload = deserialized.payload
+    assert payload.metadata.machine_name == "machine_name"
+    assert payload.instance_metadata == {"AQ_MACHINENAME": "machine_name"}
+    assert payload.image_id == "image_id"
+    assert payload.fixed_ips[0].address == "10.0.0.1"
+    assert payload.fixed_ips[0].vif_mac == "fa:16:3e:00:00:01"
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("https://image.example.com/images/image_id", "image_id"),
+        ("https://image.example.com/v2/images/image_id?x=1", "image_id"),
+        ("https://image.example.com/images/", None),
+        ("https://image.example.com/images", None),
+        ("", None),
+    ],
+)
+def test_payload_image_id(example_json, url, expected):
+    """
+    Tests that volume-backed VMs, whose URL is just the images collection,
+    have no image ID
+    """
+    payload = RabbitMessage.from_json(example_json).payload
+    payload.image_ref_url = url
+    assert payload.image_id == expected
+
+
+def test_payload_first_fields_missing(example_json):
+    """
+    Tests that messages without the payload-first fields still decode
+    """
+    payload = RabbitMessage.from_json(example_json).payload
+    assert payload.image_id is None
+    assert payload.fixed_ips == []
+    assert payload.instance_metadata == {}
+
+
+def test_sniff_event_type_from_envelope(example_json):
+    """
+    Tests that the event type is found within the escaped oslo.message string
+    """
+    envelope = json.dumps({"oslo.version": "2.0", "oslo.message": example_json})
+    assert sniff_event_type(envelope.encode("utf-8")) == "compute.instance.create.end"
+
+
+def test_sniff_event_type_unescaped(example_json):
+    """
+    Tests that the event type is found in a message which isn't wrapped
+    """
+    assert sniff_event_type(example_json.encode("utf-8")) == (
+        "compute.instance.create.end"
+    )
+
+
+def test_sniff_event_type_missing():
+    """
+    Tests that None is returned when there is no event type
+    """
+    assert sniff_event_type(b'{"oslo.message": "{}"}') is None
+
+
+def test_sniff_event_type_ambiguous():
+    """
+    Tests that None is returned when more than one event type is found,
+    so the caller falls back to decoding the message
+    """
+    example = _example_dict(with_metadata=False)
+    example["payload"]["event_type"] = "compute.instance.update"
+    assert sniff_event_type(json.dumps(example).encode("utf-8")) is None
@@ -0,0 +1,207 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the bulk reconciliation of Aquilon with Openstack
+"""
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+
+from benchmarks.fake_servers import FakeAquilon, FakeOpenstack
+from benchmarks.load_benchmark import fake_environment, make_load, run_load
+from rabbit_consumer.rabbit_message import SUPPORTED_MESSAGE_TYPES
+from rabbit_consumer.reconcile import (
+    ReconcilePlan,
+    apply_plan,
+    build_plan,
+    fetch_plan,
+    main,
+    server_to_message,
+)
+
+
+def _server(server_id: str, status: str = "ACTIVE") -> NonCallableMock:
+    server = NonCallableMock()
+    server.id = server_id
+    server.status = status
+    return server
+
+
+@patch("rabbit_consumer.reconcile.is_aq_managed_image")
+def test_build_plan(is_aq_managed):
+    """
+    Tests that only active Aquilon servers without a machine are created,
+    and only machines without any server are deleted
+    """
+    servers = [
+        _server("has_machine"),
+        _server("missing"),
+        _server("not_aq"),
+        _server("not_active", status="BUILD"),
+    ]
+    is_aq_managed.side_effect = lambda snapshot: snapshot.server.id != "not_aq"
+    machines = {"has_machine": "vm-1", "orphan": "vm-2"}
+
+    plan = build_plan(servers, machines, "vm-")
+
+    assert plan.creates == [servers[1]]
+    assert plan.deletes == {"orphan": "vm-2"}
+
+
+@patch("rabbit_consumer.reconcile.is_aq_managed_image")
+def test_build_plan_keeps_other_prefixes(_):
+    """
+    Tests that machines named by another deployment sharing Aquilon
+    are never planned for deletion
+    """
+    machines = {"ours": "vm-dev-1", "theirs": "vm-prod-1"}
+
+    plan = build_plan([], machines, "vm-dev-")
+
+    assert plan.deletes == {"ours": "vm-dev-1"}
+
+
+@patch("rabbit_consumer.reconcile.is_aq_managed_image")
+def test_build_plan_checks_each_image_once(is_aq_managed):
+    """
+    Tests that servers sharing an image only check it once
+    """
+    servers = [_server(f"server{i}") for i in range(3)]
+    servers[1].image = servers[0].image
+    is_aq_managed.side_effect = lambda snapshot: snapshot.server.id != "server2"
+
+    plan = build_plan(servers, {}, "vm-", workers=2)
+
+    assert plan.creates == servers[:2]
+    assert is_aq_managed.call_count == 2
+
+
+@patch("rabbit_consumer.reconcile.ConsumerConfig")
+@patch("rabbit_consumer.reconcile.build_plan")
+@patch("rabbit_consumer.reconcile.openstack_api")
+@patch("rabbit_consumer.reconcile.aq_api")
+def test_fetch_plan_lists_machines_first(aq_api, openstack_api, build, config):
+    """
+    Tests that machines are listed before servers, so a VM created in
+    between isn't planned as an orphan
+    """
+    calls = []
+    aq_api.search_machines_by_model.side_effect = (
+        lambda _: calls.append("machines") or {}
+    )
+    openstack_api.list_servers.side_effect = lambda: calls.append("servers") or []
+
+    assert fetch_plan(workers=4) == build.return_value
+    assert calls == ["machines", "servers"]
+    build.assert_called_once_with([], {}, config.return_value.aq_prefix, 4)
+
+
+@patch("rabbit_consumer.reconcile.ConsumerConfig")
+@patch("rabbit_consumer.reconcile.aq_api")
+def test_fetch_plan_needs_prefix(aq_api, config):
+    """
+    Tests that a plan isn't made without a prefix to tell our machines apart
+    """
+    config.return_value.aq_prefix = None
+    with pytest.raises(ValueError):
+        fetch_plan()
+    aq_api.search_machines_by_model.assert_not_called()
+
+
+def test_server_to_message():
+    """
+    Tests that a server is converted to the create message Nova would send
+    """
+    server = _server("instance_id_mock")
+    message = server_to_message(server)
+
+    assert message.event_type == SUPPORTED_MESSAGE_TYPES["create"]
+    assert message.project_id == server.project_id
+    assert message.payload.instance_id == "instance_id_mock"
+    assert message.payload.vcpus == server.flavor.vcpus
+    assert message.payload.memory_mb == server.flavor.ram
+    assert message.payload.vm_host == server.compute_host
+
+
+@patch("rabbit_consumer.reconcile.delete_machine")
+@patch("rabbit_consumer.reconcile.handle_create_machine")
+def test_apply_plan_counts_failures(create, delete, capsys):
+    """
+    Tests that a failed change is reported without stopping the others
+    """
+    create.side_effect = RuntimeError()
+    plan = ReconcilePlan(creates=[_server("missing")], deletes={"orphan": "vm-2"})
+
+    report = apply_plan(plan, workers=2)
+
+    assert report.succeeded == 1
+    assert report.failed == ["create missing"]
+    delete.assert_called_once()
+    assert delete.call_args.args[0].virtual_machine_id == "orphan"
+    assert "Progress: 2/2 (1 failed)" in capsys.readouterr().out
+
+
+@patch("rabbit_consumer.reconcile.apply_plan")
+@patch("rabbit_consumer.reconcile.fetch_plan")
+def test_main_dry_run(fetch, apply, capsys):
+    """
+    Tests that a dry run lists the changes without applying them
+    """
+    fetch.return_value = ReconcilePlan(deletes={"orphan": "vm-2"})
+    main(["--dry-run"])
+
+    apply.assert_not_called()
+    assert "Would delete machine vm-2 (orphan)" in capsys.readouterr().out
+
+
+@patch("rabbit_consumer.reconcile.apply_plan")
+@patch("rabbit_consumer.reconcile.fetch_plan")
+def test_main_refuses_large_deletes(fetch, apply):
+    """
+    Tests that a plan with many deletes is only applied when forced
+    """
+    fetch.return_value = ReconcilePlan(deletes={f"s{i}": f"vm-{i}" for i in range(3)})
+    apply.return_value.failed = []
+
+    with pytest.raises(SystemExit):
+        main(["--max-deletes", "2"])
+    apply.assert_not_called()
+
+    main(["--max-deletes", "2", "--force"])
+    apply.assert_called_once()
+
+
+@patch("rabbit_consumer.reconcile.stop_make_batcher")
+@patch("rabbit_consumer.reconcile.apply_plan")
+@patch("rabbit_consumer.reconcile.fetch_plan")
+def test_main_makes_queued_hosts(fetch, apply, stop_make_batcher):
+    """
+    Tests that hosts queued to be made are made before exiting, even on failure
+    """
+    fetch.return_value = ReconcilePlan()
+    apply.side_effect = RuntimeError()
+    with pytest.raises(RuntimeError):
+        main([])
+    stop_make_batcher.assert_called_once_with()
+
+
+def test_reconcile_against_fakes():
+    """
+    Tests that reconciling creates missing machines and deletes orphans
+    """
+    with FakeAquilon() as aquilon, FakeOpenstack() as openstack:
+        load = make_load(openstack, vms=3, lag=3)
+        with fake_environment(aquilon, openstack):
+            run_load(load[:2], workers=1)
+            # The first server was deleted whilst the consumer was down
+            orphan = load[0][0]
+            del openstack.servers[orphan]
+
+            plan = fetch_plan()
+            assert [i.id for i in plan.creates] == [load[2][0]]
+            assert list(plan.deletes) == [orphan]
+
+            report = apply_plan(plan, workers=2)
+
+    assert not report.failed
+    assert {i.serial for i in aquilon.machines.values()} == set(openstack.servers)
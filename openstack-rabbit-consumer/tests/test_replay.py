@@ -0,0 +1,149 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests recording messages and replaying them through the consumer
+"""
+from unittest.mock import Mock, patch
+
+import pytest
+
+from rabbit_consumer.replay import (
+    RecordedMessage,
+    ReplayReport,
+    main,
+    read_dump,
+    read_recording,
+    replay,
+    tap_queue,
+    write_recording,
+)
+
+
+@pytest.mark.parametrize("body", [b'{"oslo.message": "{}"}', b"\xff\xfe"])
+def test_recording_round_trip(tmp_path, body):
+    """
+    Tests that messages, including non UTF-8 bodies, survive being recorded
+    """
+    path = str(tmp_path / "recording.gz")
+    messages = [RecordedMessage(0.0, body), RecordedMessage(1.5, body)]
+
+    assert write_recording(path, messages) == 2
+    assert list(read_recording(path)) == messages
+
+
+def test_read_dump(tmp_path):
+    """
+    Tests that each line of a dump is read as a message with no timing
+    """
+    path = tmp_path / "dump.txt"
+    path.write_bytes(b"first\n\nsecond\n")
+
+    assert list(read_dump(str(path))) == [
+        RecordedMessage(0.0, b"first"),
+        RecordedMessage(0.0, b"second"),
+    ]
+
+
+def test_replay_max_speed():
+    """
+    Tests that each message is fed to the handler, counting failures
+    """
+    handler = Mock(side_effect=[None, ValueError, None])
+    messages = [RecordedMessage(i, f"body{i}".encode()) for i in range(3)]
+
+    with patch("rabbit_consumer.replay.time.sleep") as sleep:
+        report = replay(messages, speed=0, handler=handler)
+
+    sleep.assert_not_called()
+    assert [i[0][0].body for i in handler.call_args_list] == [
+        b"body0",
+        b"body1",
+        b"body2",
+    ]
+    assert (report.count, report.failed) == (3, 1)
+
+
+@patch("rabbit_consumer.replay.time")
+def test_replay_paced(mock_time):
+    """
+    Tests that messages are held until their original offset, scaled by speed
+    """
+    mock_time.monotonic.return_value = 100.0
+    messages = [RecordedMessage(0.0, b"first"), RecordedMessage(4.0, b"second")]
+
+    replay(messages, speed=2, handler=Mock())
+    mock_time.sleep.assert_called_once_with(2.0)
+
+
+@patch("rabbit_consumer.replay.generate_login_str")
+@patch("rabbit_consumer.replay.rabbitpy")
+@patch("rabbit_consumer.replay.time")
+def test_tap_queue_duration_without_messages(mock_time, rabbitpy, _):
+    """
+    Tests that recording stops after the duration, even if no messages arrive
+    """
+    mock_time.monotonic.side_effect = [100.0, 100.0, 100.5, 101.0]
+    queue = rabbitpy.Queue.return_value
+    queue.get.return_value = None
+
+    assert not list(tap_queue(Mock(), count=None, duration=1))
+    assert queue.get.call_count == 2
+    mock_time.sleep.assert_called_with(0.5)
+
+
+@patch("rabbit_consumer.replay.generate_login_str")
+@patch("rabbit_consumer.replay.rabbitpy")
+@patch("rabbit_consumer.replay.time")
+def test_tap_queue_count(mock_time, rabbitpy, _):
+    """
+    Tests that recording stops once enough messages have been copied
+    """
+    mock_time.monotonic.return_value = 100.0
+    queue = rabbitpy.Queue.return_value
+    queue.get.side_effect = [Mock(body=b"first"), None, Mock(body=b"second")]
+
+    assert [i.body for i in tap_queue(Mock(), count=2, duration=None)] == [
+        b"first",
+        b"second",
+    ]
+    queue.get.assert_called_with(acknowledge=False)
+    mock_time.sleep.assert_called_once_with(0.5)
+
+
+def test_report_percentiles():
+    """
+    Tests the nearest rank percentiles and throughput
+    """
+    report = ReplayReport(elapsed=2.0, latencies=[0.1 * i for i in range(1, 11)])
+
+    assert report.throughput == 5.0
+    assert report.percentile(50) == pytest.approx(0.5)
+    assert report.percentile(90) == pytest.approx(0.9)
+    assert report.percentile(100) == pytest.approx(1.0)
+    assert ReplayReport().percentile(50) == 0.0
+
+
+@patch("rabbit_consumer.replay.stop_make_batcher")
+@patch("rabbit_consumer.replay.replay")
+def test_main_replay_makes_queued_hosts(replay_mock, stop_make_batcher, tmp_path):
+    """
+    Tests that hosts queued to be made are made before exiting
+    """
+    path = str(tmp_path / "recording.gz")
+    write_recording(path, [])
+    main(["replay", path])
+
+    replay_mock.assert_called_once()
+    stop_make_batcher.assert_called_once_with()
+
+
+def test_main_converts_dump(tmp_path):
+    """
+    Tests that the record command can convert a dump to a recording
+    """
+    dump = tmp_path / "dump.txt"
+    dump.write_bytes(b"first\n")
+    output = str(tmp_path / "recording.gz")
+
+    main(["record", "--dump", str(dump), "--output", output])
+    assert list(read_recording(output)) == [RecordedMessage(0.0, b"first")]
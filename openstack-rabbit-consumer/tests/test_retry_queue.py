@@ -0,0 +1,192 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that failed messages are parked on retry queues,
+then moved to the dead-letter queue once out of attempts
+"""
+from unittest.mock import Mock, NonCallableMock, call, patch
+
+import pytest
+
+from rabbit_consumer.circuit_breaker import CircuitOpenError
+from rabbit_consumer.retry_queue import (
+    LAST_ERROR_HEADER,
+    RETRY_COUNT_HEADER,
+    RetryHandler,
+)
+
+
+@pytest.fixture(name="retry_handler")
+def fixture_retry_handler():
+    """
+    Provides a retry handler with three attempts
+    """
+    config = NonCallableMock()
+    config.retry_max_attempts = 3
+    config.retry_base_delay = 10
+    config.retry_max_delay = 15
+    return RetryHandler("ral.info", config)
+
+
+def _message(retry_count=None) -> Mock:
+    message = Mock()
+    message.body = b"body"
+    message.properties = {"content_type": "application/json", "headers": None}
+    if retry_count is not None:
+        message.properties["headers"] = {RETRY_COUNT_HEADER: retry_count}
+    return message
+
+
+def test_get_delay_is_capped(retry_handler):
+    """
+    Tests that the delay doubles on each attempt up to the max
+    """
+    assert [retry_handler.get_delay(i) for i in range(1, 4)] == [10, 15, 15]
+    assert retry_handler.get_retry_queue(1) == "ral.info.retry.10s"
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_declare(rabbitpy, retry_handler):
+    """
+    Tests that each retry queue dead-letters back to the main queue
+    """
+    channel = NonCallableMock()
+    retry_handler.declare(channel)
+
+    assert rabbitpy.Queue.call_args_list == [
+        call(
+            channel,
+            name="ral.info.retry.10s",
+            durable=True,
+            message_ttl=10000,
+            dead_letter_routing_key="ral.info",
+            arguments={"x-dead-letter-exchange": ""},
+        ),
+        call(
+            channel,
+            name="ral.info.retry.15s",
+            durable=True,
+            message_ttl=15000,
+            dead_letter_routing_key="ral.info",
+            arguments={"x-dead-letter-exchange": ""},
+        ),
+        call(channel, name="ral.info.dead", durable=True),
+    ]
+    assert rabbitpy.Queue.return_value.declare.call_count == 3
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_run_success(rabbitpy, retry_handler):
+    """
+    Tests that a successful message is acked and not republished
+    """
+    message, task = _message(), Mock()
+    assert retry_handler.run(message, task)
+
+    task.assert_called_once()
+    message.ack.assert_called_once()
+    rabbitpy.Message.assert_not_called()
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_run_failure_retries(rabbitpy, retry_handler):
+    """
+    Tests that a failed message is republished to the first retry queue
+    with its headers updated, then acked
+    """
+    message = _message()
+    assert not retry_handler.run(message, Mock(side_effect=ValueError("bad")))
+
+    channel, body, properties = rabbitpy.Message.call_args[0]
+    assert (channel, body) == (message.channel, b"body")
+    assert properties["content_type"] == "application/json"
+    assert properties["headers"] == {
+        RETRY_COUNT_HEADER: 1,
+        LAST_ERROR_HEADER: "ValueError: bad",
+    }
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key="ral.info.retry.10s"
+    )
+    message.ack.assert_called_once()
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_retry_moves_to_dead_letter_queue(rabbitpy, retry_handler):
+    """
+    Tests that a message on its last attempt is moved to the dead-letter queue
+    """
+    retry_handler.retry(_message(retry_count=2), ValueError("bad"))
+
+    properties = rabbitpy.Message.call_args[0][2]
+    assert properties["headers"][RETRY_COUNT_HEADER] == 3
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key="ral.info.dead"
+    )
+
+
+@pytest.mark.parametrize(
+    "retry_count,routing_key", [(None, "ral.info.retry.10s"), (2, "ral.info.retry.15s")]
+)
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_run_circuit_open_parks(rabbitpy, retry_handler, retry_count, routing_key):
+    """
+    Tests that a message rejected by an open circuit is parked on a retry
+    queue without using up an attempt, even on its last attempt
+    """
+    message = _message(retry_count)
+    task = Mock(side_effect=CircuitOpenError("aquilon", 30))
+    assert not retry_handler.run(message, task)
+
+    properties = rabbitpy.Message.call_args[0][2]
+    assert properties["headers"][RETRY_COUNT_HEADER] == (retry_count or 0)
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key=routing_key
+    )
+    message.ack.assert_called_once()
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_park_without_retry_queues(rabbitpy):
+    """
+    Tests that messages are dead-lettered if there are no retry queues
+    """
+    config = NonCallableMock()
+    config.retry_max_attempts = 1
+    RetryHandler("ral.info", config).park(_message(), CircuitOpenError("nova", 30))
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key="ral.info.dead"
+    )
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_dead_letter(rabbitpy, retry_handler):
+    """
+    Tests that a message can be dead-lettered without using its retries
+    """
+    retry_handler.dead_letter(_message(), ValueError("bad"))
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key="ral.info.dead"
+    )
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_run_publish_failure_is_not_acked(rabbitpy, retry_handler):
+    """
+    Tests that the message is left unacked if it can't be parked
+    """
+    rabbitpy.Message.return_value.publish.side_effect = ConnectionError
+    message = _message()
+
+    with pytest.raises(ConnectionError):
+        retry_handler.run(message, Mock(side_effect=ValueError))
+    message.ack.assert_not_called()
+
+
+def test_was_retried(retry_handler):
+    """
+    Tests that a message is known to have been retried once it has
+    been through a retry queue, even if parked without using an attempt
+    """
+    assert not retry_handler.was_retried(_message())
+    assert retry_handler.was_retried(_message(retry_count=0))
+    assert retry_handler.was_retried(_message(retry_count=2))
@@ -0,0 +1,85 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests building a server snapshot from the contents of a create message
+"""
+from unittest.mock import patch
+
+from rabbit_consumer.message_consumer import get_create_snapshot
+from rabbit_consumer.openstack_api import get_server_networks
+from rabbit_consumer.rabbit_message import RabbitFixedIp
+from rabbit_consumer.server_snapshot import ServerSnapshot
+
+
+@patch("rabbit_consumer.openstack_address.get_dns_resolver")
+def test_from_payload(resolver, rabbit_message, vm_data):
+    """
+    Tests that the server is laid out as Nova returns it
+    """
+    resolver.return_value.get_hostnames.return_value = ["host"]
+    payload = rabbit_message.payload
+    payload.image_ref_url = "https://image.example.com/images/image_id"
+    payload.instance_metadata = {"AQ_OS": "os_mock"}
+    payload.fixed_ips = [
+        RabbitFixedIp(address="10.0.0.1", version=4, label="Internal", vif_mac="mac")
+    ]
+
+    snapshot = ServerSnapshot.from_payload(vm_data, payload)
+
+    assert snapshot.exists
+    assert snapshot.server.id == payload.instance_id
+    assert snapshot.server.image.id == "image_id"
+    assert snapshot.server.metadata == {"AQ_OS": "os_mock"}
+    networks = get_server_networks(snapshot)
+    assert [(i.addr, i.mac_addr, i.hostname) for i in networks] == [
+        ("10.0.0.1", "mac", "host")
+    ]
+
+
+def test_from_payload_missing_details(rabbit_message, vm_data):
+    """
+    Tests that no snapshot is built if the message is missing details
+    """
+    assert ServerSnapshot.from_payload(vm_data, rabbit_message.payload) is None
+
+    rabbit_message.payload.image_ref_url = "https://image.example.com/images/image_id"
+    assert ServerSnapshot.from_payload(vm_data, rabbit_message.payload) is None
+
+
+@patch("rabbit_consumer.message_consumer.ServerSnapshot")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.ConsumerConfig")
+def test_get_create_snapshot_payload_first(
+    config, openstack_api, snapshot, rabbit_message, vm_data
+):
+    """
+    Tests that payload-first mode builds the server from the message,
+    falling back to Nova if the message is missing details
+    """
+    config.return_value.consumer_payload_first = True
+    result = get_create_snapshot(rabbit_message, vm_data)
+
+    snapshot.from_payload.assert_called_once_with(vm_data, rabbit_message.payload)
+    assert result == snapshot.from_payload.return_value
+    openstack_api.get_server_snapshot.assert_not_called()
+
+    snapshot.from_payload.return_value = None
+    result = get_create_snapshot(rabbit_message, vm_data)
+    assert result == openstack_api.get_server_snapshot.return_value
+
+
+@patch("rabbit_consumer.message_consumer.ServerSnapshot")
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.ConsumerConfig")
+def test_get_create_snapshot_default(
+    config, openstack_api, snapshot, rabbit_message, vm_data
+):
+    """
+    Tests that the server is fetched from Nova by default
+    """
+    config.return_value.consumer_payload_first = False
+    result = get_create_snapshot(rabbit_message, vm_data)
+
+    snapshot.from_payload.assert_not_called()
+    openstack_api.get_server_snapshot.assert_called_once_with(vm_data)
+    assert result == openstack_api.get_server_snapshot.return_value
@@ -0,0 +1,343 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that messages are routed to shards keyed on their instance ID
+"""
+import threading
+from unittest.mock import ANY, MagicMock, Mock, NonCallableMock, call, patch
+
+import pytest
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.message_consumer import QueueConsumer, initiate_consumer
+from rabbit_consumer.sharding import (
+    ShardRouter,
+    declare_shard_queue,
+    get_assigned_shards,
+    get_shard_exchange,
+    get_shard_name,
+)
+from rabbit_consumer.shutdown import QueueStopper, request_stop
+
+
+@pytest.fixture(name="mocked_config")
+def fixture_mocked_config():
+    """
+    Provides a config for the consumer
+    """
+    config = ConsumerConfig()
+    config.rabbit_hosts = "rabbit_host"
+    config.rabbit_port = 1234
+    config.rabbit_username = "rabbit_username"
+    config.rabbit_password = "rabbit_password"
+    return config
+
+
+@pytest.fixture(name="message")
+def fixture_message():
+    """
+    Provides a raw message with some properties unset
+    """
+    message = Mock()
+    message.body = b"body"
+    message.properties = {"message_id": "id", "headers": None}
+    return message
+
+
+def test_get_shard_name():
+    """
+    Tests that the shard name must be set, as the hostname isn't stable
+    """
+    config = NonCallableMock()
+    config.consumer_shard_name = ""
+    with pytest.raises(ValueError):
+        get_shard_name(config)
+
+    config.consumer_shard_name = "consumer-0"
+    assert get_shard_name(config) == "consumer-0"
+
+
+@pytest.mark.parametrize(
+    "name,replicas,expected",
+    [
+        ("consumer-0", 1, list(range(8))),
+        ("consumer-0", 3, [0, 3, 6]),
+        ("consumer-2", 3, [2, 5]),
+        ("consumer-7", 8, [7]),
+    ],
+)
+def test_get_assigned_shards(name, replicas, expected):
+    """
+    Tests that every logical shard is split between the replicas
+    """
+    config = NonCallableMock()
+    config.consumer_shard_name = name
+    config.consumer_shard_count = 8
+    config.consumer_shard_replicas = replicas
+    assert get_assigned_shards(config) == expected
+
+
+@pytest.mark.parametrize(
+    "name,replicas", [("consumer", 1), ("consumer-3", 3), ("consumer-8", 10)]
+)
+def test_get_assigned_shards_invalid(name, replicas):
+    """
+    Tests that a replica without an ordinal, or without any shards, is rejected
+    """
+    config = NonCallableMock()
+    config.consumer_shard_name = name
+    config.consumer_shard_count = 8
+    config.consumer_shard_replicas = replicas
+    with pytest.raises(ValueError):
+        get_assigned_shards(config)
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_declare_shard_queue(rabbitpy):
+    """
+    Tests that each shard's queue is bound to the consistent-hash exchange,
+    with only one consumer active at a time
+    """
+    channel = NonCallableMock()
+    queue = declare_shard_queue(channel, "ral.info", 3)
+
+    rabbitpy.Exchange.assert_called_once_with(
+        channel, "ral.info.sharded", exchange_type="x-consistent-hash", durable=True
+    )
+    rabbitpy.Exchange.return_value.declare.assert_called_once_with()
+    rabbitpy.Queue.assert_called_once_with(
+        channel,
+        name="ral.info.shard.3",
+        durable=True,
+        arguments={"x-single-active-consumer": True},
+    )
+    assert queue is rabbitpy.Queue.return_value
+    rabbitpy.Queue.return_value.declare.assert_called_once_with()
+    rabbitpy.Queue.return_value.bind.assert_called_once_with(
+        get_shard_exchange("ral.info"), routing_key="1"
+    )
+
+
+@patch("rabbit_consumer.sharding.declare_shard_queue")
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_declares_every_shard(_, declare_queue):
+    """
+    Tests that the router binds every shard's queue up front, so keys are
+    spread over the same shards however many replicas are running
+    """
+    channel = NonCallableMock()
+    ShardRouter(channel, "ral.info", Mock(), 4)
+    declare_queue.assert_has_calls([call(channel, "ral.info", i) for i in range(4)])
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_routes_by_instance_id(rabbitpy, message, rabbit_message):
+    """
+    Tests that the router republishes supported messages keyed on their
+    instance ID, with publisher confirms, then acks the original
+    """
+    channel = NonCallableMock()
+    router = ShardRouter(channel, "ral.info", Mock(return_value=rabbit_message), 4)
+    channel.enable_publisher_confirms.assert_called_once_with()
+
+    router.route(message)
+
+    rabbitpy.Message.assert_called_once_with(
+        message.channel, b"body", {"message_id": "id"}
+    )
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "ral.info.sharded", routing_key="instance_id_mock", mandatory=True
+    )
+    message.ack.assert_called_once_with()
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_drops_ignored_messages(rabbitpy, message):
+    """
+    Tests that messages we ignore are acked without being routed
+    """
+    router = ShardRouter(NonCallableMock(), "ral.info", Mock(return_value=None), 4)
+    router.route(message)
+
+    rabbitpy.Message.assert_not_called()
+    message.ack.assert_called_once_with()
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_unconfirmed_not_acked(rabbitpy, message, rabbit_message):
+    """
+    Tests that a message is left unacked if the broker rejects its copy
+    """
+    rabbitpy.Message.return_value.publish.return_value = False
+    router = ShardRouter(
+        NonCallableMock(), "ral.info", Mock(return_value=rabbit_message), 4
+    )
+
+    with pytest.raises(ConnectionError):
+        router.route(message)
+    message.ack.assert_not_called()
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_run(_, rabbit_message):
+    """
+    Tests that the router routes every message from the queue in order
+    """
+    messages = [Mock(properties={}), Mock(properties={})]
+    queue = Mock()
+    queue.__iter__ = Mock(return_value=iter(messages))
+
+    router = ShardRouter(
+        NonCallableMock(), "ral.info", Mock(return_value=rabbit_message), 4
+    )
+    router.run(QueueStopper(queue))
+
+    for message in messages:
+        message.ack.assert_called_once_with()
+
+
+def _queue(messages, done=None, error=None):
+    """
+    Returns a queue which yields the messages, then waits for done to be
+    set, as a queue is consumed until the consumer stops
+    """
+
+    def consume():
+        yield from messages
+        if error:
+            raise error
+        if done:
+            done.wait(5)
+
+    queue = MagicMock()
+    queue.__iter__.return_value = consume()
+    return queue
+
+
+def _shard_config(config):
+    config.consumer_role = "shard"
+    config.consumer_shard_name = "consumer-1"
+    config.consumer_shard_count = 4
+    config.consumer_shard_replicas = 2
+    return config
+
+
+@patch("rabbit_consumer.message_consumer.RetryHandler")
+@patch("rabbit_consumer.message_consumer.declare_shard_queue")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_initiate_consumer_shard(
+    rabbitpy, message_mock, _, declare_queue, retry_handler, mocked_config
+):
+    """
+    Test that a shard consumes the queue of each of its logical shards
+    on its own channel, retrying on that shard's queues
+    """
+    handled = threading.Event()
+    message_mock.side_effect = lambda *_: message_mock.call_count == 2 and handled.set()
+    queues = {1: _queue(["message-1"], handled), 3: _queue(["message-3"], handled)}
+    declare_queue.side_effect = lambda _, __, shard: queues[shard]
+    handlers = {}
+    retry_handler.side_effect = lambda name, _: handlers.setdefault(name, Mock())
+
+    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+        config.return_value = _shard_config(mocked_config)
+        initiate_consumer()
+
+    connection = rabbitpy.Connection.return_value.__enter__.return_value
+    assert connection.channel.call_count == 2
+    channel = connection.channel.return_value.__enter__.return_value
+    declare_queue.assert_has_calls(
+        [call(channel, "ral.info", 1), call(channel, "ral.info", 3)]
+    )
+    rabbitpy.Queue.assert_not_called()
+    message_mock.assert_has_calls(
+        [
+            call("message-1", handlers[queues[1].name]),
+            call("message-3", handlers[queues[3].name]),
+        ],
+        any_order=True,
+    )
+
+
+@patch("rabbit_consumer.message_consumer.declare_shard_queue")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_shard_fails(
+    _, message_mock, __, declare_queue, mocked_config
+):
+    """
+    Test that the consumer stops if any of its shards fails, e.g. as
+    its channel was closed, rather than carrying on without it
+    """
+    mocked_config.retry_max_attempts = 0
+    done = threading.Event()
+    queues = {1: _queue([], error=ConnectionError()), 3: _queue([], done)}
+    declare_queue.side_effect = lambda _, __, shard: queues[shard]
+
+    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+        config.return_value = _shard_config(mocked_config)
+        with pytest.raises(ConnectionError):
+            initiate_consumer()
+    done.set()
+    message_mock.assert_not_called()
+
+
+@patch("rabbit_consumer.message_consumer.on_message")
+def test_queue_consumer_stopped(message_mock, mocked_config):
+    """
+    Test that a message delivered once the consumer has stopped is left
+    unacked, so it is redelivered
+    """
+    mocked_config.retry_max_attempts = 0
+    message = NonCallableMock()
+    request_stop()
+
+    consumer = QueueConsumer(NonCallableMock(), _queue([message]), mocked_config)
+    consumer.run()
+
+    message_mock.assert_not_called()
+    message.ack.assert_not_called()
+
+
+@patch("rabbit_consumer.message_consumer.ShardRouter")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_router(
+    rabbitpy, message_mock, verify_kerberos, router, mocked_config
+):
+    """
+    Test that a router only routes messages, without needing Kerberos
+    """
+    mocked_config.consumer_role = "router"
+    mocked_config.consumer_shard_count = 4
+    mocked_config.retry_max_attempts = 0
+
+    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+        config.return_value = mocked_config
+        initiate_consumer()
+
+    queue = rabbitpy.Queue.return_value
+    channel = rabbitpy.Connection.return_value.__enter__.return_value.channel
+    router.assert_called_once_with(
+        channel.return_value.__enter__.return_value, queue.name, ANY, 4
+    )
+    router.return_value.run.assert_called_once_with(ANY, None)
+    assert router.return_value.run.call_args.args[0].queue is queue
+    verify_kerberos.assert_not_called()
+    message_mock.assert_not_called()
+
+
+def test_initiate_consumer_unknown_role(mocked_config):
+    """
+    Test that an unknown role is rejected
+    """
+    mocked_config.consumer_role = "unknown"
+    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+        config.return_value = mocked_config
+        with pytest.raises(ValueError):
+            initiate_consumer()
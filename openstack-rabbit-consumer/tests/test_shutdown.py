@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that the consume loops only stop between messages
+"""
+import signal
+import threading
+from unittest.mock import MagicMock, Mock
+
+from rabbit_consumer.shutdown import (
+    QueueStopper,
+    request_stop,
+    stop_on_sigterm,
+    stop_when_requested,
+)
+
+
+def _queue(messages):
+    queue = MagicMock()
+    queue.__iter__.return_value = iter(messages)
+    return queue
+
+
+def test_consume_handles_messages():
+    """
+    Tests that every message is handled until the queue is exhausted
+    """
+    handle = Mock()
+    QueueStopper(_queue(["message-1", "message-2"])).consume(handle)
+
+    assert [i.args[0] for i in handle.call_args_list] == ["message-1", "message-2"]
+
+
+def test_consume_stops_between_messages():
+    """
+    Tests that a stop requested whilst a message is handled lets it finish,
+    then cancels the queue before the next message is handled
+    """
+    queue = _queue(["message-1", "message-2"])
+    handle = Mock(side_effect=lambda _: request_stop())
+    QueueStopper(queue).consume(handle)
+
+    handle.assert_called_once_with("message-1")
+    queue.stop_consuming.assert_called_once_with()
+
+
+def test_stop_waits_for_message():
+    """
+    Tests that stopping a queue waits for the message being handled
+    """
+    handling = threading.Event()
+    finish = threading.Event()
+    stopper = QueueStopper(_queue(["message-1"]))
+
+    def handle(_):
+        handling.set()
+        finish.wait(5)
+
+    thread = threading.Thread(target=stopper.consume, args=(handle,))
+    thread.start()
+    assert handling.wait(5)
+
+    stopping = threading.Thread(target=stopper.stop)
+    stopping.start()
+    stopping.join(0.1)
+    assert stopping.is_alive()
+    stopper.queue.stop_consuming.assert_not_called()
+
+    finish.set()
+    stopping.join(5)
+    thread.join(5)
+    stopper.queue.stop_consuming.assert_called_once_with()
+
+
+def test_stop_when_requested():
+    """
+    Tests that every queue is stopped once a stop is requested, waking
+    any loops waiting for their next message
+    """
+    stoppers = [Mock(), Mock()]
+    watcher = stop_when_requested(stoppers)
+    stoppers[0].stop.assert_not_called()
+
+    request_stop()
+    watcher.join(5)
+    for stopper in stoppers:
+        stopper.stop.assert_called_once_with()
+
+
+def test_stop_ignores_closed_channel():
+    """
+    Tests that a queue whose channel is already closed is still stopped
+    """
+    queue = _queue([])
+    queue.stop_consuming.side_effect = ConnectionError()
+    QueueStopper(queue).stop()
+
+
+def test_stop_on_sigterm():
+    """
+    Tests SIGTERM only requests a stop, rather than interrupting the
+    message being handled
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    try:
+        stop_on_sigterm()
+        handler = signal.getsignal(signal.SIGTERM)
+        handler(signal.SIGTERM, None)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    handle = Mock()
+    QueueStopper(_queue(["message-1"])).consume(handle)
+    handle.assert_not_called()
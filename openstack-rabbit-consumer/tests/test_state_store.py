@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the local state store of VM records and processed messages
+"""
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer.state_store import (
+    StateStore,
+    VmRecord,
+    close_state_store,
+    get_state_store,
+)
+
+
+@pytest.fixture(name="store")
+def fixture_store(tmp_path):
+    """
+    Opens a state store in a temporary directory
+    """
+    store = StateStore(str(tmp_path / "state.db"), dedupe_ttl=60)
+    yield store
+    store.close()
+
+
+def test_record_created(store):
+    """
+    Tests that the records created for a VM can be read back
+    """
+    store.record_created("instance", "machine", "host.example.com", "10.0.0.1")
+    assert store.get_vm("instance") == VmRecord(
+        "instance", "machine", "host.example.com", "10.0.0.1", StateStore.CREATED
+    )
+    assert store.get_vm("missing") is None
+
+
+def test_record_deleted(store):
+    """
+    Tests that deleted VMs are no longer returned
+    """
+    store.record_created("instance", "machine", "host.example.com", "10.0.0.1")
+    store.record_deleted("instance")
+    assert store.get_vm("instance") is None
+
+
+def test_record_created_supersedes_hostname(store):
+    """
+    Tests that a VM which reuses a hostname drops the old VM's records,
+    so deleting the old VM can't remove the new host
+    """
+    store.record_created("old", "machine1", "host.example.com", "10.0.0.1")
+    store.record_created("other", "machine2", "other.example.com", "10.0.0.2")
+    store.record_created("new", "machine3", "host.example.com", "10.0.0.1")
+
+    assert store.get_vm("old") is None
+    assert store.get_vm("other")
+    assert store.get_vm("new").machine_name == "machine3"
+
+
+def test_records_are_durable(tmp_path):
+    """
+    Tests that records survive the store being re-opened
+    """
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, dedupe_ttl=60)
+    store.record_created("instance", "machine", "host.example.com", "10.0.0.1")
+    store.mark_processed("message")
+    store.close()
+
+    store = StateStore(path, dedupe_ttl=60)
+    assert store.get_vm("instance").machine_name == "machine"
+    assert store.is_processed("message")
+    store.close()
+
+
+def test_processed_messages(store):
+    """
+    Tests that processed message IDs are recognised
+    """
+    assert not store.is_processed("message")
+    store.mark_processed("message")
+    assert store.is_processed("message")
+
+
+def test_prune_processed(store):
+    """
+    Tests that message IDs older than the TTL are pruned
+    """
+    with patch("rabbit_consumer.state_store.time.time", return_value=0):
+        store.mark_processed("old")
+    store.mark_processed("new")
+
+    assert store.prune_processed() == 1
+    assert not store.is_processed("old")
+    assert store.is_processed("new")
+
+
+def test_get_state_store_disabled(monkeypatch):
+    """
+    Tests that no store is opened without a configured path
+    """
+    monkeypatch.delenv("STATE_DB_PATH", raising=False)
+    assert get_state_store() is None
+
+
+def test_get_state_store_is_shared(monkeypatch, tmp_path):
+    """
+    Tests that the store is opened once, and re-opened after closing
+    """
+    monkeypatch.setenv("STATE_DB_PATH", str(tmp_path / "state.db"))
+    store = get_state_store()
+    assert store is get_state_store()
+
+    close_state_store()
+    assert get_state_store() is not store
@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the per-message trace and the slow message log
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from rabbit_consumer.tracing import MessageTrace, run_in_context, span, traced
+
+
+def test_span_without_trace_is_noop():
+    """
+    Tests that spans do nothing outside of a trace
+    """
+    with span("stage") as current:
+        assert current is None
+
+
+def test_spans_are_nested():
+    """
+    Tests that spans are recorded as children of the current span
+    """
+    trace = MessageTrace()
+    with trace.activate():
+        with span("outer"):
+            with span("inner"):
+                pass
+        with span("second"):
+            pass
+
+    outer, second = trace.root.children
+    assert (outer.name, second.name) == ("outer", "second")
+    assert [i.name for i in outer.children] == ["inner"]
+    assert outer.duration >= outer.children[0].duration
+
+
+def test_span_records_error():
+    """
+    Tests that a span records the error raised within it, and re-raises
+    """
+    trace = MessageTrace()
+    with trace.activate(), pytest.raises(ValueError):
+        with span("failing"):
+            raise ValueError()
+
+    assert trace.root.children[0].error == "ValueError"
+    assert trace.root.children[0].duration is not None
+
+
+def test_traced_decorator():
+    """
+    Tests that a traced function is recorded under the given name
+    """
+
+    @traced("named")
+    def example():
+        return "value"
+
+    trace = MessageTrace()
+    with trace.activate():
+        assert example() == "value"
+    assert trace.root.children[0].name == "named"
+
+
+def test_run_in_context_joins_trace():
+    """
+    Tests that spans started on another thread join the current trace
+    """
+    trace = MessageTrace()
+
+    def stage():
+        with span("threaded"):
+            pass
+
+    with trace.activate(), ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(run_in_context(stage)).result()
+    assert trace.root.children[0].name == "threaded"
+
+
+def test_finish_logs_slow_message(caplog):
+    """
+    Tests that a slow message is logged as a single JSON line with its spans
+    """
+    trace = MessageTrace()
+    trace.fields["instance_id"] = "instance_id_mock"
+    with trace.activate(), span("stage"):
+        pass
+
+    with caplog.at_level(logging.WARNING, logger="rabbit_consumer.tracing"):
+        assert trace.finish(threshold=0.000001)
+
+    logged = json.loads(caplog.records[0].getMessage())
+    assert logged["slow_message"]
+    assert logged["instance_id"] == "instance_id_mock"
+    assert logged["name"] == "message"
+    assert logged["spans"][0]["name"] == "stage"
+
+
+@pytest.mark.parametrize("threshold", [0, 60])
+def test_finish_skips_fast_message(caplog, threshold):
+    """
+    Tests that fast messages aren't logged, and a threshold of 0 disables logging
+    """
+    with caplog.at_level(logging.WARNING, logger="rabbit_consumer.tracing"):
+        assert not MessageTrace().finish(threshold=threshold)
+    assert not caplog.records
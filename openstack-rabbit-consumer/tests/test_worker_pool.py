@@ -0,0 +1,212 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the sharded worker pool used to handle messages concurrently
+"""
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.worker_pool import LanedWorkerPool, ShardedWorkerPool
+
+
+def test_worker_pool_requires_workers():
+    """
+    Tests that a pool without workers can't be created
+    """
+    with pytest.raises(ValueError):
+        ShardedWorkerPool(0)
+
+
+def test_worker_pool_runs_all_tasks():
+    """
+    Tests that every submitted task runs before shutdown returns
+    """
+    pool = ShardedWorkerPool(4)
+    tasks = [Mock() for _ in range(20)]
+    for i, task in enumerate(tasks):
+        pool.submit(f"instance-{i}", task)
+    pool.shutdown()
+
+    for task in tasks:
+        task.assert_called_once_with()
+
+
+def test_worker_pool_keeps_key_order():
+    """
+    Tests that tasks with the same key run in the order they were submitted
+    """
+    pool = ShardedWorkerPool(4)
+    results = []
+    for i in range(50):
+        pool.submit("instance", lambda i=i: results.append(i))
+    pool.shutdown()
+
+    assert results == list(range(50))
+
+
+def test_worker_pool_same_key_same_shard():
+    """
+    Tests that a key always maps to the same worker
+    """
+    pool = ShardedWorkerPool(8)
+    assert len({pool.get_shard("instance-id") for _ in range(10)}) == 1
+    pool.shutdown()
+
+
+def test_worker_pool_runs_keys_in_parallel():
+    """
+    Tests that a slow task does not block tasks for other keys
+    """
+    pool = ShardedWorkerPool(2)
+    blocked_key = "a"
+    other_key = next(
+        f"b{i}" for i in range(100) if pool.get_shard(f"b{i}") != pool.get_shard("a")
+    )
+
+    release = threading.Event()
+    other_ran = threading.Event()
+    pool.submit(blocked_key, release.wait)
+    pool.submit(other_key, other_ran.set)
+
+    assert other_ran.wait(timeout=5)
+    release.set()
+    pool.shutdown()
+
+
+def test_worker_pool_raises_failed_task():
+    """
+    Tests that a failed task is raised on the next submit, and later
+    tasks are not run so they can be redelivered in order
+    """
+    pool = ShardedWorkerPool(1)
+    error = RuntimeError("failed")
+    pool.submit("instance", Mock(side_effect=error))
+    later = Mock()
+    pool.submit("instance", later)
+    pool.shutdown()
+
+    later.assert_not_called()
+    with pytest.raises(RuntimeError):
+        pool.submit("instance", Mock())
+
+
+@patch("rabbit_consumer.worker_pool.request_stop")
+def test_worker_pool_stops_consumer_on_failure(request_stop):
+    """
+    Tests that the first failure stops the consumer straight away, and
+    skipped tasks are told they were skipped
+    """
+    pool = ShardedWorkerPool(1)
+    pool.submit("instance", Mock(side_effect=RuntimeError("failed")))
+    later, on_skip = Mock(), Mock()
+    pool.submit("instance", later, on_skip=on_skip)
+    pool.shutdown()
+
+    request_stop.assert_called_once_with()
+    later.assert_not_called()
+    on_skip.assert_called_once_with()
+
+
+def test_laned_pool_runs_lanes_in_parallel():
+    """
+    Tests that a slow task in one lane does not block tasks in another
+    """
+    release = threading.Event()
+    done = threading.Event()
+    pool = LanedWorkerPool(
+        {"create": ShardedWorkerPool(1), "delete": ShardedWorkerPool(1)}
+    )
+    pool.submit("create", "instance-1", release.wait)
+    pool.submit("delete", "instance-2", done.set)
+
+    assert done.wait(5)
+    release.set()
+    pool.shutdown()
+
+
+def test_laned_pool_keeps_key_in_lane():
+    """
+    Tests that a key's tasks follow its outstanding task into the same lane,
+    so they still run in order
+    """
+    release = threading.Event()
+    results = []
+    pool = LanedWorkerPool(
+        {"create": ShardedWorkerPool(1), "delete": ShardedWorkerPool(1)}
+    )
+    pool.submit("create", "instance", release.wait)
+    pool.submit("create", "instance", lambda: results.append("create"))
+    assert pool.submit("delete", "instance", lambda: results.append("delete")) == (
+        "create"
+    )
+    release.set()
+    pool.shutdown()
+
+    assert results == ["create", "delete"]
+
+
+def test_laned_pool_uses_lane_once_idle():
+    """
+    Tests that a key is free to change lanes once its tasks have finished
+    """
+    pool = LanedWorkerPool(
+        {"create": ShardedWorkerPool(1), "delete": ShardedWorkerPool(1)}
+    )
+    pool.submit("create", "instance", Mock())
+    pool.lanes["create"].shutdown()
+
+    assert pool.submit("delete", "instance", Mock()) == "delete"
+    pool.lanes["delete"].shutdown()
+
+
+@patch("rabbit_consumer.worker_pool.request_stop")
+def test_laned_pool_releases_skipped_tasks(_):
+    """
+    Tests that tasks skipped after a failure no longer count as outstanding
+    """
+
+    def queued():
+        return REGISTRY.get_sample_value(
+            "rabbit_consumer_lane_messages", {"lane": "create"}
+        )
+
+    before = queued()
+    release = threading.Event()
+    pool = LanedWorkerPool({"create": ShardedWorkerPool(1)})
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError("failed")
+
+    pool.submit("create", "instance-1", fail)
+    pool.submit("create", "instance-2", Mock())
+    release.set()
+    pool.shutdown()
+
+    assert queued() == before
+    assert not pool._outstanding  # pylint: disable=protected-access
+
+
+def test_laned_pool_shared_pool_shuts_down_once():
+    """
+    Tests that lanes sharing a pool only shut it down once
+    """
+    shared = Mock()
+    pool = LanedWorkerPool({"create": shared, "delete": shared})
+    pool.shutdown()
+
+    shared.shutdown.assert_called_once_with()
+
+
+def test_laned_pool_reports_lane_error():
+    """
+    Tests that an error in any lane is reported by the pool
+    """
+    error = RuntimeError("failed")
+    create, delete = Mock(error=None), Mock(error=error)
+    pool = LanedWorkerPool({"create": create, "delete": delete})
+
+    assert pool.error is error